@@ -0,0 +1,172 @@
+"""
+Measures listing, downloading and parsing against the mock SAT server in
+tests/mock_sat.py, without real credentials. Reports invoices per second,
+p50/p99 latency and the peak RSS of the process (which includes the mock
+server, it runs in the same process).
+
+    python benchmarks/bench_end_to_end.py --days 30 --invoices-per-day 50 \\
+        --latency 0.05 --workers 8
+"""
+
+import os
+import sys
+import time
+import datetime
+import argparse
+import resource
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from tests.mock_sat import MockSAT  # noqa: E402
+from sat_gt_fel_invoices_downloader import metrics  # noqa: E402
+from sat_gt_fel_invoices_downloader.main import SATDownloader  # noqa: E402
+from sat_gt_fel_invoices_downloader.models import (  # noqa: E402
+    EstadoDTE,
+    SatCredentials,
+    SATFELFilters,
+    TypeFEL,
+)
+from sat_gt_fel_invoices_downloader.parser import parse_invoice_xml  # noqa: E402
+from sat_gt_fel_invoices_downloader.resilience import (  # noqa: E402
+    ResilientSession,
+    RetryPolicy,
+)
+
+
+class Latencies:
+    """
+    Collects the latency of every response of a session with a hook.
+    """
+
+    def __init__(self):
+        self.values = []
+        self._lock = threading.Lock()
+
+    def hook(self, response, *args, **kwargs):
+        with self._lock:
+            self.values.append(response.elapsed.total_seconds())
+
+    def take(self):
+        with self._lock:
+            values, self.values = self.values, []
+        return values
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak /= 1024
+    return peak / 1024
+
+
+def report(name, count, elapsed, latencies):
+    print(
+        "{:<12} {:>7} invoices {:>9.1f} invoices/s "
+        "p50 {:>7.1f} ms p99 {:>7.1f} ms peak RSS {:>7.1f} MiB".format(
+            name,
+            count,
+            count / elapsed if elapsed else 0,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            peak_rss_mib(),
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--invoices-per-day", type=int, default=20)
+    parser.add_argument("--lines-per-invoice", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--contingency-rate", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--window-days", type=int, default=7)
+    parser.add_argument("--formats", default="xml,pdf")
+    args = parser.parse_args()
+
+    sink = metrics.InMemorySink()
+    metrics.set_sink(sink)
+    start = datetime.date(2021, 1, 1)
+    filters = SATFELFilters(
+        0,
+        EstadoDTE.TODOS,
+        start,
+        start + datetime.timedelta(days=args.days - 1),
+        TypeFEL.RECIBIDA,
+    )
+    with MockSAT(
+        invoices_per_day=args.invoices_per_day,
+        start=start,
+        lines_per_invoice=args.lines_per_invoice,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        contingency_rate=args.contingency_rate,
+    ) as mock:
+        latencies = Latencies()
+        session = mock.session(
+            ResilientSession(default_policy=RetryPolicy(backoff=0.05))
+        )
+        session.hooks["response"].append(latencies.hook)
+        downloader = SATDownloader(request_session=session)
+        downloader.setCredentials(SatCredentials(mock.username, mock.password))
+        downloader.initialize()
+        latencies.take()
+
+        started = time.perf_counter()
+        invoices = list(
+            downloader.iter_invoices(
+                filters, window_days=args.window_days, prefetch=args.workers
+            )
+        )
+        report(
+            "listing", len(invoices), time.perf_counter() - started, latencies.take()
+        )
+
+        contents = []
+        for filetype in args.formats.split(","):
+            started = time.perf_counter()
+            results = list(
+                downloader.download_many(
+                    invoices, formats=(filetype,), workers=args.workers
+                )
+            )
+            elapsed = time.perf_counter() - started
+            failed = sum(1 for result in results if not result.ok)
+            if failed:
+                print("{} {} downloads failed".format(failed, filetype))
+            if filetype == "xml":
+                contents = [result.content for result in results if result.ok]
+            report(filetype, len(results), elapsed, latencies.take())
+
+        parse_times = []
+        started = time.perf_counter()
+        for content in contents:
+            parse_started = time.perf_counter()
+            parse_invoice_xml(content)
+            parse_times.append(time.perf_counter() - parse_started)
+        report("parsing", len(contents), time.perf_counter() - started, parse_times)
+
+    print()
+    for name, values in sorted(sink.summary().items()):
+        print(
+            "{:<16} {:>7} calls p50 {:>7.1f} ms p99 {:>7.1f} ms".format(
+                name, values["count"], values["p50"] * 1000, values["p99"] * 1000
+            )
+        )
+    for (name, tags), value in sorted(sink.counters.items()):
+        print("{:<16} {:>12} {}".format(name, value, dict(tags) or ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Compares the slotted models against the same dataclasses with a __dict__,
+and the Builder against calling the constructor, for many invoice lines.
+
+    python benchmarks/bench_models.py [number of lines]
+"""
+
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from sat_gt_fel_invoices_downloader.models import InvoiceLine
+
+
+@dataclass
+class DictInvoiceLine:
+    good_or_service: str
+    description: str
+    quantity: float
+    unit_price: float
+    total_line: float
+    total: float
+    line_number: int
+    discount: float
+
+
+def build_direct(cls, count):
+    return [
+        cls(
+            good_or_service="B",
+            description="LINE",
+            quantity=1.0,
+            unit_price=float(i),
+            total_line=float(i),
+            total=float(i),
+            line_number=i,
+            discount=0.0,
+        )
+        for i in range(count)
+    ]
+
+
+def build_with_builder(cls, count):
+    return [
+        InvoiceLine.builder()
+        .set_good_or_service("B")
+        .set_description("LINE")
+        .set_quantity(1.0)
+        .set_unit_price(float(i))
+        .set_total_line(float(i))
+        .set_total(float(i))
+        .set_line_number(i)
+        .set_discount(0.0)
+        .build()
+        for i in range(count)
+    ]
+
+
+def measure(name, function, cls, count):
+    start = time.perf_counter()
+    function(cls, count)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    lines = function(cls, count)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        "{:<28} {:>8.1f} ms {:>8.1f} MiB {:>6.0f} bytes/line".format(
+            name, elapsed * 1000, peak / 2**20, peak / count
+        )
+    )
+    return lines
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print("{} invoice lines".format(count))
+    measure("dataclass with __dict__", build_direct, DictInvoiceLine, count)
+    measure("slotted dataclass", build_direct, InvoiceLine, count)
+    measure("slotted, Builder", build_with_builder, InvoiceLine, count)
+
+
+if __name__ == "__main__":
+    main()
@@ -25,4 +25,15 @@ setuptools.setup(
     ],
     python_requires=">=3.7",
     install_requires=["requests", "beautifulsoup4", "lxml"],
+    extras_require={
+        "async": ["httpx"],
+        "arrow": ["pyarrow"],
+        "prometheus": ["prometheus_client"],
+        "zstd": ["zstandard"],
+    },
+    entry_points={
+        "console_scripts": [
+            "sat-fel-parse=sat_gt_fel_invoices_downloader.offline:main",
+        ],
+    },
 )
@@ -1 +1,23 @@
 from .main import SATDownloader
+from .parser import (
+    LazyInvoice,
+    parse_invoice_header,
+    parse_invoice_xml,
+    parse_invoice_xml_lazy,
+)
+from .models import (
+    Address,
+    ContactModel,
+    DownloadResult,
+    EstadoDTE,
+    Invoice,
+    InvoiceHeaderSummary,
+    InvoiceHeaders,
+    InvoiceLine,
+    InvoiceTotals,
+    IssuingModel,
+    SatCredentials,
+    SATFELFilters,
+    TotalTax,
+    TypeFEL,
+)
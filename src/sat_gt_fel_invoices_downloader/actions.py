@@ -4,8 +4,72 @@ import logging
 import requests
 from bs4 import BeautifulSoup, CData
 from urllib.parse import urlencode
+from . import metrics
 
 TIMEOUT = 20
+LOGIN_URL = "https://farm3.sat.gob.gt/menu/init.do"
+HOME_URL = "https://farm3.sat.gob.gt/menu-agenciaVirtual/private/home.jsf"
+STABLISMENTS_URL = (
+    "https://felcons.c.sat.gob.gt/dte-agencia-virtual/api/catalogo/establecimientos"
+)
+
+
+class SessionExpiredError(Exception):
+    pass
+
+
+"""
+Forms and parsers shared by the blocking actions and the asyncio client.
+"""
+
+
+def login_form(credentials):
+    return {
+        "login": credentials.username,
+        "password": credentials.password,
+        "operacion": "ACEPTAR",
+    }
+
+
+def parse_view_state(html):
+    bs = BeautifulSoup(html, features="html.parser")
+    view_state = bs.find("input", {"name": "javax.faces.ViewState"})
+    if view_state and "value" in view_state.attrs.keys():
+        return view_state["value"]
+    return None
+
+
+def _home_form(view_state, source):
+    return {
+        "javax.faces.partial.ajax": True,
+        "javax.faces.source: formContent": source,
+        "javax.faces.partial.execute": "@all",
+        "javax.faces.partial.render": "formContent:contentAgenciaVirtual",
+        "formContent:" + source: "formContent:" + source,
+        "formContent": "formContent",
+        "javax.faces.ViewState": view_state,
+    }
+
+
+def menu_form(view_state):
+    return _home_form(view_state, "j_idt34")
+
+
+def logout_form(view_state):
+    return _home_form(view_state, "j_idt46")
+
+
+def parse_fel_link(html):
+    parser = BeautifulSoup(html, features="lxml")
+    logging.getLogger().info(parser)
+    dtelink = parser.find("a", href=re.compile("dte-consulta"))
+    logging.info(dtelink)
+    return dtelink["href"]
+
+
+def auth_header(session):
+    cookie = session.cookies.get("ACCESS_TOKEN")
+    return {"authtoken": "token " + cookie}
 
 
 class SATDoLogin:
@@ -14,21 +78,15 @@ class SATDoLogin:
         self._session = request_session
         self._view_state = None
 
+    @metrics.timed("login")
     def execute(self):
-        login_dict = {
-            "login": self._credentials.username,
-            "password": self._credentials.password,
-            "operacion": "ACEPTAR",
-        }
         r = self._session.post(
-            "https://farm3.sat.gob.gt/menu/init.do", data=login_dict, timeout=TIMEOUT
+            LOGIN_URL, data=login_form(self._credentials), timeout=TIMEOUT
         )
         r.raise_for_status()
         logging.info("Did make loging")
-        bs = BeautifulSoup(r.text, features="html.parser")
-        view_state = bs.find("input", {"name": "javax.faces.ViewState"})
-        if view_state and "value" in view_state.attrs.keys():
-            self._view_state = view_state["value"]
+        self._view_state = parse_view_state(r.text)
+        if self._view_state:
             logging.info(self._view_state)
             logging.info("Did get view state")
             return (True, self._view_state)
@@ -41,24 +99,15 @@ class SATDoLogout:
         self._session = request_session
         self.view_state = view_state
 
+    @metrics.timed("logout")
     def execute(self):
-
-        form_data = {
-            "javax.faces.partial.ajax": True,
-            "javax.faces.source: formContent": "j_idt46",
-            "javax.faces.partial.execute": "@all",
-            "javax.faces.partial.render": "formContent:contentAgenciaVirtual",
-            "formContent:j_idt46": "formContent:j_idt46",
-            "formContent": "formContent",
-            "javax.faces.ViewState": self.view_state,
-        }
         r = self._session.post(
-            "https://farm3.sat.gob.gt/menu-agenciaVirtual/private/home.jsf",
-            data=form_data,
+            HOME_URL,
+            data=logout_form(self.view_state),
             timeout=3,
         )
         r2 = self._session.post(
-            "https://farm3.sat.gob.gt/menu/init.do",
+            LOGIN_URL,
             data={"operacion": "CANCELAR"},
             timeout=3,
         )
@@ -70,29 +119,17 @@ class SATGetMenu:
         self._view_state = view_state
         self._url_get_fel = None
 
+    @metrics.timed("menu")
     def execute(self):
-        form_data = {
-            "javax.faces.partial.ajax": True,
-            "javax.faces.source: formContent": "j_idt34",
-            "javax.faces.partial.execute": "@all",
-            "javax.faces.partial.render": "formContent:contentAgenciaVirtual",
-            "formContent:j_idt34": "formContent:j_idt34",
-            "formContent": "formContent",
-            "javax.faces.ViewState": self._view_state,
-        }
-        print(form_data)
+        form_data = menu_form(self._view_state)
+        logging.debug(form_data)
         r = self._session.post(
-            "https://farm3.sat.gob.gt/menu-agenciaVirtual/private/home.jsf",
+            HOME_URL,
             data=form_data,
             timeout=TIMEOUT,
         )
         logging.getLogger().debug(r.text)
-        parser = BeautifulSoup(r.text)
-        logging.getLogger().info(parser)
-        dtelink = parser.find("a", href=re.compile("dte-consulta"))
-        logging.info(dtelink)
-        dte_link = dtelink["href"]
-        self._url_get_fel = dte_link
+        self._url_get_fel = parse_fel_link(r.text)
         return (True, self._url_get_fel)
 
 
@@ -100,9 +137,9 @@ class SATGetStablisments:
     def __init__(self, request_session):
         self._session = request_session
 
+    @metrics.timed("establishments")
     def execute(self):
-        url = "https://felcons.c.sat.gob.gt/dte-agencia-virtual/api/catalogo/establecimientos"
-        cookie = self._session.cookies.get("ACCESS_TOKEN")
-        header = {"authtoken": "token " + cookie}
-        r = self._session.get(url, headers=header, timeout=TIMEOUT)
+        r = self._session.get(
+            STABLISMENTS_URL, headers=auth_header(self._session), timeout=TIMEOUT
+        )
         return r.json
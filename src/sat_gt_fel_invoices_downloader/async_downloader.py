@@ -0,0 +1,233 @@
+import asyncio
+import logging
+from .actions import (
+    HOME_URL,
+    LOGIN_URL,
+    TIMEOUT,
+    auth_header,
+    login_form,
+    logout_form,
+    menu_form,
+    parse_fel_link,
+    parse_view_state,
+)
+from .main import (
+    CONTINGENCY_URL,
+    DOWNLOAD_FORMATS,
+    contingency_payload,
+    decode_contingency_pdf,
+    document_url,
+    invoices_headers_url,
+)
+from .parser import parse_invoice_xml
+from .models import DownloadResult, EstadoDTE, SATFELFilters, TypeFEL
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+def _form(data):
+    # httpx encodes booleans as "true", keep the same form values requests sends
+    return {key: str(value) for key, value in data.items()}
+
+
+def _check_status(r):
+    # Redirects were followed already, anything but a 200 is not the document
+    if r.status_code != 200:
+        raise httpx.HTTPStatusError(
+            "{} answered {}".format(r.url, r.status_code),
+            request=r.request,
+            response=r,
+        )
+
+
+"""
+asyncio version of SATDownloader. It needs httpx, install it with
+pip install sat_gt_fel_invoices_downloader[async]
+"""
+
+
+class AsyncSATDownloader:
+    def __init__(self, client=None, max_concurrency=20):
+        if httpx is None:
+            raise ImportError(
+                "AsyncSATDownloader needs httpx. "
+                "Install it with pip install sat_gt_fel_invoices_downloader[async]"
+            )
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=TIMEOUT,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=max_concurrency),
+            )
+        self.credentials = None
+        self.client = client
+        self.url_get_fel = None
+        self.its_initialized = False
+        self.view_state = None
+        self._semaphore = None
+        self._max_concurrency = max_concurrency
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        if self.its_initialized:
+            await self.logout()
+        await self.client.aclose()
+
+    def setCredentials(self, credentials):
+        self.credentials = credentials
+        return self
+
+    async def _request(self, method, url, **kwargs):
+        if self._semaphore is None:
+            # Created here so it belongs to the running event loop
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        async with self._semaphore:
+            return await self.client.request(method, url, **kwargs)
+
+    async def initialize(self):
+        if self.credentials is None:
+            raise ValueError(
+                "You didn't provided credentials. Please use setCredentials method"
+            )
+        r = await self._request(
+            "POST", LOGIN_URL, data=login_form(self.credentials), timeout=TIMEOUT
+        )
+        r.raise_for_status()
+        view_state = parse_view_state(r.text)
+        if not view_state:
+            raise ValueError("The credentials you provided are not valid")
+        logging.info("Did authenticate")
+        r = await self._request(
+            "POST", HOME_URL, data=_form(menu_form(view_state)), timeout=TIMEOUT
+        )
+        self.url_get_fel = parse_fel_link(r.text)
+        logging.info("Did get menu URL")
+        await self._request("GET", self.url_get_fel, timeout=TIMEOUT)
+        self.its_initialized = True
+        self.view_state = view_state
+        logging.info("Initialization process finished")
+
+    """
+        Remember to logout after you have finished your operations to make sure you don't interfere with web login.
+    """
+
+    async def logout(self):
+        await self._request(
+            "POST", HOME_URL, data=_form(logout_form(self.view_state)), timeout=3
+        )
+        await self._request(
+            "POST", LOGIN_URL, data={"operacion": "CANCELAR"}, timeout=3
+        )
+        self.its_initialized = False
+        self.view_state = None
+        self.url_get_fel = None
+
+    async def _ensure_initialized(self):
+        if not self.its_initialized:
+            await self.initialize()
+
+    async def get_invoices_with_filters(self, filters: SATFELFilters):
+        await self._ensure_initialized()
+        url = invoices_headers_url(self.credentials.username, filters)
+        r = await self._request(
+            "GET", url, headers=auth_header(self.client), timeout=TIMEOUT
+        )
+        r.raise_for_status()
+        return r.json()["detalle"]["data"]
+
+    async def get_invoices(self, date_start, date_end, received=True):
+        type_fel = TypeFEL.RECIBIDA if received else TypeFEL.EMITIDA
+        filter = SATFELFilters(0, EstadoDTE.TODOS, date_start, date_end, type_fel)
+        return await self.get_invoices_with_filters(filter)
+
+    async def _get_content(self, invoice, filetype, received=True):
+        await self._ensure_initialized()
+        url = document_url(self.credentials.username, filetype, received)
+        r = await self._request(
+            "POST",
+            url,
+            headers=auth_header(self.client),
+            json=[invoice],
+            timeout=TIMEOUT,
+        )
+        if r.status_code == 500 and filetype == "pdf":
+            logging.warning("Did get 500 error trying pdf contingency")
+            return await self._get_contingency_pdf(invoice)
+        _check_status(r)
+        return r.content
+
+    async def _get_contingency_pdf(self, invoice):
+        r = await self._request(
+            "POST", CONTINGENCY_URL, json=contingency_payload(invoice), timeout=TIMEOUT
+        )
+        _check_status(r)
+        return decode_contingency_pdf(r.json()[0])
+
+    async def get_xml_content(self, invoice, received=True):
+        return await self._get_content(invoice, "xml", received)
+
+    async def get_pdf_content(self, invoice, received=True):
+        return await self._get_content(invoice, "pdf", received)
+
+    async def get_invoice_model(self, invoice, received=True):
+        xml_content = await self.get_xml_content(invoice, received)
+        return parse_invoice_xml(xml_content)
+
+    async def download_many(
+        self, invoices, formats=("xml", "pdf"), concurrency=None, received=True
+    ):
+        """
+        Async generator that yields a DownloadResult for every format of
+        every invoice as soon as it finishes, keeping at most `concurrency`
+        downloads running.
+        """
+        for filetype in formats:
+            if filetype not in DOWNLOAD_FORMATS:
+                raise ValueError("Unknown format {}".format(filetype))
+        await self._ensure_initialized()
+        concurrency = concurrency or self._max_concurrency
+
+        async def download(invoice, filetype):
+            try:
+                if filetype == "model":
+                    content = await self.get_invoice_model(invoice, received)
+                else:
+                    content = await self._get_content(invoice, filetype, received)
+            except Exception as e:
+                logging.warning(
+                    "Could not download %s of %s: %s",
+                    filetype,
+                    invoice.get("numeroUuid"),
+                    e,
+                )
+                return DownloadResult(invoice, filetype, error=e)
+            return DownloadResult(invoice, filetype, content=content)
+
+        pending = set()
+        try:
+            for invoice in invoices:
+                for filetype in formats:
+                    pending.add(asyncio.ensure_future(download(invoice, filetype)))
+                    if len(pending) >= concurrency:
+                        done, pending = await asyncio.wait(
+                            pending, return_when=asyncio.FIRST_COMPLETED
+                        )
+                        for task in done:
+                            yield task.result()
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    yield task.result()
+        finally:
+            # The consumer stopped early, don't leave downloads running
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
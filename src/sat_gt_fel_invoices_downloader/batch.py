@@ -0,0 +1,57 @@
+import io
+import zipfile
+from lxml import etree
+
+"""
+Helpers to split the response of a request with many invoices back into
+one document per numeroUuid.
+"""
+
+ZIP_SIGNATURE = b"PK\x03\x04"
+
+
+def split_batch_response(content, uuids):
+    if content[0:4] == ZIP_SIGNATURE:
+        return _split_zip(content, uuids)
+    if content.lstrip()[0:1] == b"<":
+        return _split_xml(content, uuids)
+    return {}
+
+
+def _find_uuid(text, uuids):
+    text = text.upper()
+    for uuid in uuids:
+        if uuid.upper() in text:
+            return uuid
+    return None
+
+
+def _split_zip(content, uuids):
+    documents = {}
+    try:
+        with zipfile.ZipFile(io.BytesIO(content)) as zip_file:
+            for info in zip_file.infolist():
+                uuid = _find_uuid(info.filename, uuids)
+                if uuid is not None and uuid not in documents:
+                    documents[uuid] = zip_file.read(info)
+    except zipfile.BadZipFile as e:
+        raise ValueError("Invalid zip file in batch response") from e
+    return documents
+
+
+def _split_xml(content, uuids):
+    try:
+        root = etree.fromstring(content)
+    except etree.XMLSyntaxError as e:
+        raise ValueError("Invalid XML in batch response") from e
+    documents = {}
+    for document in root.iter("{*}GTDocumento"):
+        authorization = document.find(".//{*}NumeroAutorizacion")
+        if authorization is None or not authorization.text:
+            continue
+        uuid = _find_uuid(authorization.text.strip(), uuids)
+        if uuid is not None:
+            documents[uuid] = etree.tostring(
+                document, xml_declaration=True, encoding="UTF-8"
+            )
+    return documents
@@ -0,0 +1,218 @@
+import os
+import logging
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from .files import atomic_open, atomic_write
+
+# Eviction frees space down to this fraction of max_bytes, so the puts after it
+# don't have to scan the cache again
+LOW_WATER_MARK = 0.9
+
+
+class DirectoryCache:
+    """
+    Stores downloaded documents in a local directory, one file per numeroUuid
+    and format, sharded in sub directories by the first characters of the UUID.
+
+    When max_bytes is given the least recently used files are removed once the
+    cache grows past it, until it is back to LOW_WATER_MARK of max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=None, shard_length=2):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.shard_length = shard_length
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, uuid, filetype):
+        uuid = uuid.upper()
+        return os.path.join(
+            self.path, uuid[: self.shard_length], "{}.{}".format(uuid, filetype)
+        )
+
+    def get(self, uuid, filetype):
+        filename = self._filename(uuid, filetype)
+        try:
+            with open(filename, "rb") as f:
+                content = f.read()
+            # The modification time is used as last access time for the LRU
+            os.utime(filename)
+        except FileNotFoundError:
+            return None
+        return content
+
+    def put(self, uuid, filetype, content):
+        filename = self._filename(uuid, filetype)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        previous_size = _file_size(filename)
+        atomic_write(filename, content)
+        self._added(len(content) - previous_size)
+
+    def put_file(self, uuid, filetype, path):
+        """
+        Same as put but copying the content from the file in path.
+        """
+        filename = self._filename(uuid, filetype)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        previous_size = _file_size(filename)
+        with open(path, "rb") as source, atomic_open(filename) as destination:
+            shutil.copyfileobj(source, destination)
+        self._added(_file_size(filename) - previous_size)
+
+    def _added(self, size):
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+        if self.max_bytes is not None:
+            self._evict()
+
+    def invalidate(self, uuid):
+        shard = os.path.dirname(self._filename(uuid, ""))
+        prefix = uuid.upper() + "."
+        if not os.path.isdir(shard):
+            return
+        with self._lock:
+            for name in os.listdir(shard):
+                if name.startswith(prefix):
+                    size = _file_size(os.path.join(shard, name))
+                    os.remove(os.path.join(shard, name))
+                    if self._size is not None:
+                        self._size -= size
+
+    def _entries(self):
+        for shard in os.scandir(self.path):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    yield entry
+
+    def size(self):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry.stat().st_size for entry in self._entries())
+            return self._size
+
+    def _evict(self):
+        if self.size() <= self.max_bytes:
+            return
+        low_water = self.max_bytes * LOW_WATER_MARK
+        with self._lock:
+            entries = []
+            for entry in self._entries():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            entries.sort()
+            self._size = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if self._size <= low_water:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                self._size -= size
+                logging.debug("Evicted %s from the cache", path)
+
+
+class MemoryCache:
+    """
+    Keeps downloaded documents in memory, so asking again for a document in
+    the same process doesn't download it again. Holds at most max_bytes of
+    documents, removing the least recently used, and with ttl a document is
+    downloaded again that many seconds after it was stored.
+
+    With a backend (like a DirectoryCache) the misses are looked up there,
+    and documents are stored in both.
+    """
+
+    def __init__(
+        self, max_bytes=64 * 1024 * 1024, ttl=None, backend=None, clock=time.monotonic
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.backend = backend
+        self._clock = clock
+        # (uuid, filetype) -> (content, stored at)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            content, stored_at = entry
+            if self.ttl is not None and self._clock() - stored_at > self.ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return content
+
+    def get(self, uuid, filetype):
+        key = (uuid.upper(), filetype)
+        content = self._get(key)
+        if content is None and self.backend is not None:
+            content = self.backend.get(uuid, filetype)
+            if content is not None:
+                self._add(key, content)
+        return content
+
+    def _add(self, key, content):
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (content, self._clock())
+            self._size += len(content)
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[0])
+
+    def put(self, uuid, filetype, content):
+        self._add((uuid.upper(), filetype), content)
+        if self.backend is not None:
+            self.backend.put(uuid, filetype, content)
+
+    def put_file(self, uuid, filetype, path):
+        """
+        Same as put for a document saved in path. Only files that fit in
+        max_bytes are read into memory.
+        """
+        if _file_size(path) <= self.max_bytes:
+            with open(path, "rb") as f:
+                self._add((uuid.upper(), filetype), f.read())
+        if self.backend is not None:
+            self.backend.put_file(uuid, filetype, path)
+
+    def invalidate(self, uuid):
+        uuid = uuid.upper()
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == uuid]:
+                self._remove(key)
+        if self.backend is not None:
+            self.backend.invalidate(uuid)
+
+    def size(self):
+        with self._lock:
+            return self._size
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def _file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except FileNotFoundError:
+        return 0
@@ -0,0 +1,155 @@
+import os
+import csv
+from array import array
+from .parser import extract_invoice, invoice_values, parse_xml_tree
+
+"""
+Columnar tables of invoice headers, lines and taxes. Numeric columns are
+stored in array.array buffers (usable with numpy.frombuffer without copies)
+and the rest in lists. The tables can be filled straight from the XML,
+without building the Invoice models.
+"""
+
+HEADER_COLUMNS = (
+    ("fel_signature", str),
+    ("fel_invoice_serie", str),
+    ("fel_invoice_number", str),
+    ("issue_date", object),
+    ("invoice_type", str),
+    ("currency", str),
+    ("issuer_nit", str),
+    ("issuer_name", str),
+    ("issuer_commercial_name", str),
+    ("establishment", str),
+    ("vat_affiliation", str),
+    ("receiver_nit", str),
+    ("receiver_name", str),
+    ("grand_total", float),
+)
+LINE_COLUMNS = (
+    ("fel_signature", str),
+    ("line_number", int),
+    ("good_or_service", str),
+    ("description", str),
+    ("quantity", float),
+    ("unit_price", float),
+    ("total_line", float),
+    ("discount", float),
+    ("total", float),
+)
+TAX_COLUMNS = (
+    ("fel_signature", str),
+    ("tax_name", str),
+    ("tax_total", float),
+)
+
+
+def _new_column(kind):
+    if kind is float:
+        return array("d")
+    if kind is int:
+        return array("q")
+    return []
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError(
+            "Arrow and Parquet export need pyarrow. "
+            "Install it with pip install sat_gt_fel_invoices_downloader[arrow]"
+        )
+    return pyarrow
+
+
+class ColumnTable:
+    def __init__(self, schema):
+        self.schema = schema
+        self.columns = {name: _new_column(kind) for name, kind in schema}
+        self._appenders = [(name, self.columns[name].append) for name, _ in schema]
+
+    def __len__(self):
+        return len(self.columns[self.schema[0][0]])
+
+    def append(self, row):
+        for name, append in self._appenders:
+            append(row[name])
+
+    def rows(self):
+        names = [name for name, _ in self.schema]
+        return zip(*(self.columns[name] for name in names))
+
+    def to_csv(self, path):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([name for name, _ in self.schema])
+            writer.writerows(self.rows())
+
+    def to_arrow(self):
+        pyarrow = _import_pyarrow()
+        return pyarrow.table(
+            {name: pyarrow.array(self.columns[name]) for name, _ in self.schema}
+        )
+
+
+class InvoiceColumns:
+    """
+    Headers, lines and taxes of many invoices in three ColumnTable. Lines
+    and taxes reference their invoice by fel_signature.
+    """
+
+    def __init__(self):
+        self.headers = ColumnTable(HEADER_COLUMNS)
+        self.lines = ColumnTable(LINE_COLUMNS)
+        self.taxes = ColumnTable(TAX_COLUMNS)
+
+    def __len__(self):
+        return len(self.headers)
+
+    def add_values(self, header, lines, taxes):
+        signature = header["fel_signature"]
+        self.headers.append(header)
+        for line in lines:
+            line["fel_signature"] = signature
+            self.lines.append(line)
+        for name, total in taxes:
+            self.taxes.append(
+                {"fel_signature": signature, "tax_name": name, "tax_total": total}
+            )
+
+    def add_xml(self, content):
+        """
+        Adds the invoice in the XML content without building its models.
+        """
+        self.add_values(*extract_invoice(parse_xml_tree(content)))
+
+    def add_invoice(self, invoice):
+        self.add_values(*invoice_values(invoice))
+
+    def tables(self):
+        return {"headers": self.headers, "lines": self.lines, "taxes": self.taxes}
+
+    def to_csv(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name, table in self.tables().items():
+            table.to_csv(os.path.join(directory, name + ".csv"))
+
+    def to_arrow(self):
+        """
+        Returns a dict of pyarrow tables. Needs pyarrow installed.
+        """
+        return {name: table.to_arrow() for name, table in self.tables().items()}
+
+    def to_parquet(self, directory):
+        """
+        Writes headers.parquet, lines.parquet and taxes.parquet. Needs pyarrow.
+        """
+        _import_pyarrow()
+        import pyarrow.parquet
+
+        os.makedirs(directory, exist_ok=True)
+        for name, table in self.to_arrow().items():
+            pyarrow.parquet.write_table(
+                table, os.path.join(directory, name + ".parquet")
+            )
@@ -0,0 +1,85 @@
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from itertools import islice
+
+
+def bounded_unordered_map(executor, fn, iterable, max_in_flight):
+    """
+    Like executor.map but yields the results as they finish and never keeps
+    more than max_in_flight submitted tasks, so the input can be a generator.
+    """
+    pending = set()
+    for item in iterable:
+        pending.add(executor.submit(fn, item))
+        if len(pending) >= max_in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+def bounded_map(executor, fn, iterable, max_in_flight):
+    """
+    Like executor.map, results in order, but only submits up to max_in_flight
+    tasks ahead of the one being consumed, so the input can be a generator.
+    """
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            # The task being consumed plus max_in_flight ahead of it
+            if len(pending) > max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # The consumer stopped early, don't run what it won't read
+        for future in pending:
+            future.cancel()
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time. Calling do with a key that is already
+    running waits for that call and returns its result (or raises its
+    exception) instead of running function again.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = function()
+        except BaseException as e:
+            self._forget(key)
+            future.set_exception(e)
+            raise
+        self._forget(key)
+        future.set_result(result)
+        return result
+
+    def _forget(self, key):
+        with self._lock:
+            del self._calls[key]
@@ -0,0 +1,63 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .concurrency import SingleFlight
+from .resilience import CircuitBreaker
+
+
+class ContingencyRouter:
+    """
+    Decides where PDFs are requested from. After failure_threshold
+    consecutive 5xx answers of consulta-dte/pdf the PDFs are requested
+    straight from the contingency verifier for cool_down seconds, so an
+    outage costs one request per invoice instead of two. Then consulta-dte
+    is tried again.
+
+    The verifier requests run in their own pool of `workers` threads, and
+    requests for an invoice that is already being fetched wait for that one
+    instead of repeating it.
+    """
+
+    def __init__(
+        self, cool_down=60, failure_threshold=3, workers=4, clock=time.monotonic
+    ):
+        self.workers = workers
+        self._breaker = CircuitBreaker(failure_threshold, cool_down, clock)
+        self._single_flight = SingleFlight()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def use_primary(self):
+        return self._breaker.remaining() == 0
+
+    def primary_failed(self):
+        self._breaker.record_failure()
+
+    def primary_succeeded(self):
+        self._breaker.record_success()
+
+    def _submit(self, function):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="contingency"
+                )
+            executor = self._executor
+        return executor.submit(function)
+
+    def fetch(self, uuid, function):
+        """
+        Runs function in the contingency pool and returns its result. With a
+        uuid, concurrent calls for it share one call of function.
+        """
+        if uuid is None:
+            return self._submit(function).result()
+        return self._single_flight.do(
+            uuid.upper(), lambda: self._submit(function).result()
+        )
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
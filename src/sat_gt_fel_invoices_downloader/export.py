@@ -0,0 +1,314 @@
+import io
+import os
+import csv
+import json
+import time
+import base64
+import hashlib
+import logging
+import tarfile
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from .concurrency import bounded_unordered_map
+from .files import atomic_write
+from .models import ExportReport, TypeFEL
+from .parser import parse_invoice_header
+
+"""
+Writes the documents of a period straight into a compressed archive (zip,
+tar.gz or tar.zst) as they are downloaded, with an index of the invoices,
+without leaving one file per document on disk.
+
+While it runs the archive is written to <path>.partial and a checkpoint is
+saved to <path>.progress every few documents. Running the export again
+after an interruption continues from the last checkpoint.
+"""
+
+INDEX_FORMATS = ("csv", "json")
+INDEX_COLUMNS = (
+    "uuid",
+    "serie",
+    "number",
+    "issue_date",
+    "invoice_type",
+    "issuer_nit",
+    "issuer_name",
+    "receiver_nit",
+    "receiver_name",
+    "establishment",
+    "currency",
+    "grand_total",
+    "status",
+)
+# Already compressed, deflating them again costs time for nothing
+STORED_FORMATS = ("pdf",)
+
+
+def archive_kind(path):
+    for kind in ("zip", "tar.gz", "tar.zst"):
+        if path.endswith("." + kind):
+            return kind
+    raise ValueError("The archive must end in .zip, .tar.gz or .tar.zst")
+
+
+class _ZipWriter:
+    """
+    A checkpoint closes the zip file, writing its central directory, and
+    opens it again to append. The central directory is kept in the checkpoint
+    because the next documents are written over it.
+    """
+
+    def __init__(self, filename, append):
+        # ZipFile leaves a file object it didn't open open on close, so the
+        # checkpoints can fsync it
+        self._file = open(filename, "r+b" if append else "w+b")
+        self._zip = zipfile.ZipFile(self._file, "a" if append else "w")
+
+    def add(self, name, content):
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        extension = name.rsplit(".", 1)[-1]
+        if extension in STORED_FORMATS:
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        self._zip.writestr(info, content)
+
+    def _sync(self):
+        self._zip.close()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def checkpoint(self):
+        self._sync()
+        offset = self._zip.start_dir
+        self._file.seek(offset)
+        tail = self._file.read()
+        self._zip = zipfile.ZipFile(self._file, "a")
+        return offset, tail
+
+    def finish(self):
+        self._sync()
+        self._file.close()
+
+
+class _TarWriter:
+    """
+    Writes the tar members through the compressor by hand. A checkpoint ends
+    the current gzip member or zstd frame: concatenated ones decompress as a
+    single stream, so resuming only needs to truncate the file to the last
+    checkpoint and continue with a new one.
+    """
+
+    def __init__(self, filename, new_compressor):
+        self._file = open(filename, "ab")
+        self._new_compressor = new_compressor
+        self._compressor = new_compressor()
+
+    def _write(self, data):
+        self._file.write(self._compressor.compress(data))
+
+    def add(self, name, content):
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        self._write(info.tobuf(format=tarfile.PAX_FORMAT))
+        self._write(content)
+        padding = -len(content) % tarfile.BLOCKSIZE
+        if padding:
+            self._write(tarfile.NUL * padding)
+
+    def _end_frame(self):
+        self._file.write(self._compressor.flush())
+        self._compressor = self._new_compressor()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def checkpoint(self):
+        self._end_frame()
+        return self._file.tell(), b""
+
+    def finish(self):
+        # End of archive: two empty blocks
+        self._write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+        self._end_frame()
+        self._file.close()
+
+
+def _gzip_compressor():
+    # wbits 31 writes a gzip member instead of a raw zlib stream
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def _zstd_compressor():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "tar.zst archives need zstandard. Install it with "
+            "pip install sat_gt_fel_invoices_downloader[zstd]"
+        )
+    return zstandard.ZstdCompressor().compressobj()
+
+
+def _open_writer(kind, filename, append):
+    if kind == "zip":
+        return _ZipWriter(filename, append)
+    if kind == "tar.gz":
+        return _TarWriter(filename, _gzip_compressor)
+    return _TarWriter(filename, _zstd_compressor)
+
+
+def _index_row(invoice):
+    summary = parse_invoice_header(invoice)
+    return {
+        "uuid": summary.fel_signature,
+        "serie": summary.fel_invoice_serie,
+        "number": summary.fel_invoice_number,
+        "issue_date": summary.issue_date.isoformat() if summary.issue_date else None,
+        "invoice_type": summary.invoice_type,
+        "issuer_nit": summary.issuer_nit,
+        "issuer_name": summary.issuer_name,
+        "receiver_nit": summary.receiver_nit,
+        "receiver_name": summary.receiver_name,
+        "establishment": summary.establishment,
+        "currency": summary.currency,
+        "grand_total": summary.grand_total,
+        "status": summary.status.value if summary.status else None,
+    }
+
+
+def _index_content(rows, index, formats):
+    if index == "json":
+        return json.dumps(rows, ensure_ascii=False, indent=1).encode("utf-8")
+    columns = list(INDEX_COLUMNS)
+    for filetype in formats:
+        columns += [filetype, filetype + "_sha256"]
+    output = io.StringIO()
+    writer = csv.DictWriter(output, columns, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue().encode("utf-8")
+
+
+class ArchiveExporter:
+    """
+    Downloads the formats of every invoice of filters with `workers` threads
+    and writes them into the archive in path as xml/<uuid>.xml and
+    pdf/<uuid>.pdf, plus an index.csv or index.json with the listing of every
+    invoice, its members and their sha256.
+
+    Only the documents being downloaded are kept in memory. Documents that
+    fail are left out of the archive, with an empty member in the index, and
+    reported in ExportReport.failed.
+    """
+
+    def __init__(
+        self,
+        downloader,
+        path,
+        formats=("xml", "pdf"),
+        index="csv",
+        workers=4,
+        checkpoint_every=100,
+    ):
+        for filetype in formats:
+            if filetype not in ("xml", "pdf"):
+                raise ValueError("Unknown format {}".format(filetype))
+        if index not in INDEX_FORMATS:
+            raise ValueError("index must be one of {}".format(INDEX_FORMATS))
+        self.downloader = downloader
+        self.path = path
+        self.kind = archive_kind(path)
+        self.formats = formats
+        self.index = index
+        self.workers = workers
+        self.checkpoint_every = checkpoint_every
+        self.partial_path = path + ".partial"
+        self.progress_path = path + ".progress"
+
+    def _load_progress(self):
+        """
+        Returns the checkpoint of a previous run, after restoring the partial
+        archive to it, or None to start from scratch.
+        """
+        if not os.path.exists(self.progress_path) or not os.path.exists(
+            self.partial_path
+        ):
+            return None
+        with open(self.progress_path, "rb") as f:
+            progress = json.loads(f.read())
+        with open(self.partial_path, "r+b") as f:
+            f.truncate(progress["offset"])
+            f.seek(progress["offset"])
+            f.write(base64.b64decode(progress["tail"]))
+        logging.info(
+            "Resuming %s with %s documents", self.path, len(progress["members"])
+        )
+        return progress
+
+    def _save_progress(self, writer, rows, members):
+        offset, tail = writer.checkpoint()
+        progress = {
+            "offset": offset,
+            "tail": base64.b64encode(tail).decode("ascii"),
+            "rows": rows,
+            "members": sorted(members),
+        }
+        atomic_write(
+            self.progress_path, json.dumps(progress).encode("utf-8"), fsync=True
+        )
+
+    def run(self, filters):
+        progress = self._load_progress()
+        if progress is None:
+            if os.path.exists(self.partial_path):
+                os.remove(self.partial_path)
+            rows, members = {}, set()
+        else:
+            rows, members = progress["rows"], set(progress["members"])
+        received = filters.tipo == TypeFEL.RECIBIDA
+        writer = _open_writer(self.kind, self.partial_path, progress is not None)
+        failed = []
+
+        def tasks():
+            for invoice in self.downloader.iter_invoices(filters):
+                uuid = invoice["numeroUuid"].upper()
+                if uuid not in rows:
+                    rows[uuid] = _index_row(invoice)
+                for filetype in self.formats:
+                    if "{0}/{1}.{0}".format(filetype, uuid) not in members:
+                        yield invoice, filetype
+
+        def download(task):
+            invoice, filetype = task
+            return self.downloader.download_one(invoice, filetype, received=received)
+
+        written = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for result in bounded_unordered_map(
+                executor, download, tasks(), self.workers * 2
+            ):
+                uuid = result.invoice["numeroUuid"].upper()
+                if not result.ok:
+                    failed.append((uuid, result.format, result.error))
+                    continue
+                name = "{0}/{1}.{0}".format(result.format, uuid)
+                writer.add(name, result.content)
+                rows[uuid][result.format] = name
+                rows[uuid][result.format + "_sha256"] = hashlib.sha256(
+                    result.content
+                ).hexdigest()
+                members.add(name)
+                written += 1
+                if written % self.checkpoint_every == 0:
+                    self._save_progress(writer, rows, members)
+
+        index = _index_content(list(rows.values()), self.index, self.formats)
+        writer.add("index." + self.index, index)
+        writer.finish()
+        os.replace(self.partial_path, self.path)
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+        return ExportReport(self.path, len(rows), len(members), failed)
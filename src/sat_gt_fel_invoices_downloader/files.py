@@ -0,0 +1,67 @@
+import os
+import base64
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_open(filename, fsync=False):
+    """
+    Opens a temporary file in the same directory as filename and renames it
+    over filename when the block finishes, so readers never see a half written
+    file. If the block raises the temporary file is removed.
+    """
+    directory = os.path.dirname(filename) or "."
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+def atomic_write(filename, content, fsync=False):
+    with atomic_open(filename, fsync=fsync) as f:
+        f.write(content)
+
+
+def iter_decode_base64_json(chunks):
+    """
+    Decodes the first string of a JSON list like ["JVBERi0..."] holding base64
+    data, as the chunks of the response arrive. Yields the decoded bytes
+    without keeping the whole payload in memory.
+    """
+    started = False
+    escape = b""
+    remainder = b""
+    for chunk in chunks:
+        if not started:
+            start = chunk.find(b'"')
+            if start == -1:
+                continue
+            chunk = chunk[start + 1 :]
+            started = True
+        end = chunk.find(b'"')
+        if end != -1:
+            chunk = chunk[:end]
+        data = escape + chunk
+        escape = b""
+        if data.endswith(b"\\"):
+            # The escape sequence continues in the next chunk
+            escape = b"\\"
+            data = data[:-1]
+        data = data.replace(b"\\/", b"/").replace(b"\\n", b"").replace(b"\\r", b"")
+        data = remainder + data
+        usable = len(data) - len(data) % 4
+        remainder = data[usable:]
+        if usable:
+            yield base64.b64decode(data[:usable])
+        if end != -1:
+            break
+    if remainder:
+        yield base64.b64decode(remainder + b"=" * (-len(remainder) % 4))
@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from .files import atomic_write
+from .main import DOWNLOAD_FORMATS
+from .models import TypeFEL
+from .offline import json_default, invoice_to_dict
+
+"""
+Download jobs that survive crashes. The planned work is kept in a SQLite
+database inside the job directory, so a job can be stopped at any moment and
+continued later (or from other processes at the same time) without repeating
+what was already downloaded.
+"""
+
+DATABASE_NAME = "job.sqlite3"
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# How often run checks the tasks leased by other processes
+POLL_SECONDS = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    uuid TEXT NOT NULL,
+    format TEXT NOT NULL,
+    invoice TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    leased_until REAL,
+    result TEXT,
+    error TEXT,
+    PRIMARY KEY (uuid, format)
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, leased_until);
+"""
+
+
+class DownloadJob:
+    """
+    A job downloads every format of the invoices returned by a query into
+    directory. plan runs the query once and stores one task per invoice and
+    format, then the workers claim the tasks one by one.
+
+    A claimed task is leased for lease_seconds: if its worker dies the task
+    is claimed again after that. Failed tasks are retried up to max_attempts
+    times.
+    """
+
+    def __init__(self, directory, lease_seconds=300, max_attempts=3):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, DATABASE_NAME)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _get_setting(self, key, default=None):
+        row = (
+            self._connection()
+            .execute("SELECT value FROM job WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return json.loads(row[0]) if row else default
+
+    @property
+    def is_planned(self):
+        return self._get_setting("planned", False)
+
+    @property
+    def formats(self):
+        return self._get_setting("formats")
+
+    @property
+    def received(self):
+        return self._get_setting("received", True)
+
+    def plan(self, downloader, filters, formats=("xml", "pdf")):
+        """
+        Queries the invoices and stores the tasks. A job that was already
+        planned is not queried again. Returns the number of tasks.
+        """
+        for filetype in formats:
+            if filetype not in DOWNLOAD_FORMATS:
+                raise ValueError("Unknown format {}".format(filetype))
+        if not self.is_planned:
+            invoices = downloader.get_invoices_with_filters(filters)
+            settings = {
+                "formats": list(formats),
+                "received": filters.tipo == TypeFEL.RECIBIDA,
+                "planned": True,
+            }
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO tasks (uuid, format, invoice) "
+                    "VALUES (?, ?, ?)",
+                    (
+                        (invoice["numeroUuid"], filetype, json.dumps(invoice))
+                        for invoice in invoices
+                        for filetype in formats
+                    ),
+                )
+                connection.executemany(
+                    "INSERT OR REPLACE INTO job (key, value) VALUES (?, ?)",
+                    [(key, json.dumps(value)) for key, value in settings.items()],
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            logging.info("Planned job with %s invoices", len(invoices))
+        return sum(self.progress().values())
+
+    def claim(self):
+        """
+        Leases the next pending task. Returns (uuid, format, invoice) or None
+        when there is nothing left to claim.
+        """
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT uuid, format, invoice FROM tasks WHERE status = ? "
+                "OR (status = ? AND leased_until < ?) LIMIT 1",
+                (PENDING, RUNNING, now),
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE tasks SET status = ?, leased_until = ?, "
+                    "attempts = attempts + 1 WHERE uuid = ? AND format = ?",
+                    (RUNNING, now + self.lease_seconds, row[0], row[1]),
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def complete(self, uuid, filetype, result):
+        self._connection().execute(
+            "UPDATE tasks SET status = ?, result = ?, error = NULL, "
+            "leased_until = NULL WHERE uuid = ? AND format = ?",
+            (DONE, result, uuid, filetype),
+        )
+
+    def fail(self, uuid, filetype, error):
+        self._connection().execute(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+            "error = ?, leased_until = NULL WHERE uuid = ? AND format = ?",
+            (self.max_attempts, FAILED, PENDING, str(error), uuid, filetype),
+        )
+
+    def retry_failed(self):
+        self._connection().execute(
+            "UPDATE tasks SET status = ?, attempts = 0 WHERE status = ?",
+            (PENDING, FAILED),
+        )
+
+    def progress(self):
+        """
+        Returns the number of tasks in every status.
+        """
+        progress = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        rows = self._connection().execute(
+            "SELECT status, COUNT(*) FROM tasks GROUP BY status"
+        )
+        progress.update(rows)
+        return progress
+
+    def failures(self):
+        return (
+            self._connection()
+            .execute(
+                "SELECT uuid, format, error FROM tasks WHERE status = ?", (FAILED,)
+            )
+            .fetchall()
+        )
+
+    def execute_task(self, downloader, uuid, filetype, invoice):
+        """
+        Downloads one task and returns the file where it was saved.
+        """
+        received = self.received
+        if filetype == "model":
+            model = downloader._call(lambda d: d.get_invoice_model(invoice, received))
+            filename = os.path.join(self.directory, uuid + ".json")
+            content = json.dumps(invoice_to_dict(model), default=json_default)
+            atomic_write(filename, content.encode("utf-8"), fsync=True)
+            return filename
+        return downloader._call(
+            lambda d: d._stream_document(invoice, filetype, self.directory, received)
+        )
+
+    def start(self, downloader, workers=4):
+        """
+        Starts workers threads and returns the JobRunner, which can add or
+        remove workers while the job runs.
+        """
+        if not self.is_planned:
+            raise ValueError("The job in {} is not planned".format(self.directory))
+        runner = JobRunner(self, downloader)
+        runner.add_workers(workers)
+        return runner
+
+    def run(self, downloader, workers=4):
+        """
+        Runs the job until no task is left and returns its progress. Tasks
+        leased by other processes are waited for, and claimed again if their
+        lease expires.
+        """
+        while True:
+            self.start(downloader, workers).join()
+            progress = self.progress()
+            # Tasks that failed while other workers were leaving are pending again
+            if progress[PENDING]:
+                continue
+            if not progress[RUNNING]:
+                return progress
+            # The rest are leased by other processes, or by one that crashed:
+            # wait until they finish or their lease expires to claim them
+            expiry = self._next_lease_expiry()
+            if expiry is not None:
+                time.sleep(min(max(expiry - time.time(), 0), POLL_SECONDS))
+
+    def _next_lease_expiry(self):
+        row = (
+            self._connection()
+            .execute("SELECT MIN(leased_until) FROM tasks WHERE status = ?", (RUNNING,))
+            .fetchone()
+        )
+        return row[0]
+
+
+class JobRunner:
+    def __init__(self, job, downloader):
+        self.job = job
+        self.downloader = downloader
+        self._workers = []
+        self._lock = threading.Lock()
+
+    @property
+    def workers(self):
+        with self._lock:
+            return len(
+                [w for w in self._workers if w[0].is_alive() and not w[1].is_set()]
+            )
+
+    def add_workers(self, count=1):
+        self.downloader._get_downloader()
+        with self._lock:
+            for _ in range(count):
+                stop = threading.Event()
+                thread = threading.Thread(target=self._work, args=(stop,), daemon=True)
+                thread.start()
+                self._workers.append((thread, stop))
+
+    def remove_workers(self, count=1):
+        """
+        Asks count workers to stop after their current task.
+        """
+        with self._lock:
+            running = [
+                w for w in self._workers if w[0].is_alive() and not w[1].is_set()
+            ]
+            for _, stop in running[:count]:
+                stop.set()
+
+    def stop(self):
+        self.remove_workers(len(self._workers))
+
+    def join(self):
+        while True:
+            with self._lock:
+                threads = [thread for thread, _ in self._workers if thread.is_alive()]
+            if not threads:
+                return
+            for thread in threads:
+                thread.join()
+
+    def _work(self, stop):
+        while not stop.is_set():
+            task = self.job.claim()
+            if task is None:
+                return
+            uuid, filetype, invoice = task
+            try:
+                result = self.job.execute_task(self.downloader, uuid, filetype, invoice)
+            except Exception as e:
+                logging.warning("Could not download %s of %s: %s", filetype, uuid, e)
+                self.job.fail(uuid, filetype, e)
+            else:
+                self.job.complete(uuid, filetype, result)
@@ -1,41 +1,151 @@
 import re
 import os.path
 import base64
-import codecs
+import hashlib
+import time
 import logging
+import threading
 import requests
-from bs4 import BeautifulSoup, CData
+from bs4 import BeautifulSoup
 from urllib.parse import urlencode
-from datetime import datetime
 from .models import (
     EstadoDTE,
-    Invoice,
-    InvoiceLine,
-    InvoiceTotals,
     SATFELFilters,
-    TotalTax,
-    Address,
-    ContactModel,
-    InvoiceHeaders,
-    IssuingModel,
     TypeFEL,
+    DownloadResult,
+    InvoiceDocument,
+    get_invoice_status,
 )
-from .actions import SATDoLogin, SATDoLogout, SATGetMenu, SATGetStablisments
-from contextlib import contextmanager
+from .actions import (
+    LOGIN_URL,
+    SATDoLogin,
+    SATDoLogout,
+    SATGetMenu,
+    SATGetStablisments,
+    SessionExpiredError,
+    auth_header,
+)
+from .batch import split_batch_response
+from .files import atomic_open, atomic_write, iter_decode_base64_json
+from .parser import parse_invoice_header, parse_invoice_xml, parse_invoice_xml_lazy
+from .concurrency import SingleFlight, bounded_map, bounded_unordered_map, chunked
+from .contingency import ContingencyRouter
+from .resilience import DEFAULT_POOL_SIZE, default_session
+from . import metrics
+from .ranges import halve_filters, iter_unique, merge_invoices, split_filters
+from concurrent.futures import ThreadPoolExecutor
+
+TIMEOUT = 20
+STREAM_CHUNK_SIZE = 64 * 1024
+# Formats every downloader (jobs, multiple accounts, async) can download
+DOWNLOAD_FORMATS = ("xml", "pdf", "model")
+# SATDownloader.download_many also builds InvoiceDocuments
+DOCUMENT_FORMATS = DOWNLOAD_FORMATS + ("document",)
+FEL_API_URL = "https://felcons.c.sat.gob.gt/dte-agencia-virtual/api/"
+CONTINGENCY_URL = (
+    "https://felav02.c.sat.gob.gt/verificador-rest/rest/publico/descargapdf"
+)
+
+
+def invoices_headers_url(username, filter: SATFELFilters):
+    dict_query = {
+        "usuario": username,
+        "tipoOperacion": filter.tipo.value,
+        "nitIdReceptor": "",
+        "estadoDte": filter.estadoDte.value,
+        "fechaEmisionIni": filter.fechaInicio.strftime("%d-%m-%Y"),
+        "fechaEmisionFinal": filter.fechaFin.strftime("%d-%m-%Y"),
+    }
+    logging.debug(dict_query)
+    return FEL_API_URL + "consulta-dte?" + urlencode(dict_query)
+
+
+def document_url(username, filetype, received=True):
+    if filetype.lower() not in ("xml", "pdf"):
+        return None
+    operation_param = "R" if received else "E"
+    dict_query = {
+        "usuario": username,
+        "tipoOperacion": operation_param,
+        "nitIdReceptor": "",
+    }
+    return "{}consulta-dte/{}?{}".format(
+        FEL_API_URL, filetype.lower(), urlencode(dict_query)
+    )
+
+
+def contingency_payload(invoice):
+    return {
+        "autorizacion": invoice["numeroUuid"],
+        "emisor": invoice["nitEmisor"],
+        "estado": "V",
+        "monto": invoice["granTotal"],
+        "receptor": invoice["nitReceptor"],
+    }
+
+
+def invoice_document(content, filename=None):
+    """
+    Hashes, saves to filename (if given) and parses the XML of a DTE,
+    keeping the bytes, into an InvoiceDocument.
+    """
+    digest = hashlib.sha256(content).hexdigest()
+    if filename:
+        atomic_write(filename, content, fsync=True)
+    with metrics.span("parse"):
+        invoice = parse_invoice_xml(content)
+    return InvoiceDocument(invoice, content, digest, filename)
+
+
+def decode_contingency_pdf(base64encoded):
+    bytes = base64.b64decode(base64encoded)
+    if bytes[0:4] != b"%PDF":
+        raise ValueError("Missing the PDF file signature")
+    return bytes
+
+
+def iter_check_pdf_signature(chunks):
+    """
+    Yields the chunks of a streamed PDF, raising ValueError if it doesn't
+    start with the PDF file signature. The first chunks can be shorter than
+    the signature, they are joined until it can be checked.
+    """
+    chunks = iter(chunks)
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= 4:
+            break
+    if head[0:4] != b"%PDF":
+        raise ValueError("Missing the PDF file signature")
+    yield head
+    yield from chunks
+
 
 """
 Private class that makes all the action
 """
 
-TIMEOUT = 20
-
 
 class SatFelDownloader:
-    def __init__(self, credentials, url_get_fel, request_session=requests.Session()):
+    def __init__(
+        self,
+        credentials,
+        url_get_fel,
+        request_session=None,
+        cache=None,
+        contingency=None,
+        single_flight=None,
+    ):
+        if request_session is None:
+            request_session = default_session()
         self._credentials = credentials
         self._session = request_session
         self._view_state = None
         self._url_get_fel = url_get_fel
+        self._cache = cache
+        self._contingency = contingency
+        self._single_flight = single_flight
 
     def _login(self):
         login_dict = {
@@ -56,266 +166,353 @@ class SatFelDownloader:
             return True
         return False
 
-    def _get_invoices_headers(self, filter: SATFELFilters):
+    def _open_fel(self, force=False):
+        # Opening the FEL page sets the ACCESS_TOKEN cookie, once is enough
+        if not force and self._session.cookies.get("ACCESS_TOKEN"):
+            return
         logging.info("CALL URL GET FEL")
-        self._session.get(self._url_get_fel, timeout=TIMEOUT)
-        operation_param = filter.tipo
-        cookie = self._session.cookies.get("ACCESS_TOKEN")
-        dict_query = {
-            "usuario": self._credentials.username,
-            "tipoOperacion": operation_param.value,
-            "nitIdReceptor": "",
-            "estadoDte": filter.estadoDte.value,
-            "fechaEmisionIni": filter.fechaInicio.strftime("%d-%m-%Y"),
-            "fechaEmisionFinal": filter.fechaFin.strftime("%d-%m-%Y"),
-        }
+        with metrics.span("fel_page"):
+            self._session.get(self._url_get_fel, timeout=TIMEOUT)
+
+    def _check_session(self, r):
+        if r.status_code == 401 or (r.history and r.url.startswith(LOGIN_URL)):
+            r.close()
+            raise SessionExpiredError("The SAT session expired")
+
+    def _query_invoices_headers(self, filter: SATFELFilters):
         logging.info("Querying invoices")
-        logging.debug(dict_query)
-        url = (
-            "https://felcons.c.sat.gob.gt/dte-agencia-virtual/api/consulta-dte?"
-            + urlencode(dict_query)
-        )
-        header = {"authtoken": "token " + cookie}
-        r = self._session.get(url, headers=header, timeout=TIMEOUT)
-        r.raise_for_status()
-        json_response = r.json()["detalle"]["data"]
+        url = invoices_headers_url(self._credentials.username, filter)
+        with metrics.span("headers_query"):
+            r = self._session.get(
+                url, headers=auth_header(self._session), timeout=TIMEOUT
+            )
+            self._check_session(r)
+            r.raise_for_status()
+            json_response = r.json()["detalle"]["data"]
+        metrics.increment("invoices_listed", len(json_response))
         return json_response
 
-    def _process_contingency_pdf(self, invoice, filetype, received):
-        url = "https://felav02.c.sat.gob.gt/verificador-rest/rest/publico/descargapdf"
-        invoice = {
-            "autorizacion": invoice["numeroUuid"],
-            "emisor": invoice["nitEmisor"],
-            "estado": "V",
-            "monto": invoice["granTotal"],
-            "receptor": invoice["nitReceptor"],
-        }
+    def _get_invoices_headers(self, filter: SATFELFilters):
+        self._open_fel()
+        try:
+            return self._query_invoices_headers(filter)
+        except SessionExpiredError:
+            # The FEL token can expire while the agency session is still valid
+            self._open_fel(force=True)
+            return self._query_invoices_headers(filter)
 
-        r = self._session.post(url, json=invoice, timeout=TIMEOUT)
-        if r.status_code == 200:
-            base64encoded = r.json()[0]
-            bytes = base64.b64decode(base64encoded)
-            if bytes[0:4] != b"%PDF":
-                raise ValueError("Missing the PDF file signature")
-            r.bytes = bytes
-        return r, True
-
-    def _get_response(self, invoice, filetype, received=True):
-        url = None
-        is_contingency = False
-        print(invoice)
-        if filetype.lower() == "xml":
-            url = (
-                "https://felcons.c.sat.gob.gt/dte-agencia-virtual/api/consulta-dte/xml?"
-            )
+    def _query_window(self, filter, max_results=None):
+        try:
+            invoices = self._query_invoices_headers(filter)
+        except requests.Timeout:
+            halves = halve_filters(filter)
+            if halves is None:
+                raise
+            logging.info("Query timed out, splitting %s", filter)
+            return merge_invoices(self._query_window(f, max_results) for f in halves)
+        if max_results is not None and len(invoices) >= max_results:
+            halves = halve_filters(filter)
+            if halves is not None:
+                logging.info("Query looks truncated, splitting %s", filter)
+                return merge_invoices(
+                    self._query_window(f, max_results) for f in halves
+                )
+        return invoices
+
+    def get_window(self, filter: SATFELFilters, max_results=None):
+        self._open_fel()
+        return self._query_window(filter, max_results)
+
+    def get_invoices_headers_by_windows(
+        self, filter: SATFELFilters, window_days=7, workers=4, max_results=None
+    ):
+        """
+        Queries the range of filter in windows of window_days days using
+        `workers` threads and merges the results by numeroUuid.
 
-        elif filetype.lower() == "pdf":
-            url = (
-                "https://felcons.c.sat.gob.gt/dte-agencia-virtual/api/consulta-dte/pdf?"
+        A window that times out, or returns max_results invoices or more (which
+        looks like the server truncated it), is split in halves and queried again.
+        """
+        self._open_fel()
+        windows = list(split_filters(filter, window_days))
+        if len(windows) == 1 or workers <= 1:
+            results = [self._query_window(w, max_results) for w in windows]
+            return merge_invoices(results)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                lambda window: self._query_window(window, max_results), windows
             )
+            return merge_invoices(results)
+
+    def _process_contingency_pdf(self, invoice, filetype, received, stream=False):
+        metrics.increment("contingency_hits")
+
+        def fetch():
+            with metrics.span("contingency"):
+                r = self._session.post(
+                    CONTINGENCY_URL,
+                    json=contingency_payload(invoice),
+                    timeout=TIMEOUT,
+                    stream=stream,
+                )
+            if r.status_code != 200:
+                r.close()
+                raise requests.HTTPError(
+                    "The contingency verifier answered {}".format(r.status_code),
+                    response=r,
+                )
+            if not stream:
+                r.bytes = decode_contingency_pdf(r.json()[0])
+            return r
 
+        if self._contingency is None:
+            return fetch(), True
+        # A streamed response can only be read once, it can't be shared
+        uuid = None if stream else invoice["numeroUuid"]
+        return self._contingency.fetch(uuid, fetch), True
+
+    def _get_url(self, filetype, received=True):
+        return document_url(self._credentials.username, filetype, received)
+
+    def _get_response(self, invoice, filetype, received=True, stream=False):
+        is_contingency = False
+        logging.debug("Getting %s of %s", filetype, invoice.get("numeroUuid"))
+        url = self._get_url(filetype, received)
         if url is None:
             return None
-        operation_param = "R" if received else "E"
-
-        dict_query = {
-            "usuario": self._credentials.username,
-            "tipoOperacion": operation_param,
-            "nitIdReceptor": "",
-        }
-        url += urlencode(dict_query)
-        cookie = self._session.cookies.get("ACCESS_TOKEN")
-        header = {"authtoken": "token " + cookie}
-        r = self._session.post(url, headers=header, json=[invoice], timeout=TIMEOUT)
-        if r.status_code == 500:
-            logging.warn("Did get 500 error trying pdf contingency")
-            return self._process_contingency_pdf(invoice, "pdf-contingency", received)
-        print(r)
+        router = self._contingency if filetype == "pdf" else None
+        if router is not None and not router.use_primary():
+            metrics.increment("contingency_routed")
+            return self._process_contingency_pdf(
+                invoice, "pdf-contingency", received, stream=stream
+            )
+        self._open_fel()
+        header = auth_header(self._session)
+        with metrics.span("document", format=filetype):
+            r = self._session.post(
+                url, headers=header, json=[invoice], timeout=TIMEOUT, stream=stream
+            )
+        self._check_session(r)
+        # Only PDFs can come from the contingency verifier
+        unavailable = r.status_code == 500 or (
+            router is not None and r.status_code > 500
+        )
+        if filetype == "pdf" and unavailable:
+            logging.warning("Did get %s error trying pdf contingency", r.status_code)
+            r.close()
+            if router is not None:
+                router.primary_failed()
+            return self._process_contingency_pdf(
+                invoice, "pdf-contingency", received, stream=stream
+            )
+        if router is not None and r.status_code == 200:
+            router.primary_succeeded()
+        logging.debug(r)
         return r, is_contingency
 
-    def get_pdf_content(self, invoice, received=True):
+    def _get_batch_contents(self, invoices, filetype, received=True):
+        """
+        Requests several invoices in a single call. Returns a dict of
+        numeroUuid -> content with the documents that could be matched
+        from the response (a zip file or a single document).
+        """
+        url = self._get_url(filetype, received)
+        self._open_fel()
+        header = auth_header(self._session)
+        r = self._session.post(url, headers=header, json=invoices, timeout=TIMEOUT)
+        self._check_session(r)
+        r.raise_for_status()
+        return split_batch_response(r.content, [i["numeroUuid"] for i in invoices])
+
+    def get_contents(
+        self, invoices, filetype, received=True, batch_size=20, errors=None
+    ):
+        """
+        Gets the xml or pdf content of many invoices packing up to batch_size
+        invoices per request. Returns a dict of numeroUuid -> content.
+        Invoices missing from a batch response, or whose batch request
+        failed, are requested one by one.
+
+        With a dict in errors, the invoices that fail one by one are added to
+        it as numeroUuid -> exception instead of raising.
+        """
+        contents = {}
+        if self._cache is not None:
+            for invoice in invoices:
+                content = self._get_cached(invoice, filetype)
+                if content is not None:
+                    contents[invoice["numeroUuid"]] = content
+            invoices = [i for i in invoices if i["numeroUuid"] not in contents]
+        for start in range(0, len(invoices), batch_size):
+            batch = invoices[start : start + batch_size]
+            if len(batch) > 1:
+                try:
+                    batch_contents = self._get_batch_contents(batch, filetype, received)
+                    for invoice in batch:
+                        uuid = invoice["numeroUuid"]
+                        if uuid in batch_contents:
+                            self._put_cached(invoice, filetype, batch_contents[uuid])
+                    contents.update(batch_contents)
+                except SessionExpiredError:
+                    raise
+                except (requests.RequestException, ValueError) as e:
+                    logging.warning(
+                        "Batch request failed, requesting one by one: %s", e
+                    )
+            for invoice in batch:
+                if invoice["numeroUuid"] in contents:
+                    continue
+                try:
+                    if filetype == "pdf":
+                        content = self.get_pdf_content(invoice, received)
+                    else:
+                        content = self.get_xml_content(invoice, received)
+                except SessionExpiredError:
+                    raise
+                except Exception as e:
+                    if errors is None:
+                        raise
+                    errors[invoice["numeroUuid"]] = e
+                    continue
+                contents[invoice["numeroUuid"]] = content
+        return contents
+
+    def _get_cached(self, invoice, filetype):
+        if self._cache is None:
+            return None
+        if get_invoice_status(invoice) == EstadoDTE.ANULADAS:
+            # The document may have been cached before it was voided
+            self._cache.invalidate(invoice["numeroUuid"])
+            return None
+        content = self._cache.get(invoice["numeroUuid"], filetype)
+        metrics.increment("cache_hits" if content is not None else "cache_misses")
+        return content
+
+    def _put_cached(self, invoice, filetype, content):
+        if self._cache is None:
+            return
+        if get_invoice_status(invoice) == EstadoDTE.ANULADAS:
+            return
+        self._cache.put(invoice["numeroUuid"], filetype, content)
+
+    def _get_document(self, invoice, filetype, received=True):
+        """
+        Returns the content of the document and the filename sent by SAT, if any.
+        The cache is consulted before making the request.
+        """
+        content = self._get_cached(invoice, filetype)
+        if content is not None:
+            return content, None
+        if self._single_flight is None:
+            return self._download_document(invoice, filetype, received)
+        # Concurrent requests for the same document wait for the first one
+        key = (invoice["numeroUuid"].upper(), filetype, received)
+        return self._single_flight.do(
+            key, lambda: self._download_document(invoice, filetype, received)
+        )
+
+    def _download_document(self, invoice, filetype, received=True):
         r, is_contingency = self._get_response(
-            invoice, filetype="pdf", received=received
+            invoice, filetype=filetype, received=received
         )
-        
+        r.raise_for_status()
         if is_contingency:
-            return r.bytes
-        return r.content
+            content = r.bytes
+        else:
+            content = r.content
+        metrics.increment("bytes_downloaded", len(content), format=filetype)
+        self._put_cached(invoice, filetype, content)
+        filename = self.get_filename_from_cd(r.headers.get("Content-Disposition"))
+        return content, filename
 
-    def get_pdf(self, invoice, save_in_dir=None, received=True):
+    def _stream_document(self, invoice, filetype, save_in_dir=None, received=True):
+        """
+        Writes the document to disk chunk by chunk, through a temporary file
+        that is renamed when complete, so memory stays flat for big files and
+        a crash doesn't leave half written files. Returns the filename.
+        """
+        default_filename = "{}.{}".format(invoice["numeroUuid"], filetype)
+        content = self._get_cached(invoice, filetype)
+        if content is not None:
+            filename = os.path.join(save_in_dir or "", default_filename)
+            atomic_write(filename, content, fsync=True)
+            return filename
         r, is_contingency = self._get_response(
-            invoice, filetype="pdf", received=received
+            invoice, filetype=filetype, received=received, stream=True
         )
-        filename = self.get_filename_from_cd(r.headers.get("Content-Disposition"))
+        with r:
+            r.raise_for_status()
+            filename = self.get_filename_from_cd(r.headers.get("Content-Disposition"))
+            filename = os.path.join(save_in_dir or "", filename or default_filename)
+            chunks = r.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+            if is_contingency:
+                chunks = iter_check_pdf_signature(iter_decode_base64_json(chunks))
+            size = 0
+            with atomic_open(filename, fsync=True) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+        metrics.increment("bytes_downloaded", size, format=filetype)
+        if self._cache is not None:
+            if get_invoice_status(invoice) != EstadoDTE.ANULADAS:
+                self._cache.put_file(invoice["numeroUuid"], filetype, filename)
+        return filename
+
+    def get_pdf_content(self, invoice, received=True):
+        return self._get_document(invoice, "pdf", received)[0]
+
+    def get_pdf(self, invoice, save_in_dir=None, received=True, stream=False):
+        if stream:
+            return self._stream_document(invoice, "pdf", save_in_dir, received)
+        content, filename = self._get_document(invoice, "pdf", received)
         if not filename:
             filename = invoice["numeroUuid"] + ".pdf"
         if save_in_dir:
             filename = os.path.join(save_in_dir, filename)
-        if is_contingency:
-            open(filename, "wb+").write(r.bytes)
-        else:
-            open(filename, "wb+").write(r.content)
+        with open(filename, "wb+") as f:
+            f.write(content)
         return filename
 
-    def _process_invoice_lines(self, xml_lines):
-        lines = xml_lines
-        model_lines = []
-        for item in lines:
-            quantity = item.Cantidad.text
-            good_or_service = item["BienOServicio"]
-            line_number = item["NumeroLinea"]
-            if "UnidadMedida" in item:
-                uom = item.UnidadMedida.text
-            description = item.Descripcion.text.strip()
-            unit_price = item.PrecioUnitario.text
-            total_before_discount = item.Precio.text
-            discount = item.Descuento.text
-            total = item.Total.text
-            line = (
-                InvoiceLine.builder()
-                .set_quantity(float(quantity))
-                .set_good_or_service(good_or_service)
-                .set_line_number(int(line_number))
-                .set_description(description)
-                .set_unit_price(float(unit_price))
-                .set_total_line(float(total_before_discount))
-                .set_discount(float(discount))
-                .set_total(float(total))
-                .build()
-            )
-            model_lines.append(line)
-        return model_lines
-
-    def get_invoice_model(self, invoice, received=True):
+    def get_invoice_model(self, invoice, received=True, lazy=False):
         xml_content = self.get_xml_content(invoice, received)
-        bs = BeautifulSoup(xml_content, "xml")
-        emission_data = bs.find("DatosEmision")
-        general_data = emission_data.select("DatosGenerales")[0]
-        issuer = emission_data.select("Emisor")[0]
-        receptor = emission_data.select("Receptor")[0]
-        lines = emission_data.select("Item")
-        currency = general_data["CodigoMoneda"]
-        
-        try:
-             
-            issue_date = datetime.strptime(
-                general_data["FechaHoraEmision"], "%Y-%m-%dT%H:%M:%S%z"
-            )
-        except ValueError:
-            try:
-                issue_date = datetime.strptime(
-                general_data["FechaHoraEmision"], "%Y-%m-%dT%H:%M:%S.%f%z"
-                )
-            except:
-                try:
-                    issue_date = datetime.strptime(
-                    general_data["FechaHoraEmision"], "%Y-%m-%dT%H:%M:%S.%f"
-                    )
-                except:
-                    issue_date = datetime.strptime(
-                    general_data["FechaHoraEmision"], "%Y-%m-%dT%H:%M:%S"
-                    )
-            
-        invoice_type = general_data["Tipo"]
-        vat_affiliation = issuer["AfiliacionIVA"]
-        stablisment_number = issuer["CodigoEstablecimiento"]
-        
-        issuer_email = issuer["CorreoEmisor"] if "CorreoEmisor" in issuer else None
-        issuernit = issuer["NITEmisor"]
-        commercial_name = issuer["NombreComercial"]
-        issuer_name = issuer["NombreEmisor"]
-        receptor_email = receptor.find("CorreoReceptor")
-        emissor_address = issuer.find("Direccion").Text
-        zip_code = issuer.find("CodigoPostal").text
-        city = issuer.find("Municipio").text
-        state = issuer.find("Departamento").text
-        country = issuer.find("Pais").text
-        nit_receptor = receptor["IDReceptor"]
-        nombre_receptor = receptor["NombreReceptor"]
-        model_lines = self._process_invoice_lines(lines)
-        total = emission_data.Totales
-        total_taxes = total.select("TotalImpuesto")
-        grand_total = total.find("GranTotal").text
-
-        total_taxes_model = []
-        for tax in total_taxes:
-            tax_model = (
-                TotalTax.builder()
-                .set_tax_name(tax["NombreCorto"])
-                .set_tax_total(tax["TotalMontoImpuesto"])
-                .build()
+        return self.parse_invoice_model(xml_content, lazy)
+
+    def get_invoice_document(self, invoice, save_in_dir=None, received=True):
+        """
+        Downloads the XML once and returns it parsed together with its bytes
+        and sha256, saving it in save_in_dir if given.
+        """
+        content, filename = self._get_document(invoice, "xml", received)
+        if save_in_dir:
+            filename = os.path.join(
+                save_in_dir, filename or invoice["numeroUuid"] + ".xml"
             )
-            total_taxes_model.append(tax_model)
-        address_model = (
-            Address.builder()
-            .set_street(emissor_address)
-            .set_zip_code(zip_code)
-            .set_city(city)
-            .set_state(state)
-            .set_country(country)
-            .build()
-        )
-        issuer_model = (
-            IssuingModel.builder()
-            .set_nit(issuernit)
-            .set_commercial_name(commercial_name)
-            .set_issuing_name(issuer_name)
-            .set_address(address_model)
-            .set_vat_affiliation(vat_affiliation)
-            .set_establishment(stablisment_number)
-            .set_email(issuer_email)
-            .build()
-        )
-        receiver = (
-            ContactModel.builder()
-            .set_nit(nit_receptor)
-            .set_commercial_name(nombre_receptor)
-            .set_address("CIUDAD")
-            .set_email(receptor_email)
-            .build()
-        )
-        invoice_header = (
-            InvoiceHeaders.builder()
-            .set_issue_date(issue_date)
-            .set_invoice_type(invoice_type)
-            .set_currency(currency)
-            .set_issuer(issuer_model)
-            .set_receiver(receiver)
-            .build()
-        )
-        invoice_total = InvoiceTotals(total_taxes_model, grand_total=float(grand_total))
-        fel_data = bs.find("Certificacion").find("NumeroAutorizacion")
-        fel_invoice_number = fel_data["Numero"]
-        fel_invoice_serie = fel_data["Serie"]
-        fel_signature = fel_data.text
-        invoice = (
-            Invoice.builder()
-            .with_headers(invoice_header)
-            .with_lines(model_lines)
-            .with_totals(invoice_total)
-            .set_fel_signature(fel_signature)
-            .set_fel_invoice_number(fel_invoice_number)
-            .set_fel_invoice_serie(fel_invoice_serie)
-            .build()
-        )
-        return invoice
+        else:
+            filename = None
+        return invoice_document(content, filename)
+
+    def parse_invoice_model(self, xml_content, lazy=False):
+        if lazy:
+            return parse_invoice_xml_lazy(xml_content)
+        with metrics.span("parse"):
+            return parse_invoice_xml(xml_content)
 
     def get_xml_content(self, invoice, received=True):
-        return self._get_response(
-            invoice=invoice, filetype="xml", received=received
-        )[0].content
+        return self._get_document(invoice, "xml", received)[0]
 
-    def get_xml(self, invoice, save_in_dir=None, received=True):
-        r, _ = self._get_response(invoice=invoice, filetype="xml", received=received)
-        filename = self.get_filename_from_cd(r.headers.get("Content-Disposition"))
+    def get_xml(self, invoice, save_in_dir=None, received=True, stream=False):
+        if stream and save_in_dir:
+            return self._stream_document(invoice, "xml", save_in_dir, received)
+        content, filename = self._get_document(invoice, "xml", received)
         if not filename:
             filename = invoice["numeroUuid"] + ".xml"
         if save_in_dir:
             filename = os.path.join(save_in_dir, filename)
-            open(filename, "wb").write(r.content)
+            with open(filename, "wb") as f:
+                f.write(content)
             return filename
         else:
-            return r.content
+            return content
 
     def get_filename_from_cd(self, cd):
         """
@@ -336,12 +533,35 @@ Main entrance of the SAT Downloader.
 
 
 class SATDownloader:
-    def __init__(self, request_session=requests.Session()):
+    def __init__(
+        self,
+        request_session=None,
+        cache=None,
+        token_ttl=None,
+        contingency=None,
+        pool_size=DEFAULT_POOL_SIZE,
+    ):
+        if request_session is None:
+            # Keeps pool_size connections, enough for that many workers
+            request_session = default_session(pool_size)
         self.credentials = None
         self.session = request_session
+        self.cache = cache
+        # Routes the PDF requests to the contingency verifier while
+        # consulta-dte/pdf is failing, see ContingencyRouter
+        self.contingency = contingency or ContingencyRouter()
+        # Shared by every SatFelDownloader of this session, so concurrent
+        # requests for the same document are made once
+        self._single_flight = SingleFlight()
         self.url_get_fel = None
         self.its_initialized = False
         self.view_state = None
+        # Seconds after which the session is considered expired and a new
+        # login is made before the next request. None waits for SAT to reject it.
+        self.token_ttl = token_ttl
+        self.authenticated_at = None
+        self._downloader = None
+        self._auth_lock = threading.RLock()
 
     "Need to set credentials before use any of the methods"
 
@@ -366,6 +586,15 @@ class SATDownloader:
             raise ValueError("Could not get the menu")
         self.its_initialized = True
         self.view_state = view_state
+        self.authenticated_at = time.monotonic()
+        self._downloader = SatFelDownloader(
+            self.credentials,
+            url_get_fel=self.url_get_fel,
+            request_session=self.session,
+            cache=self.cache,
+            contingency=self.contingency,
+            single_flight=self._single_flight,
+        )
         logging.info("Initialization process finished")
 
     """
@@ -374,9 +603,18 @@ class SATDownloader:
 
     def logout(self):
         SATDoLogout(self.session, self.view_state).execute()
+        # Its threads are started again by the next contingency request
+        self.contingency.close()
         self.its_initialized = False
         self.view_state = None
         self.url_get_fel = None
+        self.authenticated_at = None
+        self._downloader = None
+
+    def is_expired(self):
+        if self.token_ttl is None or self.authenticated_at is None:
+            return False
+        return time.monotonic() - self.authenticated_at > self.token_ttl
 
     def get_stablisments(self):
 
@@ -385,14 +623,66 @@ class SATDownloader:
         stablisments = SATGetStablisments(self.session).execute()
         return stablisments
 
-    def get_invoices_with_filters(self, filters: SATFELFilters):
+    def _get_downloader(self):
+        if not self.its_initialized or self.is_expired():
+            with self._auth_lock:
+                if not self.its_initialized or self.is_expired():
+                    self._login_again()
+        return self._downloader
+
+    def _login_again(self):
+        if self.its_initialized:
+            logging.info("Session expired, login again")
+            metrics.increment("relogins")
+            self.session.cookies.clear()
+            self.its_initialized = False
+        self.initialize()
+
+    def _reauthenticate(self, expired_downloader):
+        with self._auth_lock:
+            # Another thread may have logged in again already
+            if expired_downloader is self._downloader:
+                self._login_again()
+            return self._downloader
+
+    def _call(self, function):
+        """
+        Calls function with the downloader and, if SAT answers that the
+        session expired, logs in again and retries it once.
+        """
+        downloader = self._get_downloader()
+        try:
+            return function(downloader)
+        except SessionExpiredError:
+            return function(self._reauthenticate(downloader))
+
+    def get_invoices_with_filters(
+        self, filters: SATFELFilters, window_days=None, workers=4, max_results=None
+    ):
+        """
+        With window_days the date range is queried in windows of that many days
+        at the same time, see SatFelDownloader.get_invoices_headers_by_windows.
+        """
         logging.info("GET INVOICES WITH FILTERS")
-        if not self.its_initialized:
-            self.initialize()
-        downloader = SatFelDownloader(
-            self.credentials, url_get_fel=self.url_get_fel, request_session=self.session
+        if window_days is None:
+            return self._call(lambda d: d._get_invoices_headers(filters))
+        return self._call(
+            lambda d: d.get_invoices_headers_by_windows(
+                filters,
+                window_days=window_days,
+                workers=workers,
+                max_results=max_results,
+            )
         )
-        return downloader._get_invoices_headers(filters)
+
+    def get_invoice_summaries(self, filters: SATFELFilters, **kwargs):
+        """
+        Returns an InvoiceHeaderSummary of every invoice of filters, built
+        from the listing without downloading any XML. Takes the same
+        arguments as get_invoices_with_filters.
+        """
+        invoices = self.get_invoices_with_filters(filters, **kwargs)
+        return [parse_invoice_header(invoice) for invoice in invoices]
 
     def get_invoices(self, date_start, date_end, received=True):
         logging.info("GET INVOICES WITH OLD FORMAT")
@@ -401,52 +691,265 @@ class SATDownloader:
         filter = SATFELFilters(0, EstadoDTE.TODOS, date_start, date_end, type_fel)
         return self.get_invoices_with_filters(filter)
 
-    def get_invoices_models(self, date_start, date_end, received=True):
-        if not self.its_initialized:
-            self.initialize()
-        downloader = SatFelDownloader(
-            self.credentials, url_get_fel=self.url_get_fel, request_session=self.session
-        )
+    def get_invoices_models(self, date_start, date_end, received=True, workers=1):
         invoices = self.get_invoices(date_start, date_end, received)
-        invoices_model = list(map(downloader.get_invoice_model, invoices))
-        return invoices_model
+        if workers <= 1:
+            return list(map(self.get_model, invoices))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.get_model, invoices))
+
+    def iter_invoices(
+        self, filters: SATFELFilters, window_days=7, prefetch=2, max_results=None
+    ):
+        """
+        Yields the invoice headers of filters window by window, in order, with
+        up to `prefetch` windows being queried ahead of the one being read.
+        """
+        windows = split_filters(filters, window_days)
 
-    def get_model(self, invoice):
-        if not self.its_initialized:
-            self.initialize()
-        downloader = SatFelDownloader(
-            self.credentials, url_get_fel=self.url_get_fel, request_session=self.session
+        def query(window):
+            return self._call(lambda d: d.get_window(window, max_results))
+
+        if prefetch <= 0:
+            yield from iter_unique(map(query, windows))
+            return
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            yield from iter_unique(bounded_map(executor, query, windows, prefetch))
+
+    def iter_invoice_summaries(self, filters: SATFELFilters, window_days=7, prefetch=2):
+        """
+        Same as iter_invoices, yielding an InvoiceHeaderSummary of each one.
+        """
+        for invoice in self.iter_invoices(filters, window_days, prefetch):
+            yield parse_invoice_header(invoice)
+
+    def iter_downloads(
+        self, filters: SATFELFilters, formats=("xml", "pdf"), workers=4, **kwargs
+    ):
+        """
+        Downloads the invoices of filters while their headers are still being
+        queried and yields a DownloadResult as each one finishes. Only a few
+        windows and downloads per worker are in memory at once. The keyword
+        arguments are passed to download_many.
+        """
+        headers = self.iter_invoices(filters, prefetch=max(1, workers // 4))
+        received = filters.tipo == TypeFEL.RECIBIDA
+        return self.download_many(
+            headers, formats=formats, workers=workers, received=received, **kwargs
         )
-        return downloader.get_invoice_model(invoice)
 
-    def get_pdf_content(self, invoice, save_in_dir=None):
-        if not self.its_initialized:
-            self.initialize()
-        downloader = SatFelDownloader(
-            self.credentials, url_get_fel=self.url_get_fel, request_session=self.session
+    def iter_invoice_models(self, filters: SATFELFilters, workers=4):
+        """
+        Yields the Invoice of every invoice of filters as soon as its XML is
+        parsed, in no particular order. Raises the first download error.
+        """
+        for result in self.iter_downloads(filters, formats=("model",), workers=workers):
+            if not result.ok:
+                raise result.error
+            yield result.content
+
+    def download_many(
+        self,
+        invoices,
+        formats=("xml", "pdf"),
+        workers=4,
+        save_in_dir=None,
+        received=True,
+        batch_size=None,
+    ):
+        """
+        Downloads every format of every invoice using a pool of `workers`
+        threads that share this session (and its ACCESS_TOKEN cookie).
+
+        Yields a DownloadResult as soon as each download finishes. A failed
+        download is reported in DownloadResult.error and doesn't stop the rest.
+        Supported formats are "xml", "pdf", "model" and "document" (see
+        get_invoice_document).
+
+        With batch_size each request asks for up to batch_size invoices at once,
+        falling back to one request per invoice when a batch can't be split.
+        """
+        for filetype in formats:
+            if filetype not in DOCUMENT_FORMATS:
+                raise ValueError("Unknown format {}".format(filetype))
+        self._get_downloader()
+
+        def download(invoice, filetype):
+            return self.download_one(invoice, filetype, save_in_dir, received)
+
+        def download_batch(task):
+            batch, filetype = task
+            if len(batch) == 1:
+                return [download(batch[0], filetype)]
+            errors = {}
+
+            def fetch(downloader):
+                # Retried after a new login, only keep the errors of the last try
+                errors.clear()
+                return downloader.get_contents(
+                    batch,
+                    "xml" if filetype in ("model", "document") else filetype,
+                    received,
+                    batch_size=len(batch),
+                    errors=errors,
+                )
+
+            try:
+                contents = self._call(fetch)
+            except Exception:
+                return [download(invoice, filetype) for invoice in batch]
+            results = []
+            for invoice in batch:
+                error = errors.get(invoice["numeroUuid"])
+                if error is not None:
+                    metrics.increment("download_errors", format=filetype)
+                    logging.warning(
+                        "Could not download %s of %s: %s",
+                        filetype,
+                        invoice["numeroUuid"],
+                        error,
+                    )
+                    results.append(DownloadResult(invoice, filetype, error=error))
+                    continue
+                content = contents[invoice["numeroUuid"]]
+                try:
+                    if filetype == "model":
+                        content = parse_invoice_xml(content)
+                    elif filetype == "document":
+                        filename = None
+                        if save_in_dir:
+                            filename = os.path.join(
+                                save_in_dir, invoice["numeroUuid"] + ".xml"
+                            )
+                        content = invoice_document(content, filename)
+                    elif save_in_dir:
+                        filename = os.path.join(
+                            save_in_dir, invoice["numeroUuid"] + "." + filetype
+                        )
+                        atomic_write(filename, content, fsync=True)
+                        content = filename
+                except Exception as e:
+                    results.append(DownloadResult(invoice, filetype, error=e))
+                    continue
+                results.append(DownloadResult(invoice, filetype, content=content))
+            return results
+
+        tasks = (
+            (batch, filetype)
+            for batch in chunked(invoices, batch_size or 1)
+            for filetype in formats
         )
-        return downloader.get_pdf_content(invoice, save_in_dir)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for results in bounded_unordered_map(
+                executor, download_batch, tasks, workers * 2
+            ):
+                yield from results
 
-    def get_pdf(self, invoice, save_in_dir=None):
-        if not self.its_initialized:
-            self.initialize()
-        downloader = SatFelDownloader(
-            self.credentials, url_get_fel=self.url_get_fel, request_session=self.session
+    def download_one(self, invoice, filetype, save_in_dir=None, received=True):
+        """
+        Downloads one format of an invoice and returns a DownloadResult,
+        with the error instead of raising it.
+        """
+
+        def fetch(downloader):
+            if filetype == "model":
+                return downloader.get_invoice_model(invoice, received)
+            elif filetype == "document":
+                return downloader.get_invoice_document(invoice, save_in_dir, received)
+            elif save_in_dir and filetype == "pdf":
+                return downloader.get_pdf(invoice, save_in_dir, received, stream=True)
+            elif save_in_dir:
+                return downloader.get_xml(invoice, save_in_dir, received, stream=True)
+            elif filetype == "pdf":
+                return downloader.get_pdf_content(invoice, received)
+            else:
+                return downloader.get_xml_content(invoice, received)
+
+        try:
+            content = self._call(fetch)
+        except Exception as e:
+            metrics.increment("download_errors", format=filetype)
+            logging.warning(
+                "Could not download %s of %s: %s",
+                filetype,
+                invoice.get("numeroUuid"),
+                e,
+            )
+            return DownloadResult(invoice, filetype, error=e)
+        return DownloadResult(invoice, filetype, content=content)
+
+    def sync(
+        self,
+        target_dir,
+        since=None,
+        until=None,
+        formats=("xml", "pdf"),
+        received=True,
+        workers=4,
+    ):
+        """
+        Downloads into target_dir the invoices that are new or changed status
+        since the last sync. See InvoiceSync.
+        """
+        from .sync import InvoiceSync
+
+        invoice_sync = InvoiceSync(
+            self, target_dir, formats=formats, received=received, workers=workers
         )
-        return downloader.get_pdf(invoice, save_in_dir)
+        return invoice_sync.run(since=since, until=until)
 
-    def get_xml_content(self, invoice):
-        if not self.its_initialized:
-            self.initialize()
-        downloader = SatFelDownloader(
-            self.credentials, url_get_fel=self.url_get_fel, request_session=self.session
+    def run_job(self, directory, filters, formats=("xml", "pdf"), workers=4):
+        """
+        Downloads the invoices of filters into directory keeping the progress
+        in a SQLite database there. Calling it again with the same directory
+        continues where the last run stopped. See DownloadJob.
+        """
+        from .jobs import DownloadJob
+
+        job = DownloadJob(directory)
+        job.plan(self, filters, formats=formats)
+        return job.run(self, workers=workers)
+
+    def export_archive(
+        self, filters, path, formats=("xml", "pdf"), index="csv", workers=4
+    ):
+        """
+        Downloads the invoices of filters straight into the zip, tar.gz or
+        tar.zst archive in path, with an index of the invoices. Calling it
+        again after an interruption continues where it stopped. See
+        ArchiveExporter.
+        """
+        from .export import ArchiveExporter
+
+        exporter = ArchiveExporter(
+            self, path, formats=formats, index=index, workers=workers
         )
-        downloader.get_xml_content(invoice)
+        return exporter.run(filters)
 
-    def get_xml(self, invoice, save_in_dir=None):
-        if not self.its_initialized:
-            self.initialize()
-        downloader = SatFelDownloader(
-            self.credentials, url_get_fel=self.url_get_fel, request_session=self.session
+    def get_model(self, invoice, lazy=False):
+        """
+        Returns the Invoice, or with lazy a LazyInvoice that parses each part
+        of the XML only when it is read.
+        """
+        return self._call(lambda d: d.get_invoice_model(invoice, lazy=lazy))
+
+    def get_invoice_document(self, invoice, save_in_dir=None, received=True):
+        """
+        Returns an InvoiceDocument with the parsed Invoice, the XML bytes and
+        their sha256, downloading the XML only once.
+        """
+        return self._call(
+            lambda d: d.get_invoice_document(invoice, save_in_dir, received)
         )
-        downloader.get_xml(invoice, save_in_dir)
+
+    def get_pdf_content(self, invoice, save_in_dir=None):
+        return self._call(lambda d: d.get_pdf_content(invoice))
+
+    def get_pdf(self, invoice, save_in_dir=None):
+        return self._call(lambda d: d.get_pdf(invoice, save_in_dir))
+
+    def get_xml_content(self, invoice):
+        return self._call(lambda d: d.get_xml_content(invoice))
+
+    def get_xml(self, invoice, save_in_dir=None):
+        return self._call(lambda d: d.get_xml(invoice, save_in_dir))
@@ -0,0 +1,254 @@
+import time
+import socket
+import logging
+import threading
+from functools import wraps
+
+"""
+Timings and counters of the requests made to SAT and of the parsing.
+
+Nothing is recorded until a sink is set with set_sink, and while no sink is
+set span and increment only check a flag, so the instrumentation can stay in
+the hot paths.
+
+    from sat_gt_fel_invoices_downloader import metrics
+
+    sink = metrics.InMemorySink()
+    metrics.set_sink(sink)
+    ...
+    print(sink.summary())
+"""
+
+
+class MetricsSink:
+    """
+    Receives the metrics. This one ignores them, subclasses send them
+    somewhere. tags is a dict of str -> str.
+    """
+
+    enabled = False
+
+    def increment(self, name, value=1, tags=None):
+        pass
+
+    def timing(self, name, seconds, tags=None):
+        pass
+
+
+def _tags_key(tags):
+    return tuple(sorted(tags.items())) if tags else ()
+
+
+class InMemorySink(MetricsSink):
+    """
+    Keeps the counters and every timing in memory, for tests and benchmarks.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, tags=None):
+        key = (name, _tags_key(tags))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def timing(self, name, seconds, tags=None):
+        key = (name, _tags_key(tags))
+        with self._lock:
+            self.timings.setdefault(key, []).append(seconds)
+
+    def counter(self, name, **tags):
+        """
+        Returns the total of the counter name for the series matching tags.
+        """
+        wanted = set(tags.items())
+        with self._lock:
+            return sum(
+                value
+                for (counter, key), value in self.counters.items()
+                if counter == name and wanted <= set(key)
+            )
+
+    def summary(self):
+        """
+        Returns {name: {"count", "total", "p50", "p99"}} of the timings,
+        adding up every tag combination.
+        """
+        by_name = {}
+        with self._lock:
+            for (name, _), values in self.timings.items():
+                by_name.setdefault(name, []).extend(values)
+        summary = {}
+        for name, values in by_name.items():
+            values.sort()
+            summary[name] = {
+                "count": len(values),
+                "total": sum(values),
+                "p50": values[int(len(values) * 0.5)],
+                "p99": values[min(len(values) - 1, int(len(values) * 0.99))],
+            }
+        return summary
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
+
+
+class StatsDSink(MetricsSink):
+    """
+    Sends the metrics to a StatsD server over UDP. The tags are sent in the
+    DogStatsD format (|#key:value), servers without tags support ignore them
+    unless tags=False.
+    """
+
+    enabled = True
+
+    def __init__(self, host="localhost", port=8125, prefix="sat_fel", tags=True):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.tags = tags
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, value, kind, tags):
+        line = "{}.{}:{}|{}".format(self.prefix, name, value, kind)
+        if self.tags and tags:
+            line += "|#" + ",".join("{}:{}".format(k, v) for k, v in tags.items())
+        try:
+            self._socket.sendto(line.encode("utf-8"), self.address)
+        except OSError as e:
+            logging.debug("Could not send metric %s: %s", name, e)
+
+    def increment(self, name, value=1, tags=None):
+        self._send(name, value, "c", tags)
+
+    def timing(self, name, seconds, tags=None):
+        self._send(name, round(seconds * 1000, 3), "ms", tags)
+
+
+class PrometheusSink(MetricsSink):
+    """
+    Records the counters and timings as prometheus_client Counter and
+    Histogram metrics, labelled by their tags. Every metric must be recorded
+    with the same tag names. Needs prometheus_client installed.
+    """
+
+    enabled = True
+
+    def __init__(self, registry=None, prefix="sat_fel"):
+        try:
+            import prometheus_client
+        except ImportError:
+            raise ImportError(
+                "PrometheusSink needs prometheus_client. Install it with "
+                "pip install sat_gt_fel_invoices_downloader[prometheus]"
+            )
+        self._client = prometheus_client
+        self.registry = registry or prometheus_client.REGISTRY
+        self.prefix = prefix
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _metric(self, kind, name, tags):
+        labels = tuple(sorted(tags)) if tags else ()
+        key = (kind, name)
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                full_name = "{}_{}".format(self.prefix, name)
+                if kind is self._client.Histogram:
+                    full_name += "_seconds"
+                metric = kind(
+                    full_name, name, labelnames=labels, registry=self.registry
+                )
+                self._metrics[key] = metric
+        return metric.labels(**tags) if labels else metric
+
+    def increment(self, name, value=1, tags=None):
+        self._metric(self._client.Counter, name, tags).inc(value)
+
+    def timing(self, name, seconds, tags=None):
+        self._metric(self._client.Histogram, name, tags).observe(seconds)
+
+
+_sink = MetricsSink()
+
+
+def set_sink(sink):
+    """
+    Sets where the metrics go. None stops recording them.
+    """
+    global _sink
+    _sink = sink if sink is not None else MetricsSink()
+
+
+def get_sink():
+    return _sink
+
+
+def increment(name, value=1, **tags):
+    if _sink.enabled:
+        _sink.increment(name, value, tags)
+
+
+class _Span:
+    __slots__ = ("name", "tags", "started")
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        elapsed = time.perf_counter() - self.started
+        if kind is not None:
+            _sink.increment(self.name + "_errors", 1, self.tags)
+        _sink.timing(self.name, elapsed, self.tags)
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, **tags):
+    """
+    Context manager that records how long its block takes as the timing
+    name, and counts name_errors when the block raises.
+    """
+    if not _sink.enabled:
+        return _NO_SPAN
+    return _Span(name, tags)
+
+
+def timed(name):
+    """
+    Decorator version of span.
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _sink.enabled:
+                return function(*args, **kwargs)
+            with _Span(name, {}):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
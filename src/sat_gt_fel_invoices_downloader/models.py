@@ -1,10 +1,32 @@
 from datetime import date, datetime
 from enum import Enum
 from re import S
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields
 from typing import List
 
 
+def slotted(cls):
+    """
+    Rebuilds a dataclass with __slots__ for its fields, so the instances don't
+    carry a __dict__. Same as dataclass(slots=True), which needs Python 3.10.
+    """
+    inherited = set()
+    for base in cls.__mro__[1:]:
+        inherited.update(getattr(base, "__slots__", ()))
+    field_names = [field.name for field in fields(cls)]
+    namespace = dict(cls.__dict__)
+    namespace["__slots__"] = tuple(
+        name for name in field_names if name not in inherited
+    )
+    for name in field_names:
+        namespace.pop(name, None)
+    namespace.pop("__dict__", None)
+    namespace.pop("__weakref__", None)
+    slotted_cls = type(cls)(cls.__name__, cls.__bases__, namespace)
+    slotted_cls.__qualname__ = cls.__qualname__
+    return slotted_cls
+
+
 class EstadoDTE(Enum):
     TODOS = ""
     VIGENTES = "V"
@@ -31,6 +53,7 @@ class SATFELFilters:
     tipo: TypeFEL
 
 
+@slotted
 @dataclass
 class Address:
     street: str
@@ -44,6 +67,7 @@ class Address:
         return Builder(cls)
 
 
+@slotted
 @dataclass
 class ContactModel:
     nit: str
@@ -56,6 +80,7 @@ class ContactModel:
         return Builder(cls)
 
 
+@slotted
 @dataclass
 class IssuingModel(ContactModel):
     nit: str
@@ -70,6 +95,7 @@ class IssuingModel(ContactModel):
         return Builder(cls)
 
 
+@slotted
 @dataclass
 class Tax:
     short_name: str
@@ -78,6 +104,7 @@ class Tax:
     tax_ammount: float
 
 
+@slotted
 @dataclass
 class InvoiceLine(object):
     good_or_service: str
@@ -94,6 +121,7 @@ class InvoiceLine(object):
         return Builder(cls)
 
 
+@slotted
 @dataclass
 class InvoiceHeaders:
     issue_date: datetime.date
@@ -107,6 +135,7 @@ class InvoiceHeaders:
         return Builder(cls)
 
 
+@slotted
 @dataclass
 class TotalTax:
     tax_name: str
@@ -117,6 +146,7 @@ class TotalTax:
         return Builder(cls)
 
 
+@slotted
 @dataclass
 class InvoiceTotals:
     total_taxes: List[TotalTax]
@@ -127,6 +157,7 @@ class InvoiceTotals:
         return Builder(cls)
 
 
+@slotted
 @dataclass
 class Invoice:
     headers: InvoiceHeaders
@@ -156,6 +187,83 @@ class Invoice:
         return InvoiceBuilder(cls)
 
 
+@slotted
+@dataclass
+class InvoiceHeaderSummary:
+    """
+    What the consulta-dte listing says of an invoice, without downloading its
+    XML. Fields SAT didn't send are None.
+    """
+
+    fel_signature: str
+    fel_invoice_serie: str
+    fel_invoice_number: str
+    issue_date: datetime
+    invoice_type: str
+    issuer_nit: str
+    issuer_name: str
+    receiver_nit: str
+    receiver_name: str
+    establishment: str
+    currency: str
+    grand_total: float
+    status: EstadoDTE
+    # The header as returned by consulta-dte, to download its documents
+    header: dict = field(repr=False, compare=False)
+
+
+@dataclass
+class DownloadResult:
+    invoice: dict
+    format: str
+    content: object = None
+    error: Exception = None
+    # Username of the account, set by MultiAccountDownloader
+    account: str = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+@dataclass
+class InvoiceDocument:
+    invoice: Invoice
+    # The XML as SAT sent it, the same bytes that were parsed and hashed
+    xml: bytes
+    sha256: str
+    # Where the XML was saved, if it was
+    path: str = None
+
+
+@dataclass
+class ParseResult:
+    path: str
+    invoice: Invoice = None
+    error: Exception = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+@dataclass
+class SyncReport:
+    new: List[str]
+    changed: List[str]
+    unchanged: List[str]
+    failed: List[str]
+
+
+@dataclass
+class ExportReport:
+    path: str
+    invoices: int
+    documents: int
+    # (uuid, format, error) of the documents that couldn't be downloaded
+    failed: list
+
+
 class Builder:
     def __init__(self, cls):
         self.attrs = {}
@@ -193,3 +301,15 @@ class InvoiceBuilder(Builder):
     def with_totals(self, totals):
         self.attrs["totals"] = totals
         return self
+
+
+def get_invoice_status(invoice):
+    """
+    Returns the EstadoDTE of an invoice header returned by consulta-dte,
+    or None when the header doesn't say it.
+    """
+    status = invoice.get("estado", invoice.get("estadoDte"))
+    try:
+        return EstadoDTE(status)
+    except ValueError:
+        return None
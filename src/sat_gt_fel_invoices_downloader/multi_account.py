@@ -0,0 +1,175 @@
+import os
+import logging
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from .main import DOWNLOAD_FORMATS
+from .models import DownloadResult, TypeFEL
+from .session_pool import SessionPool
+
+"""
+Downloads the invoices of many taxpayer accounts at the same time, as an
+accounting firm needs, sharing a global number of workers between them.
+"""
+
+LIST_FORMAT = "list"
+
+
+class _Account:
+    def __init__(self, credentials, filters):
+        self.credentials = credentials
+        self.filters = filters
+        self.received = filters.tipo == TypeFEL.RECIBIDA
+        self.queue = deque()
+        self.in_flight = 0
+        self.listed = False
+
+    @property
+    def username(self):
+        return self.credentials.username
+
+    @property
+    def finished(self):
+        return self.listed and not self.queue and not self.in_flight
+
+
+class MultiAccountDownloader:
+    """
+    accounts is a list of (SatCredentials, SATFELFilters). Every account
+    has its own session (cookies and connection pool) from a SessionPool,
+    logs in, lists its invoices and downloads them, and is logged out when
+    it finishes.
+
+    `workers` threads are shared by every account. Downloads are scheduled
+    round robin between the accounts, and each account has at most
+    workers_per_account downloads in flight, so a big account can't starve
+    the rest. At most max_active_accounts accounts are logged in at once.
+    """
+
+    def __init__(
+        self,
+        accounts,
+        formats=("xml", "pdf"),
+        workers=16,
+        workers_per_account=4,
+        max_active_accounts=None,
+        save_in_dir=None,
+        cache=None,
+        token_ttl=None,
+    ):
+        for filetype in formats:
+            if filetype not in DOWNLOAD_FORMATS:
+                raise ValueError("Unknown format {}".format(filetype))
+        self.accounts = [_Account(c, f) for c, f in accounts]
+        usernames = [account.username for account in self.accounts]
+        if len(set(usernames)) != len(usernames):
+            raise ValueError("Every account can be given only once")
+        self.formats = formats
+        self.workers = workers
+        self.workers_per_account = min(workers_per_account, workers)
+        self.max_active_accounts = max_active_accounts or max(
+            1, workers // self.workers_per_account
+        )
+        self.save_in_dir = save_in_dir
+        self.pool = SessionPool(
+            max_connections=self.max_active_accounts * self.workers_per_account,
+            connections_per_session=self.workers_per_account,
+            token_ttl=token_ttl,
+            cache=cache,
+        )
+
+    def _account_dir(self, account):
+        if self.save_in_dir is None:
+            return None
+        directory = os.path.join(self.save_in_dir, account.username)
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def _list(self, account):
+        downloader = self.pool.get(account.credentials)
+        return downloader.get_invoices_with_filters(account.filters)
+
+    def _download(self, account, invoice, filetype):
+        downloader = self.pool.get(account.credentials)
+        return downloader.download_one(
+            invoice, filetype, self._account_dir(account), account.received
+        )
+
+    def _next_download(self, turns):
+        """
+        Returns the next account with a download that can start, moving it to
+        the end of the turns, or None.
+        """
+        for _ in range(len(turns)):
+            account = turns[0]
+            turns.rotate(-1)
+            if account.queue and account.in_flight < self.workers_per_account:
+                return account
+        return None
+
+    def __iter__(self):
+        return self.download()
+
+    def download(self):
+        """
+        Yields a DownloadResult, with its account set to the username, for
+        every format of every invoice as soon as it finishes. When an account
+        can't log in or list its invoices a single result with format "list"
+        and the error is yielded for it.
+        """
+        waiting = deque(self.accounts)
+        turns = deque()
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                while waiting or turns:
+                    while waiting and len(turns) < self.max_active_accounts:
+                        account = waiting.popleft()
+                        turns.append(account)
+                        futures[executor.submit(self._list, account)] = (
+                            account,
+                            None,
+                            LIST_FORMAT,
+                        )
+                    while len(futures) < self.workers:
+                        account = self._next_download(turns)
+                        if account is None:
+                            break
+                        invoice, filetype = account.queue.popleft()
+                        account.in_flight += 1
+                        future = executor.submit(
+                            self._download, account, invoice, filetype
+                        )
+                        futures[future] = (account, invoice, filetype)
+                    if not futures:
+                        continue
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        account, invoice, filetype = futures.pop(future)
+                        if filetype == LIST_FORMAT:
+                            result = self._listed(account, future)
+                        else:
+                            account.in_flight -= 1
+                            result = future.result()
+                            result.account = account.username
+                        if result is not None:
+                            yield result
+                        if account.finished:
+                            turns.remove(account)
+                            self.pool.discard(account.credentials)
+            finally:
+                for future in futures:
+                    future.cancel()
+                self.pool.close()
+
+    def _listed(self, account, future):
+        account.listed = True
+        try:
+            invoices = future.result()
+        except Exception as e:
+            logging.warning("Could not list invoices of %s: %s", account.username, e)
+            return DownloadResult(None, LIST_FORMAT, error=e, account=account.username)
+        logging.info("%s has %s invoices", account.username, len(invoices))
+        account.queue.extend(
+            (invoice, filetype) for invoice in invoices for filetype in self.formats
+        )
+        return None
@@ -0,0 +1,127 @@
+import os
+import sys
+import json
+import fnmatch
+import logging
+import argparse
+import datetime
+import dataclasses
+from concurrent.futures import ProcessPoolExecutor
+from .concurrency import bounded_unordered_map, chunked
+from .models import ParseResult
+from .parser import parse_invoice_xml
+
+"""
+Rebuilds Invoice models from XML documents already on disk, parsing them
+in a pool of processes.
+"""
+
+
+def iter_files(path, pattern="*.xml"):
+    """
+    Yields the files under path matching pattern without listing the whole
+    tree first.
+    """
+    if os.path.isfile(path):
+        yield path
+        return
+    directories = [path]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif fnmatch.fnmatch(entry.name, pattern):
+                    yield entry.path
+
+
+def parse_file(path):
+    try:
+        with open(path, "rb") as f:
+            return ParseResult(path, invoice=parse_invoice_xml(f.read()))
+    except Exception as e:
+        # Exceptions from lxml can't always be pickled back from the worker
+        return ParseResult(path, error=ValueError("{}: {}".format(type(e).__name__, e)))
+
+
+def parse_files(paths):
+    return [parse_file(path) for path in paths]
+
+
+def parse_directory(path, workers=None, chunk_size=100, pattern="*.xml"):
+    """
+    Yields a ParseResult for every XML file under path. The files are parsed
+    in chunks of chunk_size by a pool of `workers` processes and only a few
+    chunks per worker are in flight, so memory doesn't grow with the archive.
+    """
+    workers = workers or os.cpu_count()
+    chunks = chunked(iter_files(path, pattern), chunk_size)
+    if workers <= 1:
+        for chunk in chunks:
+            yield from parse_files(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for results in bounded_unordered_map(
+            executor, parse_files, chunks, workers * 2
+        ):
+            yield from results
+
+
+def invoice_to_dict(invoice):
+    return dataclasses.asdict(invoice)
+
+
+def json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def write_jsonl(results, output_dir, chunk_size=10000):
+    """
+    Writes the parsed invoices as JSON lines in files of chunk_size invoices.
+    Returns the number of invoices written and the number of errors.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    written = errors = 0
+    output = None
+    try:
+        for result in results:
+            if not result.ok:
+                logging.warning("Could not parse %s: %s", result.path, result.error)
+                errors += 1
+                continue
+            if written % chunk_size == 0:
+                if output is not None:
+                    output.close()
+                filename = "invoices-{:06d}.jsonl".format(written // chunk_size)
+                output = open(os.path.join(output_dir, filename), "w")
+            row = invoice_to_dict(result.invoice)
+            row["path"] = result.path
+            output.write(json.dumps(row, default=json_default))
+            output.write("\n")
+            written += 1
+    finally:
+        if output is not None:
+            output.close()
+    return written, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Parse SAT FEL XML files into invoices in JSON lines"
+    )
+    parser.add_argument("path", help="XML file or directory with XML files")
+    parser.add_argument("--output", "-o", required=True, help="Output directory")
+    parser.add_argument("--workers", "-w", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--pattern", default="*.xml")
+    args = parser.parse_args(argv)
+    results = parse_directory(args.path, workers=args.workers, pattern=args.pattern)
+    written, errors = write_jsonl(results, args.output, args.chunk_size)
+    print("Parsed {} invoices, {} errors".format(written, errors))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,447 @@
+import re
+from datetime import datetime, timedelta, timezone
+from lxml import etree
+from .models import (
+    Address,
+    ContactModel,
+    Invoice,
+    InvoiceHeaderSummary,
+    InvoiceHeaders,
+    InvoiceLine,
+    InvoiceTotals,
+    IssuingModel,
+    TotalTax,
+    get_invoice_status,
+)
+
+"""
+Parser of the SAT DTE XML into the Invoice model. It works on the raw bytes,
+so it can be used with archived documents without any network access.
+"""
+
+_PARSER = etree.XMLParser(
+    resolve_entities=False, no_network=True, remove_blank_text=True
+)
+_DATETIME = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?"
+    r"(Z|[+-]\d{2}:?\d{2})?$"
+)
+
+
+def parse_datetime(value):
+    """
+    Parses the FechaHoraEmision formats used by the certifiers, with or
+    without fraction of seconds and with or without time zone.
+    """
+    match = _DATETIME.match(value.strip())
+    if match is None:
+        raise ValueError("Invalid date {}".format(value))
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    microsecond = int(fraction[:6].ljust(6, "0")) if fraction else 0
+    tzinfo = None
+    if zone == "Z":
+        tzinfo = timezone.utc
+    elif zone:
+        sign = -1 if zone[0] == "-" else 1
+        zone = zone[1:].replace(":", "")
+        offset = timedelta(hours=int(zone[:2]), minutes=int(zone[2:]))
+        tzinfo = timezone(sign * offset)
+    return datetime(
+        int(year),
+        int(month),
+        int(day),
+        int(hour),
+        int(minute),
+        int(second),
+        microsecond,
+        tzinfo,
+    )
+
+
+def parse_listing_date(value):
+    """
+    Parses the fechaEmision of the consulta-dte listing, either ISO like
+    FechaHoraEmision or dd/mm/yyyy. Returns None when it's missing.
+    """
+    if not value:
+        return None
+    try:
+        return parse_datetime(value)
+    except ValueError:
+        return datetime.strptime(value.strip()[:10], "%d/%m/%Y")
+
+
+def parse_invoice_header(header):
+    """
+    Maps an invoice of the consulta-dte listing into an InvoiceHeaderSummary.
+    """
+    establishment = header.get("establecimiento", header.get("codigoEstablecimiento"))
+    grand_total = header.get("granTotal")
+    return InvoiceHeaderSummary(
+        fel_signature=header["numeroUuid"],
+        fel_invoice_serie=header.get("serie"),
+        fel_invoice_number=header.get("numeroDte"),
+        issue_date=parse_listing_date(header.get("fechaEmision")),
+        invoice_type=header.get("tipoDte"),
+        issuer_nit=header.get("nitEmisor"),
+        issuer_name=header.get("nombreEmisor"),
+        receiver_nit=header.get("nitReceptor"),
+        receiver_name=header.get("nombreReceptor"),
+        establishment=None if establishment is None else str(establishment),
+        currency=header.get("moneda"),
+        grand_total=None if grand_total is None else float(grand_total),
+        status=get_invoice_status(header),
+        header=header,
+    )
+
+
+def _local_name(tag):
+    return tag[tag.rfind("}") + 1 :]
+
+
+def _children_text(element):
+    """
+    Returns a dict of local name -> text of the children of element. It walks
+    the children once instead of making one find call per field.
+    """
+    return {_local_name(child.tag): child.text for child in element}
+
+
+def _find(element, local_name):
+    for child in element:
+        if _local_name(child.tag) == local_name:
+            return child
+    return None
+
+
+def extract_lines(items):
+    """
+    Returns the values of every Item as a dict with the InvoiceLine fields.
+    """
+    lines = []
+    for item in items:
+        values = _children_text(item)
+        lines.append(
+            {
+                "good_or_service": item.get("BienOServicio"),
+                "description": values["Descripcion"].strip(),
+                "quantity": float(values["Cantidad"]),
+                "unit_price": float(values["PrecioUnitario"]),
+                "total_line": float(values["Precio"]),
+                "total": float(values["Total"]),
+                "line_number": int(item.get("NumeroLinea")),
+                "discount": float(values["Descuento"]),
+            }
+        )
+    return lines
+
+
+def parse_invoice_lines(items):
+    return [InvoiceLine(**line) for line in extract_lines(items)]
+
+
+def _namespace(root):
+    if root.tag[0] == "{":
+        return root.tag[: root.tag.index("}") + 1]
+    return ""
+
+
+def _sections(root):
+    """
+    Returns a dict of local name -> element of the children of DatosEmision,
+    plus the Certificacion element.
+    """
+    ns = _namespace(root)
+    emission_data = root.find(".//{0}DatosEmision".format(ns))
+    sections = {_local_name(child.tag): child for child in emission_data}
+    certification = emission_data.getnext()
+    if certification is None or _local_name(certification.tag) != "Certificacion":
+        certification = root.find(".//{0}Certificacion".format(ns))
+    sections["Certificacion"] = certification
+    return sections
+
+
+def _extract_certification(sections):
+    fel_data = _find(sections["Certificacion"], "NumeroAutorizacion")
+    return {
+        "fel_signature": fel_data.text,
+        "fel_invoice_serie": fel_data.get("Serie"),
+        "fel_invoice_number": fel_data.get("Numero"),
+    }
+
+
+def _extract_headers(sections):
+    general_data = sections["DatosGenerales"]
+    issuer = sections["Emisor"]
+    receptor = sections["Receptor"]
+    address = _children_text(_find(issuer, "DireccionEmisor"))
+    return {
+        "issue_date": parse_datetime(general_data.get("FechaHoraEmision")),
+        "invoice_type": general_data.get("Tipo"),
+        "currency": general_data.get("CodigoMoneda"),
+        "issuer_nit": issuer.get("NITEmisor"),
+        "issuer_commercial_name": issuer.get("NombreComercial"),
+        "issuer_name": issuer.get("NombreEmisor"),
+        "issuer_email": issuer.get("CorreoEmisor"),
+        "vat_affiliation": issuer.get("AfiliacionIVA"),
+        "establishment": issuer.get("CodigoEstablecimiento"),
+        "street": address.get("Direccion"),
+        "zip_code": address.get("CodigoPostal"),
+        "city": address.get("Municipio"),
+        "state": address.get("Departamento"),
+        "country": address.get("Pais"),
+        "receiver_nit": receptor.get("IDReceptor"),
+        "receiver_name": receptor.get("NombreReceptor"),
+        "receiver_email": receptor.get("CorreoReceptor"),
+    }
+
+
+def _extract_totals(sections):
+    """
+    Returns (grand_total, taxes) with taxes a list of (name, total).
+    """
+    totals = sections["Totales"]
+    total_taxes = _find(totals, "TotalImpuestos")
+    taxes = [
+        (tax.get("NombreCorto"), float(tax.get("TotalMontoImpuesto")))
+        for tax in (total_taxes if total_taxes is not None else ())
+    ]
+    return float(_find(totals, "GranTotal").text), taxes
+
+
+def _extract_items(sections):
+    items = sections.get("Items")
+    return extract_lines(items if items is not None else ())
+
+
+def extract_invoice(root):
+    """
+    Reads the values of a DTE tree without building any model. Returns a
+    tuple (header, lines, taxes): header is a flat dict, lines a list of
+    dicts with the InvoiceLine fields and taxes a list of (name, total).
+    """
+    sections = _sections(root)
+    header = _extract_certification(sections)
+    header.update(_extract_headers(sections))
+    header["grand_total"], taxes = _extract_totals(sections)
+    return header, _extract_items(sections), taxes
+
+
+def build_headers(header):
+    address = Address(
+        street=header["street"],
+        zip_code=header["zip_code"],
+        city=header["city"],
+        state=header["state"],
+        country=header["country"],
+    )
+    issuer = IssuingModel(
+        nit=header["issuer_nit"],
+        commercial_name=header["issuer_commercial_name"],
+        issuing_name=header["issuer_name"],
+        address=address,
+        vat_affiliation=header["vat_affiliation"],
+        establishment=header["establishment"],
+        email=header["issuer_email"],
+    )
+    receiver = ContactModel(
+        nit=header["receiver_nit"],
+        commercial_name=header["receiver_name"],
+        address="CIUDAD",
+        email=header["receiver_email"],
+    )
+    return InvoiceHeaders(
+        issue_date=header["issue_date"],
+        invoice_type=header["invoice_type"],
+        issuer=issuer,
+        receiver=receiver,
+        currency=header["currency"],
+    )
+
+
+def build_totals(grand_total, taxes):
+    return InvoiceTotals(
+        [TotalTax(tax_name=name, tax_total=total) for name, total in taxes],
+        grand_total=grand_total,
+    )
+
+
+def build_invoice(header, lines, taxes):
+    return Invoice(
+        headers=build_headers(header),
+        lines=[InvoiceLine(**line) for line in lines],
+        totals=build_totals(header["grand_total"], taxes),
+        fel_signature=header["fel_signature"],
+        fel_invoice_serie=header["fel_invoice_serie"],
+        fel_invoice_number=header["fel_invoice_number"],
+    )
+
+
+def invoice_values(invoice):
+    """
+    The reverse of build_invoice: returns the (header, lines, taxes) values
+    of an Invoice in the same shape as extract_invoice.
+    """
+    headers = invoice.headers
+    issuer = headers.issuer
+    address = issuer.address
+    header = {
+        "fel_signature": invoice.fel_signature,
+        "fel_invoice_serie": invoice.fel_invoice_serie,
+        "fel_invoice_number": invoice.fel_invoice_number,
+        "issue_date": headers.issue_date,
+        "invoice_type": headers.invoice_type,
+        "currency": headers.currency,
+        "issuer_nit": issuer.nit,
+        "issuer_commercial_name": issuer.commercial_name,
+        "issuer_name": issuer.issuing_name,
+        "issuer_email": issuer.email,
+        "vat_affiliation": issuer.vat_affiliation,
+        "establishment": issuer.establishment,
+        "street": address.street,
+        "zip_code": address.zip_code,
+        "city": address.city,
+        "state": address.state,
+        "country": address.country,
+        "receiver_nit": headers.receiver.nit,
+        "receiver_name": headers.receiver.commercial_name,
+        "receiver_email": headers.receiver.email,
+        "grand_total": invoice.totals.grand_total,
+    }
+    lines = [
+        {
+            "good_or_service": line.good_or_service,
+            "description": line.description,
+            "quantity": line.quantity,
+            "unit_price": line.unit_price,
+            "total_line": line.total_line,
+            "total": line.total,
+            "line_number": line.line_number,
+            "discount": line.discount,
+        }
+        for line in invoice.lines
+    ]
+    taxes = [(tax.tax_name, tax.tax_total) for tax in invoice.totals.total_taxes]
+    return header, lines, taxes
+
+
+def parse_invoice_tree(root):
+    return build_invoice(*extract_invoice(root))
+
+
+def parse_xml_tree(content):
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return etree.fromstring(content, _PARSER)
+
+
+def parse_invoice_xml(content):
+    """
+    Parses the XML of a DTE (bytes or str) into an Invoice.
+    """
+    return parse_invoice_tree(parse_xml_tree(content))
+
+
+class LazyInvoice:
+    """
+    Has the same attributes as Invoice, but keeps the XML and only parses it
+    on the first access. The lines are only built the first time they are
+    read, so reading the certification, the issuer or the grand total of
+    many invoices skips building their lines and keeps no XML tree.
+    """
+
+    __slots__ = ("xml", "_sections", "_certification", "_headers", "_lines", "_totals")
+
+    def __init__(self, xml):
+        self.xml = xml
+        self._sections = None
+        self._certification = None
+        self._headers = None
+        self._lines = None
+        self._totals = None
+
+    def _parse(self, lines=False):
+        """
+        Builds from one parse of the XML every small part (certification,
+        headers and totals) that isn't built yet, and the lines with lines.
+        The tree is released afterwards: keeping it costs more memory than
+        an Invoice, so reading the lines later parses the XML again.
+        """
+        self._sections = _sections(parse_xml_tree(self.xml))
+        try:
+            if self._certification is None:
+                self._certification = _extract_certification(self._sections)
+            if self._headers is None:
+                self._headers = build_headers(_extract_headers(self._sections))
+            if self._totals is None:
+                self._totals = build_totals(*_extract_totals(self._sections))
+            if lines:
+                self._lines = [
+                    InvoiceLine(**line) for line in _extract_items(self._sections)
+                ]
+        finally:
+            self._sections = None
+
+    def _get_certification(self):
+        if self._certification is None:
+            self._parse()
+        return self._certification
+
+    @property
+    def fel_signature(self):
+        return self._get_certification()["fel_signature"]
+
+    @property
+    def fel_invoice_serie(self):
+        return self._get_certification()["fel_invoice_serie"]
+
+    @property
+    def fel_invoice_number(self):
+        return self._get_certification()["fel_invoice_number"]
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._parse()
+        return self._headers
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._parse(lines=True)
+        return self._lines
+
+    @property
+    def totals(self):
+        if self._totals is None:
+            self._parse()
+        return self._totals
+
+    def to_invoice(self):
+        return Invoice(
+            headers=self.headers,
+            lines=self.lines,
+            totals=self.totals,
+            fel_signature=self.fel_signature,
+            fel_invoice_serie=self.fel_invoice_serie,
+            fel_invoice_number=self.fel_invoice_number,
+        )
+
+    def __eq__(self, other):
+        if isinstance(other, LazyInvoice):
+            other = other.to_invoice()
+        return self.to_invoice() == other
+
+    def __str__(self):
+        return str(self.to_invoice())
+
+    def __repr__(self):
+        return "LazyInvoice(fel_signature={!r})".format(self.fel_signature)
+
+
+def parse_invoice_xml_lazy(content):
+    """
+    Returns a LazyInvoice of the XML of a DTE (bytes or str), which parses it
+    when its attributes are read.
+    """
+    return LazyInvoice(content)
@@ -0,0 +1,60 @@
+import datetime
+from dataclasses import replace
+from .models import SATFELFilters
+
+"""
+Splits the date range of SATFELFilters into smaller windows so the
+consulta-dte queries can run at the same time.
+"""
+
+
+def split_filters(filters: SATFELFilters, days=7):
+    """
+    Returns an iterator of the windows of `days` days covering the range.
+    """
+    if days < 1:
+        raise ValueError("days must be at least 1, got {}".format(days))
+    return _split_filters(filters, days)
+
+
+def _split_filters(filters, days):
+    start = filters.fechaInicio
+    while start <= filters.fechaFin:
+        end = min(start + datetime.timedelta(days=days - 1), filters.fechaFin)
+        yield replace(filters, fechaInicio=start, fechaFin=end)
+        start = end + datetime.timedelta(days=1)
+
+
+def halve_filters(filters: SATFELFilters):
+    """
+    Returns the two halves of the date range, or None for a single day.
+    """
+    days = (filters.fechaFin - filters.fechaInicio).days
+    if days < 1:
+        return None
+    middle = filters.fechaInicio + datetime.timedelta(days=days // 2)
+    return (
+        replace(filters, fechaFin=middle),
+        replace(filters, fechaInicio=middle + datetime.timedelta(days=1)),
+    )
+
+
+def iter_unique(results):
+    """
+    Yields the invoice headers of every list in results dropping the repeated
+    numeroUuid.
+    """
+    seen = set()
+    for result in results:
+        for invoice in result:
+            if invoice["numeroUuid"] in seen:
+                continue
+            seen.add(invoice["numeroUuid"])
+            yield invoice
+
+
+def merge_invoices(results):
+    """
+    Merges lists of invoice headers dropping the repeated numeroUuid.
+    """
+    return list(iter_unique(results))
@@ -0,0 +1,247 @@
+import re
+import time
+import random
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from . import metrics
+from .actions import LOGIN_URL
+
+"""
+Retries, circuit breaker and rate limiting for the requests made to SAT.
+ResilientSession applies them to every request, so the actions and the
+downloaders don't need to know about them.
+"""
+
+
+class RetryPolicy:
+    """
+    How to retry the requests of an endpoint: up to max_retries times after
+    a connection error, a timeout or one of statuses, waiting a random time
+    between 0 and backoff * 2 ** attempt seconds (capped at max_backoff), or
+    what the Retry-After header asks for, up to max_retry_after.
+    """
+
+    def __init__(
+        self,
+        max_retries=3,
+        backoff=0.5,
+        max_backoff=30,
+        statuses=(429, 502, 503, 504),
+        max_retry_after=120,
+    ):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+        self.max_retry_after = max_retry_after
+
+    def delay(self, attempt, response=None):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.max_retry_after))
+        return delay
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, date.timestamp() - time.time())
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures of a host. While open
+    the requests to the host wait until reset_timeout has passed, then they
+    are let through again: a success closes it, a failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def remaining(self):
+        """
+        Seconds until the host can be called again, 0 if it can be called now.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(0, self._opened_at + self.reset_timeout - self._clock())
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logging.warning("Circuit opened after %s failures", self._failures)
+                self._opened_at = self._clock()
+
+
+class RateLimiter:
+    """
+    Token bucket that allows rate requests per second with bursts of up to
+    burst requests. acquire blocks until the request is allowed.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.burst
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            # The token is taken now, the caller waits until it would exist
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            self._sleep(wait)
+
+
+class ResilientSession(requests.Session):
+    """
+    requests.Session that retries failed requests following the RetryPolicy
+    of their endpoint, pauses the hosts that keep failing and limits the
+    request rate.
+
+    policies is a list of (pattern, RetryPolicy): the first pattern found in
+    the URL (re.search) picks the policy, otherwise default_policy is used.
+    """
+
+    def __init__(
+        self,
+        policies=(),
+        default_policy=None,
+        rate_limiter=None,
+        failure_threshold=5,
+        reset_timeout=30,
+        sleep=time.sleep,
+    ):
+        super().__init__()
+        self.policies = [(re.compile(pattern), policy) for pattern, policy in policies]
+        self.default_policy = default_policy or RetryPolicy()
+        self.rate_limiter = rate_limiter
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._sleep = sleep
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+    def policy_for(self, url):
+        for pattern, policy in self.policies:
+            if pattern.search(url):
+                return policy
+        return self.default_policy
+
+    def breaker_for(self, url):
+        host = urlsplit(url).netloc
+        with self._breakers_lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self._breakers[host] = breaker
+            return breaker
+
+    def request(self, method, url, *args, **kwargs):
+        policy = self.policy_for(url)
+        breaker = self.breaker_for(url)
+        attempt = 0
+        while True:
+            remaining = breaker.remaining()
+            if remaining:
+                metrics.increment("circuit_waits", host=urlsplit(url).netloc)
+                logging.info("Waiting %.1fs for %s to recover", remaining, url)
+                self._sleep(remaining)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                breaker.record_failure()
+                if attempt >= policy.max_retries:
+                    raise
+                delay = policy.delay(attempt)
+                logging.info("%s %s failed (%s), retry in %.1fs", method, url, e, delay)
+            else:
+                if response.status_code not in policy.statuses:
+                    breaker.record_success()
+                    return response
+                if response.status_code >= 500:
+                    breaker.record_failure()
+                if attempt >= policy.max_retries:
+                    return response
+                delay = policy.delay(attempt, response)
+                logging.info(
+                    "%s %s answered %s, retry in %.1fs",
+                    method,
+                    url,
+                    response.status_code,
+                    delay,
+                )
+                response.close()
+            metrics.increment("retries", host=urlsplit(url).netloc)
+            self._sleep(delay)
+            attempt += 1
+
+
+# SAT doesn't publish its limits, this keeps bulk runs well below the rate
+# at which the consulta endpoints start answering 503.
+DEFAULT_RATE = 10
+# Connections kept per host, requests keeps 10 by default and more workers
+# than that would keep opening and discarding connections
+DEFAULT_POOL_SIZE = 20
+
+
+def default_session(pool_size=DEFAULT_POOL_SIZE, pool_block=False):
+    """
+    Session used by SATDownloader when none is given. Login is retried only
+    once so a wrong password doesn't end up locking the account.
+
+    pool_size connections are kept per host, it should be at least the
+    number of workers sharing the session. With pool_block the requests wait
+    for a free connection instead of opening more.
+    """
+    session = ResilientSession(
+        policies=[(re.escape(LOGIN_URL), RetryPolicy(max_retries=1))],
+        rate_limiter=RateLimiter(DEFAULT_RATE, burst=2 * DEFAULT_RATE),
+    )
+    adapter = HTTPAdapter(pool_maxsize=pool_size, pool_block=pool_block)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
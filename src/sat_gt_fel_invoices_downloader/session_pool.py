@@ -0,0 +1,91 @@
+import logging
+import threading
+import requests
+from collections import OrderedDict
+from .main import SATDownloader
+from .resilience import default_session
+
+
+class SessionPool:
+    """
+    Keeps one logged in SATDownloader per credentials, each one with its own
+    connection pool, so syncing many taxpayer accounts doesn't repeat the
+    login handshake on every use.
+
+    Every session opens at most connections_per_session connections per host
+    (requests wait for a free one), and at most max_connections //
+    connections_per_session sessions are kept: asking for one more logs out
+    the least recently used.
+    """
+
+    def __init__(
+        self, max_connections=64, connections_per_session=4, token_ttl=None, cache=None
+    ):
+        self.connections_per_session = connections_per_session
+        self.max_sessions = max(1, max_connections // connections_per_session)
+        self.token_ttl = token_ttl
+        self.cache = cache
+        self._downloaders = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._downloaders)
+
+    def _new_session(self):
+        return default_session(self.connections_per_session, pool_block=True)
+
+    def get(self, credentials):
+        """
+        Returns the initialized SATDownloader of these credentials.
+        """
+        evicted = []
+        with self._lock:
+            downloader = self._downloaders.get(credentials.username)
+            if downloader is not None and downloader.credentials != credentials:
+                # The password changed, don't reuse the old session
+                evicted.append(self._downloaders.pop(credentials.username))
+                downloader = None
+            if downloader is None:
+                downloader = SATDownloader(
+                    request_session=self._new_session(),
+                    cache=self.cache,
+                    token_ttl=self.token_ttl,
+                )
+                downloader.setCredentials(credentials)
+                self._downloaders[credentials.username] = downloader
+                while len(self._downloaders) > self.max_sessions:
+                    evicted.append(self._downloaders.popitem(last=False)[1])
+            self._downloaders.move_to_end(credentials.username)
+        for old in evicted:
+            _close(old)
+        downloader._get_downloader()
+        return downloader
+
+    def discard(self, credentials):
+        with self._lock:
+            downloader = self._downloaders.pop(credentials.username, None)
+        if downloader is not None:
+            _close(downloader)
+
+    def close(self):
+        with self._lock:
+            downloaders = list(self._downloaders.values())
+            self._downloaders.clear()
+        for downloader in downloaders:
+            _close(downloader)
+
+
+def _close(downloader):
+    try:
+        if downloader.its_initialized:
+            downloader.logout()
+    except requests.RequestException as e:
+        logging.warning("Could not logout %s: %s", downloader.credentials.username, e)
+    downloader.session.close()
+    downloader.contingency.close()
@@ -0,0 +1,346 @@
+import re
+import json
+import sqlite3
+import datetime
+import logging
+from .models import get_invoice_status
+from .parser import (
+    build_invoice,
+    extract_invoice,
+    invoice_values,
+    parse_datetime,
+    parse_xml_tree,
+)
+
+"""
+Local SQLite store of invoice headers (as returned by consulta-dte) and
+parsed invoices, with their lines and taxes, so reports can be answered
+without querying SAT again.
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS headers (
+    uuid TEXT PRIMARY KEY,
+    issuer_nit TEXT,
+    receiver_nit TEXT,
+    issue_day TEXT,
+    status TEXT,
+    establishment TEXT,
+    grand_total REAL,
+    raw TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS headers_issuer ON headers (issuer_nit, issue_day);
+CREATE INDEX IF NOT EXISTS headers_receiver ON headers (receiver_nit, issue_day);
+CREATE INDEX IF NOT EXISTS headers_day ON headers (issue_day);
+CREATE INDEX IF NOT EXISTS headers_status ON headers (status);
+CREATE INDEX IF NOT EXISTS headers_establishment ON headers (establishment);
+
+CREATE TABLE IF NOT EXISTS invoices (
+    uuid TEXT PRIMARY KEY,
+    fel_invoice_serie TEXT,
+    fel_invoice_number TEXT,
+    issue_date TEXT,
+    issue_day TEXT,
+    invoice_type TEXT,
+    currency TEXT,
+    issuer_nit TEXT,
+    issuer_commercial_name TEXT,
+    issuer_name TEXT,
+    issuer_email TEXT,
+    vat_affiliation TEXT,
+    establishment TEXT,
+    street TEXT,
+    zip_code TEXT,
+    city TEXT,
+    state TEXT,
+    country TEXT,
+    receiver_nit TEXT,
+    receiver_name TEXT,
+    receiver_email TEXT,
+    grand_total REAL
+);
+CREATE INDEX IF NOT EXISTS invoices_issuer ON invoices (issuer_nit, issue_day);
+CREATE INDEX IF NOT EXISTS invoices_receiver ON invoices (receiver_nit, issue_day);
+CREATE INDEX IF NOT EXISTS invoices_day ON invoices (issue_day);
+CREATE INDEX IF NOT EXISTS invoices_establishment ON invoices (establishment);
+
+CREATE TABLE IF NOT EXISTS lines (
+    uuid TEXT NOT NULL,
+    line_number INTEGER NOT NULL,
+    good_or_service TEXT,
+    description TEXT,
+    quantity REAL,
+    unit_price REAL,
+    total_line REAL,
+    discount REAL,
+    total REAL,
+    PRIMARY KEY (uuid, line_number)
+);
+
+CREATE TABLE IF NOT EXISTS taxes (
+    uuid TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    tax_name TEXT,
+    tax_total REAL,
+    PRIMARY KEY (uuid, position)
+);
+"""
+
+INVOICE_COLUMNS = (
+    "fel_invoice_serie",
+    "fel_invoice_number",
+    "issue_date",
+    "invoice_type",
+    "currency",
+    "issuer_nit",
+    "issuer_commercial_name",
+    "issuer_name",
+    "issuer_email",
+    "vat_affiliation",
+    "establishment",
+    "street",
+    "zip_code",
+    "city",
+    "state",
+    "country",
+    "receiver_nit",
+    "receiver_name",
+    "receiver_email",
+    "grand_total",
+)
+LINE_COLUMNS = (
+    "line_number",
+    "good_or_service",
+    "description",
+    "quantity",
+    "unit_price",
+    "total_line",
+    "discount",
+    "total",
+)
+_DAY = re.compile(r"(\d{4})-(\d{2})-(\d{2})|(\d{2})/(\d{2})/(\d{4})")
+
+
+def _issue_day(value):
+    """
+    Returns the YYYY-MM-DD day of a date from SAT, either ISO or dd/mm/yyyy.
+    """
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime("%Y-%m-%d")
+    match = _DAY.match(value or "")
+    if match is None:
+        return None
+    if match.group(1):
+        return "{}-{}-{}".format(*match.group(1, 2, 3))
+    return "{}-{}-{}".format(*match.group(6, 5, 4))
+
+
+class InvoiceStore:
+    """
+    Invoices are stored by numeroUuid (the fel_signature of the Invoice).
+    Storing an invoice again replaces it, so the store can be refreshed with
+    the same data without duplicates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def upsert_headers(self, headers):
+        """
+        Stores the invoices returned by get_invoices_with_filters.
+        """
+        rows = (
+            (
+                header["numeroUuid"].upper(),
+                header.get("nitEmisor"),
+                header.get("nitReceptor"),
+                _issue_day(header.get("fechaEmision")),
+                _status_value(header),
+                _establishment(header),
+                header.get("granTotal"),
+                json.dumps(header),
+            )
+            for header in headers
+        )
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def _upsert_values(self, header, lines, taxes):
+        uuid = header["fel_signature"].upper()
+        values = dict(header)
+        values["issue_date"] = header["issue_date"].isoformat()
+        values["issue_day"] = _issue_day(header["issue_date"])
+        columns = ("uuid", "issue_day") + INVOICE_COLUMNS
+        row = [uuid] + [values[column] for column in columns[1:]]
+        self._connection.execute(
+            "INSERT OR REPLACE INTO invoices ({}) VALUES ({})".format(
+                ", ".join(columns), ", ".join("?" * len(columns))
+            ),
+            row,
+        )
+        self._connection.execute("DELETE FROM lines WHERE uuid = ?", (uuid,))
+        self._connection.execute("DELETE FROM taxes WHERE uuid = ?", (uuid,))
+        self._connection.executemany(
+            "INSERT INTO lines (uuid, {}) VALUES (?, {})".format(
+                ", ".join(LINE_COLUMNS), ", ".join("?" * len(LINE_COLUMNS))
+            ),
+            ([uuid] + [line[column] for column in LINE_COLUMNS] for line in lines),
+        )
+        self._connection.executemany(
+            "INSERT INTO taxes VALUES (?, ?, ?, ?)",
+            ((uuid, i, name, total) for i, (name, total) in enumerate(taxes)),
+        )
+
+    def upsert_invoices(self, invoices):
+        with self._connection:
+            for invoice in invoices:
+                self._upsert_values(*invoice_values(invoice))
+
+    def upsert_xml(self, contents):
+        """
+        Stores the invoices in the XML contents without building their models.
+        """
+        with self._connection:
+            for content in contents:
+                self._upsert_values(*extract_invoice(parse_xml_tree(content)))
+
+    def missing_invoices(self):
+        """
+        Returns the uuid of the headers whose invoice isn't stored yet.
+        """
+        rows = self._connection.execute(
+            "SELECT uuid FROM headers WHERE uuid NOT IN (SELECT uuid FROM invoices)"
+        )
+        return [row[0] for row in rows]
+
+    def update(self, downloader, filters, models=True, workers=4):
+        """
+        Stores the headers of filters and downloads the invoices that aren't
+        stored yet. Returns the number of invoices that failed to download.
+        """
+        headers = downloader.get_invoices_with_filters(filters)
+        self.upsert_headers(headers)
+        if not models:
+            return 0
+        missing = set(self.missing_invoices())
+        pending = [h for h in headers if h["numeroUuid"].upper() in missing]
+        failed = 0
+        results = downloader.download_many(pending, formats=("model",), workers=workers)
+        for result in results:
+            if result.ok:
+                self.upsert_invoices([result.content])
+            else:
+                failed += 1
+        logging.info("Stored %s invoices, %s failed", len(pending) - failed, failed)
+        return failed
+
+    def _where(self, table, **filters):
+        conditions = []
+        params = []
+        for column, operator, value in (
+            ("uuid", "=", filters.get("uuid") and filters["uuid"].upper()),
+            ("issuer_nit", "=", filters.get("issuer_nit")),
+            ("receiver_nit", "=", filters.get("receiver_nit")),
+            ("establishment", "=", filters.get("establishment")),
+            ("issue_day", ">=", _issue_day(filters.get("since"))),
+            ("issue_day", "<=", _issue_day(filters.get("until"))),
+            ("grand_total", ">=", filters.get("min_total")),
+            ("grand_total", "<=", filters.get("max_total")),
+        ):
+            if value is not None:
+                conditions.append("{}.{} {} ?".format(table, column, operator))
+                params.append(value)
+        status = filters.get("status")
+        if status is not None:
+            conditions.append("headers.status = ?")
+            params.append(getattr(status, "value", status))
+        if not conditions:
+            return "", params
+        return " WHERE " + " AND ".join(conditions), params
+
+    def find_headers(self, **filters):
+        """
+        Yields the stored headers (dicts as returned by consulta-dte) that
+        match the filters. See find_invoices for the filters.
+        """
+        where, params = self._where("headers", **filters)
+        cursor = self._connection.execute(
+            "SELECT raw FROM headers" + where + " ORDER BY issue_day, uuid", params
+        )
+        for (raw,) in cursor:
+            yield json.loads(raw)
+
+    def find_invoices(self, **filters):
+        """
+        Yields the stored Invoice models matching all the filters given:
+        uuid, issuer_nit, receiver_nit, establishment, since and until (dates,
+        inclusive), min_total, max_total and status (an EstadoDTE, taken from
+        the headers). The models are built one at a time while iterating.
+        """
+        where, params = self._where("invoices", **filters)
+        join = ""
+        if filters.get("status") is not None:
+            join = " JOIN headers ON headers.uuid = invoices.uuid"
+        columns = ", ".join("invoices." + c for c in ("uuid",) + INVOICE_COLUMNS)
+        order = " ORDER BY invoices.issue_day, invoices.uuid"
+        cursor = self._connection.execute(
+            "SELECT " + columns + " FROM invoices" + join + where + order, params
+        )
+        for row in cursor:
+            yield self._build(row)
+
+    def count(self, **filters):
+        where, params = self._where("invoices", **filters)
+        join = ""
+        if filters.get("status") is not None:
+            join = " JOIN headers ON headers.uuid = invoices.uuid"
+        row = self._connection.execute(
+            "SELECT COUNT(*) FROM invoices" + join + where, params
+        ).fetchone()
+        return row[0]
+
+    def get_invoice(self, uuid):
+        return next(self.find_invoices(uuid=uuid), None)
+
+    def _build(self, row):
+        uuid = row[0]
+        header = dict(zip(INVOICE_COLUMNS, row[1:]))
+        header["fel_signature"] = uuid
+        header["issue_date"] = parse_datetime(header["issue_date"])
+        lines = [
+            dict(zip(LINE_COLUMNS, line))
+            for line in self._connection.execute(
+                "SELECT {} FROM lines WHERE uuid = ? ORDER BY line_number".format(
+                    ", ".join(LINE_COLUMNS)
+                ),
+                (uuid,),
+            )
+        ]
+        taxes = self._connection.execute(
+            "SELECT tax_name, tax_total FROM taxes WHERE uuid = ? ORDER BY position",
+            (uuid,),
+        ).fetchall()
+        return build_invoice(header, lines, taxes)
+
+
+def _status_value(header):
+    status = get_invoice_status(header)
+    return status.value if status is not None else None
+
+
+def _establishment(header):
+    establishment = header.get("establecimiento", header.get("codigoEstablecimiento"))
+    return None if establishment is None else str(establishment)
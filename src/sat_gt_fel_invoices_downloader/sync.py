@@ -0,0 +1,213 @@
+import os
+import json
+import hashlib
+import logging
+import datetime
+from .files import atomic_write
+from .models import (
+    EstadoDTE,
+    SATFELFilters,
+    SyncReport,
+    TypeFEL,
+    get_invoice_status,
+)
+from .parser import parse_listing_date
+
+MANIFEST_NAME = "manifest.json"
+# Invoices can be voided after they were issued, so every run queries again
+# this many days before the watermark to pick up status changes.
+LOOKBACK_DAYS = 30
+
+
+class InvoiceSync:
+    """
+    Keeps target_dir in sync with SAT. A manifest stores the watermark (the
+    last day that was queried) and, for every numeroUuid, its status, issue
+    date, the files on disk and their sha256, so that each run only downloads
+    new invoices or invoices whose status changed.
+
+    Invoices that fail are kept apart in the manifest with their issue day
+    and the watermark moves on anyway. The next runs query again only the
+    days of the failed invoices that are before their window.
+    """
+
+    def __init__(
+        self,
+        downloader,
+        target_dir,
+        formats=("xml", "pdf"),
+        received=True,
+        workers=4,
+        lookback_days=LOOKBACK_DAYS,
+    ):
+        for filetype in formats:
+            if filetype not in ("xml", "pdf"):
+                raise ValueError("Can't sync format {}".format(filetype))
+        self.downloader = downloader
+        self.target_dir = target_dir
+        self.formats = formats
+        self.received = received
+        self.workers = workers
+        self.lookback_days = lookback_days
+        self.manifest_path = os.path.join(target_dir, MANIFEST_NAME)
+        os.makedirs(target_dir, exist_ok=True)
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {"watermark": None, "invoices": {}, "failed": {}}
+        with open(self.manifest_path, "r") as f:
+            manifest = json.load(f)
+        manifest.setdefault("failed", {})
+        return manifest
+
+    def _save_manifest(self):
+        content = json.dumps(self.manifest, indent=1, sort_keys=True)
+        atomic_write(self.manifest_path, content.encode("utf-8"))
+
+    @property
+    def watermark(self):
+        watermark = self.manifest["watermark"]
+        if watermark is None:
+            return None
+        return datetime.date.fromisoformat(watermark)
+
+    def _needs_download(self, invoice):
+        entry = self.manifest["invoices"].get(invoice["numeroUuid"])
+        if entry is None:
+            return True
+        if entry["status"] != _status_value(invoice):
+            return True
+        for filetype in self.formats:
+            filename = entry["files"].get(filetype)
+            if not filename:
+                return True
+            if not os.path.exists(os.path.join(self.target_dir, filename)):
+                return True
+        return False
+
+    def _store(self, result):
+        """
+        Writes the document and returns (filename, sha256). The manifest is
+        only updated once every format of the invoice was stored.
+        """
+        uuid = result.invoice["numeroUuid"]
+        filename = "{}.{}".format(uuid, result.format)
+        atomic_write(os.path.join(self.target_dir, filename), result.content)
+        return filename, hashlib.sha256(result.content).hexdigest()
+
+    def _list_failed(self, since, type_fel):
+        """
+        Lists again the failed invoices issued before since, querying only
+        the days they were issued.
+        """
+        failed = self.manifest["failed"]
+        days = {
+            day
+            for day in failed.values()
+            if day is not None and day < since.isoformat()
+        }
+        invoices = []
+        for day in sorted(days):
+            date = datetime.date.fromisoformat(day)
+            filters = SATFELFilters(0, EstadoDTE.TODOS, date, date, type_fel)
+            for invoice in self.downloader.get_invoices_with_filters(filters):
+                if invoice["numeroUuid"] in failed:
+                    invoices.append(invoice)
+        return invoices
+
+    def run(self, since=None, until=None):
+        if since is None:
+            if self.watermark is None:
+                raise ValueError(
+                    "There is no watermark in {}, please provide since".format(
+                        self.manifest_path
+                    )
+                )
+            since = self.watermark - datetime.timedelta(days=self.lookback_days)
+        until = until or datetime.date.today()
+        type_fel = TypeFEL.RECIBIDA if self.received else TypeFEL.EMITIDA
+        filters = SATFELFilters(0, EstadoDTE.TODOS, since, until, type_fel)
+        invoices = self.downloader.get_invoices_with_filters(filters)
+        logging.info("Sync got %s invoices from %s to %s", len(invoices), since, until)
+        invoices += self._list_failed(since, type_fel)
+        listed = {invoice["numeroUuid"] for invoice in invoices}
+        for uuid, day in list(self.manifest["failed"].items()):
+            # Its day was queried again, SAT doesn't have it anymore
+            if uuid not in listed and day is not None and day <= until.isoformat():
+                logging.warning("%s is not listed anymore, not retrying it", uuid)
+                del self.manifest["failed"][uuid]
+
+        report = SyncReport([], [], [], [])
+        pending = []
+        for invoice in invoices:
+            uuid = invoice["numeroUuid"]
+            if not self._needs_download(invoice):
+                report.unchanged.append(uuid)
+                continue
+            if uuid in self.manifest["invoices"]:
+                report.changed.append(uuid)
+            else:
+                report.new.append(uuid)
+            pending.append(invoice)
+
+        failed = set()
+        # numeroUuid -> {format: (filename, sha256)} of the stored documents
+        stored = {}
+        results = self.downloader.download_many(
+            pending, formats=self.formats, workers=self.workers, received=self.received
+        )
+        for result in results:
+            uuid = result.invoice["numeroUuid"]
+            if result.ok and not is_valid_document(result.format, result.content):
+                logging.warning("Got an invalid %s for %s", result.format, uuid)
+            elif result.ok:
+                stored.setdefault(uuid, {})[result.format] = self._store(result)
+                continue
+            failed.add(uuid)
+
+        for invoice in pending:
+            uuid = invoice["numeroUuid"]
+            documents = stored.get(uuid, {})
+            if uuid in failed or len(documents) != len(self.formats):
+                failed.add(uuid)
+                self.manifest["failed"][uuid] = _issue_day(invoice)
+                continue
+            self.manifest["failed"].pop(uuid, None)
+            entry = self.manifest["invoices"].setdefault(
+                uuid, {"status": None, "date": None, "files": {}, "hash": {}}
+            )
+            for filetype, (filename, digest) in documents.items():
+                entry["files"][filetype] = filename
+                entry["hash"][filetype] = digest
+            entry["status"] = _status_value(invoice)
+            entry["date"] = invoice.get("fechaEmision")
+        report.failed = sorted(failed)
+        report.new = [uuid for uuid in report.new if uuid not in failed]
+        report.changed = [uuid for uuid in report.changed if uuid not in failed]
+        if self.watermark is None or until > self.watermark:
+            self.manifest["watermark"] = until.isoformat()
+        self._save_manifest()
+        return report
+
+
+def is_valid_document(filetype, content):
+    """
+    Checks that content looks like a document of filetype and not an empty
+    body or an error page.
+    """
+    if not isinstance(content, bytes) or not content:
+        return False
+    if filetype == "pdf":
+        return content.startswith(b"%PDF")
+    return content.lstrip().startswith(b"<")
+
+
+def _issue_day(invoice):
+    issued = parse_listing_date(invoice.get("fechaEmision"))
+    return issued.date().isoformat() if issued is not None else None
+
+
+def _status_value(invoice):
+    status = get_invoice_status(invoice)
+    return status.value if status is not None else None
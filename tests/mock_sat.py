@@ -0,0 +1,484 @@
+import os
+import json
+import time
+import uuid
+import base64
+import random
+import datetime
+import threading
+from collections import Counter
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+"""
+Local stand-in for the SAT endpoints used by the downloader, with
+configurable latency and error rates and synthetic invoices, so the whole
+flow (login, menu, listing, documents and contingency PDFs) can be tested
+and measured without real credentials.
+
+    with MockSAT(invoices_per_day=20) as sat:
+        downloader = SATDownloader(request_session=sat.session())
+        downloader.setCredentials(SatCredentials(sat.username, sat.password))
+"""
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+SAT_HOSTS = ("farm3.sat.gob.gt", "felcons.c.sat.gob.gt", "felav02.c.sat.gob.gt")
+LOGIN_PATH = "/menu/init.do"
+HOME_PATH = "/menu-agenciaVirtual/private/home.jsf"
+FEL_PATH = "/dte-agencia-virtual/dte-consulta"
+API_PATH = "/dte-agencia-virtual/api/"
+CONTINGENCY_PATH = "/verificador-rest/rest/publico/descargapdf"
+DAY_START = datetime.datetime(1, 1, 1, 8, 0)
+
+_DTE = """<?xml version="1.0" encoding="UTF-8"?>
+<dte:GTDocumento xmlns:dte="http://www.sat.gob.gt/dte/fel/0.2.0" Version="0.1">
+  <dte:SAT ClaseDocumento="dte">
+    <dte:DTE ID="DatosCertificados">
+      <dte:DatosEmision ID="DatosEmision">
+        <dte:DatosGenerales CodigoMoneda="GTQ" FechaHoraEmision="{date}" Tipo="FACT"/>
+        <dte:Emisor AfiliacionIVA="GEN" CodigoEstablecimiento="{establishment}" CorreoEmisor="ventas@ejemplo.com.gt" NITEmisor="{issuer}" NombreComercial="COMERCIAL {issuer}" NombreEmisor="EMISOR {issuer}, S.A.">
+          <dte:DireccionEmisor>
+            <dte:Direccion>5 AVENIDA 5-55 ZONA 1</dte:Direccion>
+            <dte:CodigoPostal>01001</dte:CodigoPostal>
+            <dte:Municipio>GUATEMALA</dte:Municipio>
+            <dte:Departamento>GUATEMALA</dte:Departamento>
+            <dte:Pais>GT</dte:Pais>
+          </dte:DireccionEmisor>
+        </dte:Emisor>
+        <dte:Receptor CorreoReceptor="compras@cliente.com.gt" IDReceptor="{receiver}" NombreReceptor="RECEPTOR {receiver}"/>
+        <dte:Items>
+{items}
+        </dte:Items>
+        <dte:Totales>
+          <dte:TotalImpuestos>
+            <dte:TotalImpuesto NombreCorto="IVA" TotalMontoImpuesto="{tax:.2f}"/>
+          </dte:TotalImpuestos>
+          <dte:GranTotal>{total:.2f}</dte:GranTotal>
+        </dte:Totales>
+      </dte:DatosEmision>
+      <dte:Certificacion>
+        <dte:NITCertificador>16693949</dte:NITCertificador>
+        <dte:NumeroAutorizacion Numero="{number}" Serie="{serie}">{uuid}</dte:NumeroAutorizacion>
+        <dte:FechaHoraCertificacion>{date}</dte:FechaHoraCertificacion>
+      </dte:Certificacion>
+    </dte:DTE>
+  </dte:SAT>
+</dte:GTDocumento>
+"""
+_ITEM = """          <dte:Item BienOServicio="B" NumeroLinea="{line}">
+            <dte:Cantidad>{quantity}</dte:Cantidad>
+            <dte:Descripcion>PRODUCTO {line}</dte:Descripcion>
+            <dte:PrecioUnitario>{price:.2f}</dte:PrecioUnitario>
+            <dte:Precio>{amount:.2f}</dte:Precio>
+            <dte:Descuento>0.00</dte:Descuento>
+            <dte:Total>{amount:.2f}</dte:Total>
+          </dte:Item>"""
+
+
+def _read_fixture(name):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+class MockSAT:
+    """
+    Serves synthetic invoices from start, invoices_per_day every day.
+
+    latency seconds are added to every request and error_rate of them are
+    answered with a 503. contingency_rate of the invoices answer 500 on
+    consulta-dte/pdf, so their PDF comes from the contingency verifier.
+    void_rate of the invoices are voided (estado "I"). With token_ttl the
+    ACCESS_TOKEN is rejected with a 401 that many seconds after login.
+    accounts maps more usernames to their passwords, they all see the same
+    invoices.
+    """
+
+    username = "11111111"
+    password = "secret"
+
+    def __init__(
+        self,
+        invoices_per_day=10,
+        start=datetime.date(2021, 1, 1),
+        lines_per_invoice=5,
+        pdf_size=30 * 1024,
+        latency=0,
+        error_rate=0,
+        contingency_rate=0,
+        void_rate=0,
+        token_ttl=None,
+        seed=0,
+        accounts=None,
+    ):
+        self.invoices_per_day = invoices_per_day
+        self.start = start
+        self.lines_per_invoice = lines_per_invoice
+        self.pdf_size = pdf_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.contingency_rate = contingency_rate
+        self.void_rate = void_rate
+        self.token_ttl = token_ttl
+        self.seed = seed
+        self.accounts = {self.username: self.password}
+        self.accounts.update(accounts or {})
+        self.requests = Counter()
+        self._random = random.Random(seed)
+        self._tokens = {}
+        self._sessions = set()
+        # numeroUuid -> (header, day, index, contingency) of the listed invoices
+        self._listed = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start_server()
+        return self
+
+    def __exit__(self, *args):
+        self.stop_server()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return "http://{}:{}".format(host, port)
+
+    def start_server(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,), daemon=True
+        )
+        self._thread.start()
+
+    def stop_server(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def async_client(self, **kwargs):
+        """
+        Returns an httpx.AsyncClient sending the requests for the SAT hosts to
+        this server.
+        """
+        import httpx
+
+        return httpx.AsyncClient(
+            transport=MockSATTransport(self.url), follow_redirects=True, **kwargs
+        )
+
+    def session(self, session=None):
+        """
+        Returns session (a new requests.Session by default) sending the
+        requests for the SAT hosts to this server.
+        """
+        session = session or requests.Session()
+        adapter = MockSATAdapter(self.url)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    # Synthetic data
+
+    def _invoice_random(self, day, index):
+        return random.Random("{}-{}-{}".format(self.seed, day.toordinal(), index))
+
+    def headers_for_day(self, day):
+        headers = []
+        if day < self.start:
+            return headers
+        for index in range(self.invoices_per_day):
+            rng = self._invoice_random(day, index)
+            code = uuid.UUID(int=rng.getrandbits(128)).hex.upper()
+            number = "{}-{}-{}-{}-{}".format(
+                code[:8], code[8:12], code[12:16], code[16:20], code[20:]
+            )
+            issued = DAY_START + datetime.timedelta(minutes=index)
+            header = {
+                "numeroUuid": number,
+                "serie": code[:8],
+                "numeroDte": str(rng.randrange(10**9, 10**10)),
+                "fechaEmision": "{}T{}-06:00".format(
+                    day.isoformat(), issued.time().isoformat()
+                ),
+                "nitEmisor": str(rng.randrange(10**6, 10**8)),
+                "nitReceptor": self.username,
+                "establecimiento": rng.randrange(1, 4),
+                "granTotal": self._amounts(day, index)[1],
+                "estado": "I" if rng.random() < self.void_rate else "V",
+            }
+            contingency = rng.random() < self.contingency_rate
+            with self._lock:
+                self._listed[number] = (header, day, index, contingency)
+            headers.append(header)
+        return headers
+
+    def _amounts(self, day, index):
+        rng = self._invoice_random(day, -index - 1)
+        items = []
+        for line in range(1, self.lines_per_invoice + 1):
+            quantity = rng.randrange(1, 10)
+            price = rng.randrange(100, 100000) / 100
+            items.append((line, quantity, price, round(quantity * price, 2)))
+        return items, round(sum(item[3] for item in items), 2)
+
+    def headers(self, since, until):
+        headers = []
+        day = since
+        while day <= until:
+            headers.extend(self.headers_for_day(day))
+            day += datetime.timedelta(days=1)
+        return headers
+
+    def dte_xml(self, header):
+        _, day, index, _ = self._listed[header["numeroUuid"]]
+        items, total = self._amounts(day, index)
+        xml = _DTE.format(
+            date=header["fechaEmision"],
+            establishment=header["establecimiento"],
+            issuer=header["nitEmisor"],
+            receiver=header["nitReceptor"],
+            items="\n".join(
+                _ITEM.format(line=line, quantity=quantity, price=price, amount=amount)
+                for line, quantity, price, amount in items
+            ),
+            tax=round(total / 1.12 * 0.12, 2),
+            total=total,
+            number=header["numeroDte"],
+            serie=header["serie"],
+            uuid=header["numeroUuid"],
+        )
+        return xml.encode("utf-8")
+
+    def pdf(self, header):
+        start = "%PDF-1.4\n% {}\n".format(header["numeroUuid"]).encode("ascii")
+        return start + b"0" * max(0, self.pdf_size - len(start)) + b"\n%%EOF\n"
+
+    # Requests
+
+    def _new_token(self):
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._tokens[token] = time.monotonic()
+        return token
+
+    def expire_tokens(self):
+        """
+        Expires the ACCESS_TOKEN of the FEL pages, the login is still valid.
+        """
+        with self._lock:
+            self._tokens.clear()
+
+    def expire_sessions(self):
+        """
+        Expires the logins too, the FEL page redirects to the login page.
+        """
+        with self._lock:
+            self._tokens.clear()
+            self._sessions.clear()
+
+    def _new_session(self):
+        session = uuid.uuid4().hex
+        with self._lock:
+            self._sessions.add(session)
+        return session
+
+    def _valid_session(self, headers):
+        cookies = SimpleCookie(headers.get("Cookie") or "")
+        session = cookies.get("JSESSIONID")
+        with self._lock:
+            return session is not None and session.value in self._sessions
+
+    def _valid_token(self, headers):
+        value = headers.get("authtoken") or ""
+        token = value[len("token ") :]
+        with self._lock:
+            issued = self._tokens.get(token)
+        if issued is None:
+            return False
+        return self.token_ttl is None or time.monotonic() - issued <= self.token_ttl
+
+    def handle(self, method, path, query, headers, body):
+        """
+        Returns (status, headers, body) for a request.
+        """
+        endpoint = path
+        if path.startswith(API_PATH):
+            endpoint = API_PATH + path[len(API_PATH) :].split("/")[0]
+            if path.endswith("/xml") or path.endswith("/pdf"):
+                endpoint = path
+        with self._lock:
+            self.requests[endpoint] += 1
+            failed = self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            return 503, {}, b"Service Unavailable"
+
+        if path == LOGIN_PATH:
+            form = parse_qs(body.decode("utf-8"))
+            if form.get("operacion") == ["CANCELAR"]:
+                return 200, {}, b""
+            login = form.get("login", [None])[0]
+            valid = login in self.accounts and form.get("password") == [
+                self.accounts[login]
+            ]
+            if not valid:
+                return 200, {}, _read_fixture("invalid_login.html")
+            cookie = "JSESSIONID={}; Domain=sat.gob.gt; Path=/".format(
+                self._new_session()
+            )
+            return 200, {"Set-Cookie": cookie}, _read_fixture("valid_login.html")
+        if path == HOME_PATH:
+            return (
+                200,
+                {"Content-Type": "text/xml"},
+                _read_fixture("valid_get_menu.xml"),
+            )
+        if path == FEL_PATH:
+            if not self._valid_session(headers):
+                return 302, {"Location": "https://" + SAT_HOSTS[0] + LOGIN_PATH}, b""
+            cookie = "ACCESS_TOKEN={}; Path=/".format(self._new_token())
+            return 200, {"Set-Cookie": cookie}, b"<html></html>"
+        if path == CONTINGENCY_PATH:
+            invoice = json.loads(body)
+            listed = self._find(invoice["autorizacion"])
+            if listed is None:
+                return 404, {}, b""
+            encoded = base64.b64encode(self.pdf(listed[0])).decode("ascii")
+            return (
+                200,
+                {"Content-Type": "application/json"},
+                json.dumps([encoded]).encode(),
+            )
+
+        if not path.startswith(API_PATH):
+            return 404, {}, b""
+        if not self._valid_token(headers):
+            return 401, {}, b""
+        if path == API_PATH + "consulta-dte":
+            since = datetime.datetime.strptime(query["fechaEmisionIni"][0], "%d-%m-%Y")
+            until = datetime.datetime.strptime(
+                query["fechaEmisionFinal"][0], "%d-%m-%Y"
+            )
+            data = self.headers(since.date(), until.date())
+            content = json.dumps({"detalle": {"data": data}}).encode("utf-8")
+            return 200, {"Content-Type": "application/json"}, content
+        if path == API_PATH + "catalogo/establecimientos":
+            content = json.dumps([{"codigo": 1, "nombre": "PRINCIPAL"}]).encode()
+            return 200, {"Content-Type": "application/json"}, content
+        for filetype in ("xml", "pdf"):
+            if path == API_PATH + "consulta-dte/" + filetype:
+                invoices = json.loads(body)
+                listed = self._find(invoices[0]["numeroUuid"])
+                if listed is None:
+                    return 404, {}, b""
+                header, _, _, contingency = listed
+                if filetype == "pdf" and contingency:
+                    return 500, {}, b""
+                if filetype == "xml":
+                    content = self.dte_xml(header)
+                else:
+                    content = self.pdf(header)
+                disposition = 'attachment; filename="{}.{}"'.format(
+                    header["numeroUuid"], filetype
+                )
+                return 200, {"Content-Disposition": disposition}, content
+        return 404, {}, b""
+
+    def _find(self, number):
+        # Like SAT, only the invoices that were listed can be downloaded
+        with self._lock:
+            listed = self._listed.get(number)
+        return listed
+
+
+def _handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _respond(self):
+            parts = urlsplit(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            status, headers, content = mock.handle(
+                self.command, parts.path, parse_qs(parts.query), self.headers, body
+            )
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        do_GET = _respond
+        do_POST = _respond
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class MockSATAdapter(HTTPAdapter):
+    """
+    Sends the requests for the SAT hosts to base_url, keeping the original
+    URL in the response so cookies and redirects work as with SAT.
+    """
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        if parts.hostname not in SAT_HOSTS:
+            return super().send(request, **kwargs)
+        original_url = request.url
+        mocked = request.copy()
+        mocked.url = (
+            self.base_url + parts.path + ("?" + parts.query if parts.query else "")
+        )
+        response = super().send(mocked, **kwargs)
+        response.url = original_url
+        response.request = request
+        return response
+
+
+class MockSATTransport:
+    """
+    httpx version of MockSATAdapter.
+    """
+
+    def __init__(self, base_url):
+        import httpx
+
+        self.base_url = httpx.URL(base_url)
+        self._transport = httpx.AsyncHTTPTransport()
+
+    async def __aenter__(self):
+        await self._transport.__aenter__()
+        return self
+
+    async def __aexit__(self, *args):
+        await self._transport.__aexit__(*args)
+
+    async def handle_async_request(self, request):
+        original_url = request.url
+        if original_url.host not in SAT_HOSTS:
+            return await self._transport.handle_async_request(request)
+        request.url = original_url.copy_with(
+            scheme=self.base_url.scheme,
+            host=self.base_url.host,
+            port=self.base_url.port,
+        )
+        try:
+            return await self._transport.handle_async_request(request)
+        finally:
+            request.url = original_url
+
+    async def aclose(self):
+        await self._transport.aclose()
@@ -0,0 +1,114 @@
+import asyncio
+import datetime
+import unittest
+from sat_gt_fel_invoices_downloader.models import (
+    EstadoDTE,
+    SatCredentials,
+    SATFELFilters,
+    TypeFEL,
+)
+from .mock_sat import CONTINGENCY_PATH, LOGIN_PATH, MockSAT
+
+try:
+    import httpx
+    from sat_gt_fel_invoices_downloader.async_downloader import AsyncSATDownloader
+except ImportError:
+    httpx = None
+
+FILTERS = SATFELFilters(
+    0,
+    EstadoDTE.TODOS,
+    datetime.date(2021, 1, 1),
+    datetime.date(2021, 1, 10),
+    TypeFEL.RECIBIDA,
+)
+
+
+@unittest.skipIf(httpx is None, "httpx is not installed")
+class TestAsyncSATDownloader(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.sat = MockSAT(invoices_per_day=2)
+        self.sat.start_server()
+        self.addCleanup(self.sat.stop_server)
+
+    def make_downloader(self, password=MockSAT.password):
+        downloader = AsyncSATDownloader(self.sat.async_client())
+        return downloader.setCredentials(SatCredentials(self.sat.username, password))
+
+    async def test_login_and_logout(self):
+        async with self.make_downloader() as downloader:
+            await downloader.initialize()
+            self.assertTrue(downloader.its_initialized)
+            self.assertIsNotNone(downloader.client.cookies.get("ACCESS_TOKEN"))
+            await downloader.logout()
+            self.assertFalse(downloader.its_initialized)
+            self.assertIsNone(downloader.view_state)
+        # The login and the cancel request of the logout
+        self.assertEqual(self.sat.requests[LOGIN_PATH], 2)
+
+    async def test_invalid_credentials(self):
+        async with self.make_downloader(password="wrong") as downloader:
+            with self.assertRaises(ValueError):
+                await downloader.initialize()
+
+    async def test_list_and_download(self):
+        async with self.make_downloader() as downloader:
+            invoices = await downloader.get_invoices_with_filters(FILTERS)
+            self.assertEqual(len(invoices), 20)
+            xml = await downloader.get_xml_content(invoices[0])
+            self.assertTrue(xml.startswith(b"<?xml"))
+            pdf = await downloader.get_pdf_content(invoices[0])
+            self.assertTrue(pdf.startswith(b"%PDF"))
+            model = await downloader.get_invoice_model(invoices[0])
+            self.assertEqual(model.fel_signature, invoices[0]["numeroUuid"])
+
+    async def test_contingency_pdf(self):
+        self.sat.contingency_rate = 1
+        async with self.make_downloader() as downloader:
+            invoices = await downloader.get_invoices_with_filters(FILTERS)
+            pdf = await downloader.get_pdf_content(invoices[0])
+            self.assertTrue(pdf.startswith(b"%PDF"))
+        self.assertEqual(self.sat.requests[CONTINGENCY_PATH], 1)
+
+    async def test_download_many(self):
+        async with self.make_downloader() as downloader:
+            invoices = await downloader.get_invoices_with_filters(FILTERS)
+            results = [
+                result
+                async for result in downloader.download_many(
+                    invoices, formats=("xml", "pdf", "model"), concurrency=4
+                )
+            ]
+        self.assertEqual(len(results), 60)
+        self.assertTrue(all(result.ok for result in results), results)
+        uuids = {r.invoice["numeroUuid"] for r in results if r.format == "pdf"}
+        self.assertEqual(uuids, {invoice["numeroUuid"] for invoice in invoices})
+
+    async def test_stopping_early_cancels_downloads(self):
+        async with self.make_downloader() as downloader:
+            invoices = await downloader.get_invoices_with_filters(FILTERS)
+            self.sat.latency = 0.2
+            results = downloader.download_many(invoices, concurrency=8)
+            self.assertTrue((await results.__anext__()).ok)
+            await results.aclose()
+            self.assertEqual(asyncio.all_tasks(), {asyncio.current_task()})
+
+    async def test_unknown_formats(self):
+        async with self.make_downloader() as downloader:
+            with self.assertRaises(ValueError):
+                async for _ in downloader.download_many([{}], formats=("document",)):
+                    pass
+
+    async def test_failed_documents_are_not_ok(self):
+        unknown = {"numeroUuid": "00000000-0000-0000-0000-000000000000"}
+        async with self.make_downloader() as downloader:
+            results = [
+                result
+                async for result in downloader.download_many(
+                    [unknown], formats=("xml", "pdf")
+                )
+            ]
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertFalse(result.ok)
+            self.assertIsInstance(result.error, httpx.HTTPStatusError)
@@ -0,0 +1,39 @@
+import io
+import unittest
+import zipfile
+from sat_gt_fel_invoices_downloader.batch import split_batch_response
+
+DOCUMENT = (
+    '<dte:GTDocumento xmlns:dte="http://www.sat.gob.gt/dte/fel/0.2.0">'
+    "<dte:SAT><dte:DTE><dte:Certificacion>"
+    '<dte:NumeroAutorizacion Numero="1" Serie="A">{}</dte:NumeroAutorizacion>'
+    "</dte:Certificacion></dte:DTE></dte:SAT></dte:GTDocumento>"
+)
+
+
+class TestSplitBatchResponse(unittest.TestCase):
+    def test_split_zip(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as zip_file:
+            zip_file.writestr("AAA-111.pdf", b"%PDF-1")
+            zip_file.writestr("bbb-222.pdf", b"%PDF-2")
+        documents = split_batch_response(
+            buffer.getvalue(), ["aaa-111", "BBB-222", "CCC-333"]
+        )
+        self.assertEqual(documents, {"aaa-111": b"%PDF-1", "BBB-222": b"%PDF-2"})
+
+    def test_split_xml(self):
+        content = "<Documentos>{}{}</Documentos>".format(
+            DOCUMENT.format("AAA-111"), DOCUMENT.format("BBB-222")
+        ).encode()
+        documents = split_batch_response(content, ["AAA-111", "BBB-222"])
+        self.assertEqual(set(documents), {"AAA-111", "BBB-222"})
+        self.assertIn(b"AAA-111", documents["AAA-111"])
+        self.assertNotIn(b"BBB-222", documents["AAA-111"])
+
+    def test_unknown_content(self):
+        self.assertEqual(split_batch_response(b"%PDF-1", ["AAA-111"]), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
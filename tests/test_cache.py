@@ -0,0 +1,99 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from sat_gt_fel_invoices_downloader.cache import DirectoryCache, MemoryCache
+
+
+class TestDirectoryCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_put_and_get(self):
+        cache = DirectoryCache(self.path)
+        cache.put("abcd-1234", "xml", b"<xml/>")
+        self.assertEqual(cache.get("ABCD-1234", "xml"), b"<xml/>")
+        self.assertIsNone(cache.get("abcd-1234", "pdf"))
+        self.assertTrue(os.path.isfile(os.path.join(self.path, "AB", "ABCD-1234.xml")))
+
+    def test_invalidate(self):
+        cache = DirectoryCache(self.path)
+        cache.put("abcd-1234", "xml", b"<xml/>")
+        cache.put("abcd-1234", "pdf", b"%PDF")
+        cache.put("abcd-5678", "pdf", b"%PDF")
+        cache.invalidate("abcd-1234")
+        self.assertIsNone(cache.get("abcd-1234", "xml"))
+        self.assertIsNone(cache.get("abcd-1234", "pdf"))
+        self.assertEqual(cache.get("abcd-5678", "pdf"), b"%PDF")
+        self.assertEqual(cache.size(), 4)
+
+    def test_evicts_least_recently_used(self):
+        cache = DirectoryCache(self.path, max_bytes=20)
+        cache.put("aa-1", "xml", b"1" * 8)
+        cache.put("bb-2", "xml", b"2" * 8)
+        past = time.time() - 60
+        os.utime(os.path.join(self.path, "AA", "AA-1.xml"), (past, past))
+        os.utime(os.path.join(self.path, "BB", "BB-2.xml"), (past - 60, past - 60))
+        cache.get("bb-2", "xml")
+        cache.put("cc-3", "xml", b"3" * 8)
+        self.assertIsNone(cache.get("aa-1", "xml"))
+        self.assertIsNotNone(cache.get("bb-2", "xml"))
+        self.assertIsNotNone(cache.get("cc-3", "xml"))
+        self.assertLessEqual(cache.size(), 20)
+
+    def test_evicts_below_the_limit(self):
+        cache = DirectoryCache(self.path, max_bytes=100)
+        for i in range(10):
+            cache.put("{:02d}-1".format(i), "xml", b"1" * 10)
+        with mock.patch.object(cache, "_entries", wraps=cache._entries) as entries:
+            cache.put("10-1", "xml", b"1" * 10)
+            self.assertLessEqual(cache.size(), 90)
+            # The space freed fits the next put without scanning again
+            cache.put("11-1", "xml", b"1" * 10)
+        self.assertEqual(entries.call_count, 1)
+        self.assertLessEqual(cache.size(), 100)
+
+
+class TestMemoryCache(unittest.TestCase):
+    def test_evicts_least_recently_used_by_bytes(self):
+        cache = MemoryCache(max_bytes=20)
+        cache.put("aa-1", "xml", b"1" * 8)
+        cache.put("bb-2", "xml", b"2" * 8)
+        self.assertEqual(cache.get("AA-1", "xml"), b"1" * 8)
+        cache.put("cc-3", "pdf", b"3" * 8)
+        self.assertIsNone(cache.get("bb-2", "xml"))
+        self.assertEqual(cache.size(), 16)
+        cache.put("dd-4", "pdf", b"4" * 21)
+        self.assertIsNone(cache.get("dd-4", "pdf"))
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl(self):
+        now = [0]
+        cache = MemoryCache(ttl=10, clock=lambda: now[0])
+        cache.put("aa-1", "xml", b"<xml/>")
+        now[0] = 10
+        self.assertEqual(cache.get("aa-1", "xml"), b"<xml/>")
+        now[0] = 11
+        self.assertIsNone(cache.get("aa-1", "xml"))
+        self.assertEqual(cache.size(), 0)
+
+    def test_backend(self):
+        with tempfile.TemporaryDirectory() as path:
+            backend = DirectoryCache(path)
+            backend.put("aa-1", "pdf", b"%PDF")
+            cache = MemoryCache(backend=backend)
+            self.assertEqual(cache.get("aa-1", "pdf"), b"%PDF")
+            self.assertEqual(len(cache), 1)
+            cache.put("bb-2", "xml", b"<xml/>")
+            self.assertEqual(backend.get("bb-2", "xml"), b"<xml/>")
+            cache.invalidate("aa-1")
+            self.assertIsNone(cache.get("aa-1", "pdf"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import os
+import unittest
+from sat_gt_fel_invoices_downloader import parse_invoice_xml
+from sat_gt_fel_invoices_downloader.columnar import InvoiceColumns
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "valid_dte.xml")
+
+
+class TestInvoiceColumns(unittest.TestCase):
+    def setUp(self):
+        with open(FIXTURE, "rb") as f:
+            self.content = f.read()
+
+    def test_add_xml_matches_add_invoice(self):
+        from_xml = InvoiceColumns()
+        from_xml.add_xml(self.content)
+        from_model = InvoiceColumns()
+        from_model.add_invoice(parse_invoice_xml(self.content))
+        for name, table in from_xml.tables().items():
+            self.assertEqual(
+                list(table.rows()), list(from_model.tables()[name].rows()), name
+            )
+
+    def test_columns(self):
+        columns = InvoiceColumns()
+        columns.add_xml(self.content)
+        self.assertEqual(len(columns), 1)
+        self.assertEqual(len(columns.lines), 2)
+        self.assertEqual(sum(columns.lines.columns["total"]), 140.0)
+        self.assertEqual(columns.lines.columns["total"].typecode, "d")
+        self.assertEqual(list(columns.taxes.columns["tax_name"]), ["IVA"])
+
+
+if __name__ == "__main__":
+    unittest.main()
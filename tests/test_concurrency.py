@@ -0,0 +1,118 @@
+import datetime
+import itertools
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from sat_gt_fel_invoices_downloader.concurrency import SingleFlight, bounded_map
+from sat_gt_fel_invoices_downloader.main import SATDownloader
+from sat_gt_fel_invoices_downloader.models import EstadoDTE, SATFELFilters, TypeFEL
+
+
+class FakeFelDownloader:
+    def __init__(self):
+        self.windows = []
+
+    def get_window(self, filter, max_results=None):
+        self.windows.append(filter.fechaInicio)
+        return [{"numeroUuid": "A"}, {"numeroUuid": str(filter.fechaInicio)}]
+
+
+class TestBoundedMap(unittest.TestCase):
+    def test_keeps_order_and_reads_input_lazily(self):
+        consumed = []
+
+        def numbers():
+            for i in itertools.count():
+                consumed.append(i)
+                yield i
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = bounded_map(executor, lambda x: x * 2, numbers(), 3)
+            self.assertEqual([next(results) for _ in range(5)], [0, 2, 4, 6, 8])
+            results.close()
+        # The fifth result and 3 tasks ahead of it
+        self.assertEqual(len(consumed), 8)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_shares_calls_in_flight(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return len(calls)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            first = executor.submit(flight.do, "A", slow)
+            started.wait(5)
+            others = [executor.submit(flight.do, "A", slow) for _ in range(3)]
+            other_key = flight.do("B", lambda: "B")
+            release.set()
+            self.assertEqual([f.result() for f in [first] + others], [1] * 4)
+        self.assertEqual(other_key, "B")
+        self.assertEqual(flight.do("A", slow), 2)
+
+    def test_shares_errors(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        waiting = threading.Semaphore(0)
+        calls = []
+
+        def fail():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            raise KeyError("A")
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            leader = executor.submit(flight.do, "A", fail)
+            started.wait(5)
+            # Counts the followers that are waiting for the leader
+            future = flight._calls["A"]
+            result = future.result
+
+            def wait_result(*args, **kwargs):
+                waiting.release()
+                return result(*args, **kwargs)
+
+            future.result = wait_result
+            followers = [executor.submit(flight.do, "A", fail) for _ in range(3)]
+            for _ in followers:
+                self.assertTrue(waiting.acquire(timeout=5))
+            release.set()
+            errors = []
+            for f in [leader] + followers:
+                with self.assertRaises(KeyError):
+                    f.result()
+                errors.append(f.exception())
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(error is errors[0] for error in errors))
+        self.assertEqual(flight.do("A", lambda: 1), 1)
+
+
+class TestIterInvoices(unittest.TestCase):
+    def test_iter_invoices(self):
+        fel = FakeFelDownloader()
+        downloader = SATDownloader()
+        downloader._get_downloader = lambda: fel
+        filters = SATFELFilters(
+            0,
+            EstadoDTE.TODOS,
+            datetime.date(2021, 1, 1),
+            datetime.date(2021, 1, 21),
+            TypeFEL.RECIBIDA,
+        )
+        for prefetch in (0, 2):
+            fel.windows.clear()
+            invoices = list(downloader.iter_invoices(filters, prefetch=prefetch))
+            self.assertEqual(
+                [invoice["numeroUuid"] for invoice in invoices],
+                ["A", "2021-01-01", "2021-01-08", "2021-01-15"],
+            )
+            self.assertEqual(len(fel.windows), 3)
@@ -0,0 +1,108 @@
+import json
+import base64
+import datetime
+import threading
+import unittest
+from sat_gt_fel_invoices_downloader.contingency import ContingencyRouter
+from sat_gt_fel_invoices_downloader.files import iter_decode_base64_json
+from sat_gt_fel_invoices_downloader.main import SATDownloader, iter_check_pdf_signature
+from sat_gt_fel_invoices_downloader.models import (
+    EstadoDTE,
+    SatCredentials,
+    SATFELFilters,
+    TypeFEL,
+)
+from .mock_sat import MockSAT
+from .test_resilience import FakeClock
+
+FILTERS = SATFELFilters(
+    0,
+    EstadoDTE.TODOS,
+    datetime.date(2021, 1, 1),
+    datetime.date(2021, 1, 10),
+    TypeFEL.RECIBIDA,
+)
+PDF_PATH = "/dte-agencia-virtual/api/consulta-dte/pdf"
+CONTINGENCY_PATH = "/verificador-rest/rest/publico/descargapdf"
+
+
+class XmlErrorSAT(MockSAT):
+    def handle(self, method, path, query, headers, body):
+        if path.endswith("/consulta-dte/xml"):
+            return 500, {}, b""
+        return super().handle(method, path, query, headers, body)
+
+
+class TestPdfSignature(unittest.TestCase):
+    def test_small_chunks(self):
+        pdf = b"%PDF-1.4\n" + bytes(range(256))
+        payload = json.dumps([base64.b64encode(pdf).decode()]).encode()
+        for size in (1, 2, 3, 7):
+            chunks = [payload[i : i + size] for i in range(0, len(payload), size)]
+            decoded = iter_check_pdf_signature(iter_decode_base64_json(chunks))
+            self.assertEqual(b"".join(decoded), pdf, size)
+
+    def test_missing_signature(self):
+        for chunks in ([b"<htm", b"l>"], [b"%P"], []):
+            with self.assertRaises(ValueError):
+                list(iter_check_pdf_signature(chunks))
+
+
+class TestContingencyRouter(unittest.TestCase):
+    def test_cool_down(self):
+        clock = FakeClock()
+        router = ContingencyRouter(cool_down=60, failure_threshold=2, clock=clock)
+        router.primary_failed()
+        self.assertTrue(router.use_primary())
+        router.primary_failed()
+        self.assertFalse(router.use_primary())
+        clock.now += 61
+        self.assertTrue(router.use_primary())
+        router.primary_succeeded()
+        router.primary_failed()
+        self.assertTrue(router.use_primary())
+
+    def test_runs_in_its_own_pool(self):
+        router = ContingencyRouter(workers=1)
+        self.addCleanup(router.close)
+        name = router.fetch("a", lambda: threading.current_thread().name)
+        self.assertTrue(name.startswith("contingency"))
+
+    def test_outage_costs_one_request_per_invoice(self):
+        with MockSAT(invoices_per_day=2, contingency_rate=1) as mock:
+            router = ContingencyRouter(failure_threshold=3)
+            downloader = SATDownloader(
+                request_session=mock.session(), contingency=router
+            )
+            downloader.setCredentials(SatCredentials(mock.username, mock.password))
+            invoices = downloader.get_invoices_with_filters(FILTERS)
+            results = list(
+                downloader.download_many(invoices, formats=("pdf",), workers=1)
+            )
+            router.close()
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(mock.requests[PDF_PATH], 3)
+        self.assertEqual(mock.requests[CONTINGENCY_PATH], 20)
+
+    def test_xml_errors_are_not_routed(self):
+        with XmlErrorSAT(invoices_per_day=1) as mock:
+            downloader = SATDownloader(request_session=mock.session())
+            downloader.setCredentials(SatCredentials(mock.username, mock.password))
+            invoices = downloader.get_invoices_with_filters(FILTERS)
+            results = list(downloader.download_many(invoices[:2], formats=("xml",)))
+            downloader.logout()
+        self.assertEqual([result.ok for result in results], [False, False])
+        self.assertEqual(mock.requests[CONTINGENCY_PATH], 0)
+
+    def test_logout_closes_the_pool(self):
+        with MockSAT(invoices_per_day=1, contingency_rate=1) as mock:
+            router = ContingencyRouter()
+            downloader = SATDownloader(
+                request_session=mock.session(), contingency=router
+            )
+            downloader.setCredentials(SatCredentials(mock.username, mock.password))
+            invoices = downloader.get_invoices_with_filters(FILTERS)
+            self.assertTrue(downloader.download_one(invoices[0], "pdf").ok)
+            self.assertIsNotNone(router._executor)
+            downloader.logout()
+        self.assertIsNone(router._executor)
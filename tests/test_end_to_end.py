@@ -0,0 +1,268 @@
+import os
+import datetime
+import hashlib
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+import requests
+from sat_gt_fel_invoices_downloader.cache import MemoryCache
+from sat_gt_fel_invoices_downloader.main import SATDownloader
+from sat_gt_fel_invoices_downloader.models import (
+    EstadoDTE,
+    SatCredentials,
+    SATFELFilters,
+    TypeFEL,
+)
+from sat_gt_fel_invoices_downloader.resilience import ResilientSession
+from .mock_sat import API_PATH, MockSAT, MockSATAdapter
+
+FILTERS = SATFELFilters(
+    0,
+    EstadoDTE.TODOS,
+    datetime.date(2021, 1, 1),
+    datetime.date(2021, 1, 10),
+    TypeFEL.RECIBIDA,
+)
+
+
+def make_downloader(mock, session=None, password=MockSAT.password, cache=None):
+    downloader = SATDownloader(request_session=mock.session(session), cache=cache)
+    return downloader.setCredentials(SatCredentials(mock.username, password))
+
+
+class TestEndToEnd(unittest.TestCase):
+    def test_login_list_and_download(self):
+        with MockSAT(invoices_per_day=3, contingency_rate=0.3) as mock:
+            downloader = make_downloader(mock)
+            invoices = downloader.get_invoices_with_filters(FILTERS)
+            self.assertEqual(len(invoices), 30)
+            results = list(downloader.download_many(invoices, formats=("model", "pdf")))
+            self.assertTrue(all(result.ok for result in results), results)
+            models = [r.content for r in results if r.format == "model"]
+            pdfs = [r.content for r in results if r.format == "pdf"]
+            self.assertEqual(
+                sorted(model.fel_signature for model in models),
+                sorted(invoice["numeroUuid"] for invoice in invoices),
+            )
+            self.assertTrue(all(pdf.startswith(b"%PDF") for pdf in pdfs))
+            self.assertGreater(
+                mock.requests["/verificador-rest/rest/publico/descargapdf"], 0
+            )
+            downloader.logout()
+
+    def test_invalid_credentials(self):
+        with MockSAT() as mock:
+            downloader = make_downloader(mock, password="wrong")
+            with self.assertRaises(ValueError):
+                downloader.initialize()
+
+    def test_streams_to_disk(self):
+        with MockSAT(invoices_per_day=1) as mock, tempfile.TemporaryDirectory() as d:
+            downloader = make_downloader(mock)
+            invoices = downloader.get_invoices_with_filters(FILTERS)
+            results = list(downloader.download_many(invoices, save_in_dir=d))
+            self.assertEqual(len(os.listdir(d)), 20)
+            self.assertTrue(all(result.ok for result in results))
+
+    def test_opens_fel_again_when_token_expires(self):
+        with MockSAT(invoices_per_day=1) as mock:
+            downloader = make_downloader(mock)
+            self.assertEqual(len(downloader.get_invoices_with_filters(FILTERS)), 10)
+            mock.expire_tokens()
+            self.assertEqual(len(downloader.get_invoices_with_filters(FILTERS)), 10)
+            self.assertEqual(mock.requests["/menu/init.do"], 1)
+            self.assertEqual(mock.requests["/dte-agencia-virtual/dte-consulta"], 2)
+
+    def test_logs_in_again_when_session_expires(self):
+        with MockSAT(invoices_per_day=1) as mock:
+            downloader = make_downloader(mock)
+            invoices = downloader.get_invoices_with_filters(FILTERS)
+            mock.expire_sessions()
+            self.assertTrue(
+                downloader.get_xml_content(invoices[0]).startswith(b"<?xml")
+            )
+            self.assertEqual(mock.requests["/menu/init.do"], 2)
+
+    def test_retries_server_errors(self):
+        with MockSAT(invoices_per_day=2, error_rate=0.2, seed=3) as mock:
+            session = ResilientSession(sleep=lambda seconds: None)
+            downloader = make_downloader(mock, session)
+            invoices = list(downloader.iter_invoices(FILTERS, window_days=2))
+            self.assertEqual(len(invoices), 20)
+            models = list(downloader.iter_invoice_models(FILTERS, workers=2))
+            self.assertEqual(len(models), 20)
+
+    def test_invoice_document_downloads_the_xml_once(self):
+        with MockSAT(invoices_per_day=1) as mock, tempfile.TemporaryDirectory() as d:
+            downloader = make_downloader(mock)
+            invoices = downloader.get_invoices_with_filters(FILTERS)
+            document = downloader.get_invoice_document(invoices[0], save_in_dir=d)
+            xml_endpoint = "/dte-agencia-virtual/api/consulta-dte/xml"
+            self.assertEqual(mock.requests[xml_endpoint], 1)
+            self.assertEqual(document.invoice.fel_signature, invoices[0]["numeroUuid"])
+            with open(document.path, "rb") as f:
+                self.assertEqual(f.read(), document.xml)
+            self.assertEqual(document.sha256, hashlib.sha256(document.xml).hexdigest())
+            results = list(
+                downloader.download_many(invoices, formats=("document",), batch_size=5)
+            )
+            self.assertEqual(len(results), 10)
+            self.assertTrue(all(r.content.invoice for r in results))
+
+    def test_summaries_come_from_the_listing(self):
+        with MockSAT(invoices_per_day=2) as mock:
+            downloader = make_downloader(mock)
+            summaries = downloader.get_invoice_summaries(FILTERS)
+            self.assertEqual(len(summaries), 20)
+            self.assertEqual(
+                sum(summary.grand_total for summary in summaries),
+                sum(
+                    header["granTotal"]
+                    for header in mock.headers(FILTERS.fechaInicio, FILTERS.fechaFin)
+                ),
+            )
+            self.assertEqual(summaries[0].receiver_nit, mock.username)
+            streamed = list(downloader.iter_invoice_summaries(FILTERS, window_days=3))
+            self.assertEqual(streamed, summaries)
+            self.assertEqual(
+                mock.requests["/dte-agencia-virtual/api/consulta-dte/xml"], 0
+            )
+
+    def test_memory_cache_shared_by_entry_points(self):
+        with MockSAT(invoices_per_day=1) as mock:
+            downloader = make_downloader(mock, cache=MemoryCache())
+            invoice = downloader.get_invoices_with_filters(FILTERS)[0]
+            model = downloader.get_model(invoice)
+            content = downloader.get_xml_content(invoice)
+            self.assertEqual(model.fel_signature, invoice["numeroUuid"])
+            self.assertTrue(content.startswith(b"<?xml"))
+            xml_endpoint = "/dte-agencia-virtual/api/consulta-dte/xml"
+            self.assertEqual(mock.requests[xml_endpoint], 1)
+
+    def test_concurrent_requests_are_coalesced(self):
+        with MockSAT(invoices_per_day=1, latency=0.2) as mock:
+            downloader = make_downloader(mock)
+            invoice = downloader.get_invoices_with_filters(FILTERS)[0]
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                contents = list(executor.map(downloader.get_pdf_content, [invoice] * 4))
+            self.assertEqual(len(set(contents)), 1)
+            pdf_endpoint = "/dte-agencia-virtual/api/consulta-dte/pdf"
+            self.assertEqual(mock.requests[pdf_endpoint], 1)
+
+    def test_failed_documents_are_not_ok(self):
+        with MockSAT(invoices_per_day=1) as mock:
+            downloader = make_downloader(mock)
+            invoices = downloader.get_invoices_with_filters(FILTERS)[:1]
+            unknown = dict(
+                invoices[0], numeroUuid="00000000-0000-0000-0000-000000000000"
+            )
+            results = list(
+                downloader.download_many(invoices + [unknown], formats=("xml", "pdf"))
+            )
+        failed = [r for r in results if r.invoice is unknown]
+        self.assertEqual(len(failed), 2)
+        for result in failed:
+            self.assertFalse(result.ok)
+            self.assertIsNotNone(result.error)
+            self.assertIsNone(result.content)
+        self.assertTrue(all(r.ok for r in results if r.invoice is not unknown))
+
+    def test_batch_keeps_what_was_downloaded(self):
+        with MockSAT(invoices_per_day=1) as mock:
+            downloader = make_downloader(mock)
+            invoices = downloader.get_invoices_with_filters(FILTERS)[:4]
+            unknown = dict(
+                invoices[0], numeroUuid="00000000-0000-0000-0000-000000000000"
+            )
+            results = list(
+                downloader.download_many(
+                    invoices + [unknown], formats=("xml",), batch_size=5
+                )
+            )
+            xml_endpoint = "/dte-agencia-virtual/api/consulta-dte/xml"
+            # The batch request, then one request for each invoice missing
+            # from its answer
+            self.assertEqual(mock.requests[xml_endpoint], 5)
+        self.assertEqual(len(results), 5)
+        failed = [r for r in results if not r.ok]
+        self.assertEqual([r.invoice for r in failed], [unknown])
+
+
+LIST_PATH = API_PATH + "consulta-dte"
+
+
+class OverlappingSAT(MockSAT):
+    """
+    Answers at most max_results invoices per query, like SAT truncating a
+    big listing, and repeats the first invoice of the period in every answer
+    so merging the windows has to drop it.
+    """
+
+    def __init__(self, max_results=None, **kwargs):
+        super().__init__(**kwargs)
+        self.max_results = max_results
+
+    def headers(self, since, until):
+        headers = super().headers(since, until)
+        if self.max_results is not None:
+            headers = headers[: self.max_results]
+        first = self.headers_for_day(self.start)[0]
+        if first not in headers:
+            headers.append(first)
+        return headers
+
+
+class TimeoutAdapter(MockSATAdapter):
+    """
+    Times out the listings of more than max_days days.
+    """
+
+    def __init__(self, base_url, max_days):
+        super().__init__(base_url)
+        self.max_days = max_days
+
+    def send(self, request, **kwargs):
+        query = parse_qs(urlsplit(request.url).query)
+        if "fechaEmisionIni" in query:
+            since, until = (
+                datetime.datetime.strptime(query[key][0], "%d-%m-%Y")
+                for key in ("fechaEmisionIni", "fechaEmisionFinal")
+            )
+            if (until - since).days + 1 > self.max_days:
+                raise requests.Timeout("Listing timed out")
+        return super().send(request, **kwargs)
+
+
+class TestQueryWindows(unittest.TestCase):
+    def check_invoices(self, mock, invoices):
+        uuids = [invoice["numeroUuid"] for invoice in invoices]
+        self.assertEqual(len(uuids), len(set(uuids)))
+        expected = MockSAT.headers(mock, FILTERS.fechaInicio, FILTERS.fechaFin)
+        self.assertEqual(set(uuids), {header["numeroUuid"] for header in expected})
+
+    def test_splits_truncated_windows(self):
+        with OverlappingSAT(max_results=8, invoices_per_day=3) as mock:
+            downloader = make_downloader(mock)
+            invoices = downloader.get_invoices_with_filters(
+                FILTERS, window_days=5, workers=2, max_results=8
+            )
+            self.check_invoices(mock, invoices)
+            # Both windows of 5 days, and the halves of 3 days they are split
+            # in, are truncated: each costs 5 queries
+            self.assertEqual(mock.requests[LIST_PATH], 10)
+
+    def test_splits_windows_that_time_out(self):
+        with OverlappingSAT(invoices_per_day=3) as mock:
+            session = requests.Session()
+            adapter = TimeoutAdapter(mock.url, max_days=2)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            downloader = SATDownloader(request_session=session)
+            downloader.setCredentials(SatCredentials(mock.username, mock.password))
+            invoices = downloader.get_invoices_with_filters(
+                FILTERS, window_days=5, workers=1
+            )
+            self.check_invoices(mock, invoices)
+            # Only the windows of 2 days or less reached the server
+            self.assertEqual(mock.requests[LIST_PATH], 6)
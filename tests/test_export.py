@@ -0,0 +1,188 @@
+import io
+import os
+import csv
+import json
+import hashlib
+import tarfile
+import zipfile
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+from sat_gt_fel_invoices_downloader import export
+from sat_gt_fel_invoices_downloader.export import ArchiveExporter
+from sat_gt_fel_invoices_downloader.main import SATDownloader
+from sat_gt_fel_invoices_downloader.models import (
+    DownloadResult,
+    EstadoDTE,
+    SatCredentials,
+    SATFELFilters,
+    TypeFEL,
+)
+from .mock_sat import MockSAT
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FILTERS = SATFELFilters(
+    0,
+    EstadoDTE.TODOS,
+    datetime.date(2021, 1, 1),
+    datetime.date(2021, 1, 10),
+    TypeFEL.RECIBIDA,
+)
+
+
+def read_members(path):
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            return {name: archive.read(name) for name in archive.namelist()}
+    if path.endswith(".tar.zst"):
+        with open(path, "rb") as f:
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                f, read_across_frames=True
+            )
+            content = io.BytesIO(reader.read())
+        archive = tarfile.open(fileobj=content)
+    else:
+        archive = tarfile.open(path)
+    with archive:
+        return {
+            member.name: archive.extractfile(member).read()
+            for member in archive.getmembers()
+        }
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptingDownloader(SATDownloader):
+    def __init__(self, after, **kwargs):
+        super().__init__(**kwargs)
+        self.after = after
+        self.calls = 0
+
+    def download_one(self, *args, **kwargs):
+        self.calls += 1
+        if self.calls > self.after:
+            raise Interrupted()
+        return super().download_one(*args, **kwargs)
+
+
+class FailingPdfDownloader(SATDownloader):
+    def download_one(self, invoice, filetype, *args, **kwargs):
+        if filetype == "pdf":
+            return DownloadResult(invoice, filetype, error=ValueError())
+        return super().download_one(invoice, filetype, *args, **kwargs)
+
+
+class TestArchiveExporter(unittest.TestCase):
+    def setUp(self):
+        self.sat = MockSAT(invoices_per_day=2, pdf_size=2048)
+        self.sat.start_server()
+        self.addCleanup(self.sat.stop_server)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def make_downloader(self, cls=SATDownloader, **kwargs):
+        downloader = cls(request_session=self.sat.session(), **kwargs)
+        credentials = SatCredentials(self.sat.username, self.sat.password)
+        return downloader.setCredentials(credentials)
+
+    def check_archive(self, path, index="csv"):
+        members = read_members(path)
+        self.assertEqual(len(members), 41)
+        if index == "csv":
+            text = members["index.csv"].decode("utf-8")
+            rows = list(csv.DictReader(io.StringIO(text)))
+        else:
+            rows = json.loads(members["index.json"])
+        self.assertEqual(len(rows), 20)
+        for row in rows:
+            content = members[row["xml"]]
+            self.assertEqual(hashlib.sha256(content).hexdigest(), row["xml_sha256"])
+            self.assertTrue(members[row["pdf"]].startswith(b"%PDF"))
+        self.assertFalse(os.path.exists(path + ".partial"))
+        self.assertFalse(os.path.exists(path + ".progress"))
+
+    def test_zip(self):
+        path = os.path.join(self.directory, "2021-01.zip")
+        report = self.make_downloader().export_archive(FILTERS, path)
+        self.assertEqual((report.invoices, report.documents), (20, 40))
+        self.assertEqual(report.failed, [])
+        self.check_archive(path)
+        with zipfile.ZipFile(path) as archive:
+            kinds = {
+                info.filename[:3]: info.compress_type for info in archive.infolist()
+            }
+        self.assertEqual(kinds["pdf"], zipfile.ZIP_STORED)
+        self.assertEqual(kinds["xml"], zipfile.ZIP_DEFLATED)
+
+    def test_tar_gz_with_json_index(self):
+        path = os.path.join(self.directory, "2021-01.tar.gz")
+        self.make_downloader().export_archive(FILTERS, path, index="json")
+        self.check_archive(path, index="json")
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_tar_zst(self):
+        path = os.path.join(self.directory, "2021-01.tar.zst")
+        self.make_downloader().export_archive(FILTERS, path)
+        self.check_archive(path)
+
+    def test_resumes_after_interruption(self):
+        for name in ("2021-01.zip", "2021-01.tar.gz"):
+            with self.subTest(name):
+                path = os.path.join(self.directory, name)
+                downloader = self.make_downloader(InterruptingDownloader, after=17)
+                exporter = ArchiveExporter(downloader, path, checkpoint_every=5)
+                with self.assertRaises(Interrupted):
+                    exporter.run(FILTERS)
+                with open(path + ".progress") as f:
+                    saved = len(json.load(f)["members"])
+                self.assertGreater(saved, 0)
+                # Documents written after the last checkpoint are lost, like
+                # in a crash
+                with open(path + ".partial", "ab") as f:
+                    f.write(b"garbage")
+
+                downloader = self.make_downloader(InterruptingDownloader, after=100)
+                report = ArchiveExporter(downloader, path, checkpoint_every=5).run(
+                    FILTERS
+                )
+                self.assertEqual(downloader.calls, 40 - saved)
+                self.assertEqual(report.documents, 40)
+                self.check_archive(path)
+
+    def test_failed_downloads_are_reported(self):
+        path = os.path.join(self.directory, "2021-01.zip")
+        downloader = self.make_downloader(FailingPdfDownloader)
+        report = downloader.export_archive(FILTERS, path)
+        self.assertEqual((report.invoices, report.documents), (20, 20))
+        self.assertEqual(len(report.failed), 20)
+        members = read_members(path)
+        rows = list(csv.DictReader(io.StringIO(members["index.csv"].decode())))
+        self.assertEqual({row["pdf"] for row in rows}, {""})
+
+    def test_unknown_archive(self):
+        with self.assertRaises(ValueError):
+            ArchiveExporter(self.make_downloader(), "2021-01.rar")
+
+    def test_zip_checkpoint_is_synced(self):
+        path = os.path.join(self.directory, "2021-01.zip.partial")
+        writer = export._ZipWriter(path, append=False)
+        writer.add("xml/A.xml", b"<dte/>")
+        with mock.patch.object(export.os, "fsync", wraps=os.fsync) as fsync:
+            offset, tail = writer.checkpoint()
+        fsync.assert_called_once_with(writer._file.fileno())
+        # The checkpoint is a complete zip on disk
+        self.assertEqual(os.path.getsize(path), offset + len(tail))
+        with zipfile.ZipFile(path) as archive:
+            self.assertEqual(archive.read("xml/A.xml"), b"<dte/>")
+        writer.add("pdf/A.pdf", b"%PDF")
+        writer.finish()
+        with zipfile.ZipFile(path) as archive:
+            self.assertEqual(archive.namelist(), ["xml/A.xml", "pdf/A.pdf"])
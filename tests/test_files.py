@@ -0,0 +1,39 @@
+import os
+import json
+import base64
+import tempfile
+import unittest
+from sat_gt_fel_invoices_downloader.files import atomic_open, iter_decode_base64_json
+
+
+def split(content, size):
+    return [content[i : i + size] for i in range(0, len(content), size)]
+
+
+class TestDecodeBase64Json(unittest.TestCase):
+    def test_decodes_in_any_chunk_size(self):
+        pdf = b"%PDF-1.4\n" + bytes(range(256)) * 20
+        payload = json.dumps([base64.b64encode(pdf).decode()]).encode()
+        # Some servers escape the slashes of the base64 alphabet
+        payload = payload.replace(b"/", b"\\/")
+        for size in (1, 2, 3, 5, 7, 64, 1000, len(payload)):
+            decoded = b"".join(iter_decode_base64_json(split(payload, size)))
+            self.assertEqual(decoded, pdf, size)
+
+
+class TestAtomicOpen(unittest.TestCase):
+    def test_removes_temporary_file_on_error(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "invoice.pdf")
+            with self.assertRaises(RuntimeError):
+                with atomic_open(filename) as f:
+                    f.write(b"half")
+                    raise RuntimeError()
+            self.assertEqual(os.listdir(directory), [])
+            with atomic_open(filename, fsync=True) as f:
+                f.write(b"full")
+            self.assertEqual(os.listdir(directory), ["invoice.pdf"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,185 @@
-from sat_gt_fel_invoices_downloader import Address, IssuingModel, Invoice
+from sat_gt_fel_invoices_downloader import Address, EstadoDTE, IssuingModel, Invoice
 import unittest
 import requests
 import datetime
 from unittest import mock
-from sat_gt_fel_invoices_downloader.main import SatCredentials, SatFelDownloader
+from sat_gt_fel_invoices_downloader.main import SatFelDownloader
+from sat_gt_fel_invoices_downloader.parser import (
+    LazyInvoice,
+    parse_datetime,
+    parse_invoice_header,
+    parse_invoice_xml,
+)
+import os.path
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
 
 
 class TestParseXML(unittest.TestCase):
-    pass
+    def setUp(self):
+        self.invoice = parse_invoice_xml(read_fixture("valid_dte.xml"))
+
+    def test_headers(self):
+        headers = self.invoice.headers
+        self.assertEqual(headers.invoice_type, "FACT")
+        self.assertEqual(headers.currency, "GTQ")
+        self.assertEqual(
+            headers.issue_date,
+            datetime.datetime(
+                2021,
+                10,
+                5,
+                10,
+                21,
+                33,
+                tzinfo=datetime.timezone(datetime.timedelta(hours=-6)),
+            ),
+        )
+        self.assertIsInstance(headers.issuer, IssuingModel)
+        self.assertEqual(headers.issuer.nit, "12345678")
+        self.assertEqual(headers.issuer.issuing_name, "EJEMPLO, SOCIEDAD ANONIMA")
+        self.assertEqual(headers.issuer.email, "ventas@ejemplo.com.gt")
+        self.assertEqual(headers.issuer.establishment, "1")
+        self.assertEqual(
+            headers.issuer.address,
+            Address("5 AVENIDA 5-55 ZONA 1", "01001", "GUATEMALA", "GUATEMALA", "GT"),
+        )
+        self.assertEqual(headers.receiver.nit, "87654321")
+        self.assertEqual(headers.receiver.email, "compras@cliente.com.gt")
+
+    def test_lines(self):
+        lines = self.invoice.lines
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0].description, "MARTILLO DE ACERO")
+        self.assertEqual(lines[0].quantity, 2.0)
+        self.assertEqual(lines[1].line_number, 2)
+        self.assertEqual(lines[1].good_or_service, "S")
+        self.assertEqual(lines[1].discount, 2.0)
+        self.assertEqual(lines[1].total, 28.0)
+
+    def test_totals_and_certification(self):
+        self.assertEqual(self.invoice.totals.grand_total, 140.0)
+        self.assertEqual(self.invoice.totals.total_taxes[0].tax_name, "IVA")
+        self.assertEqual(self.invoice.totals.total_taxes[0].tax_total, 15.0)
+        self.assertEqual(
+            self.invoice.fel_signature, "0A1B2C3D-A9DA-4C15-8E7A-6B4D3F2E1C0B"
+        )
+        self.assertEqual(self.invoice.fel_invoice_serie, "0A1B2C3D")
+        self.assertEqual(self.invoice.fel_invoice_number, "2849581397")
+
+    def test_parse_datetime_formats(self):
+        self.assertEqual(
+            parse_datetime("2021-10-05T10:21:33"),
+            datetime.datetime(2021, 10, 5, 10, 21, 33),
+        )
+        self.assertEqual(
+            parse_datetime("2021-10-05T10:21:33.5"),
+            datetime.datetime(2021, 10, 5, 10, 21, 33, 500000),
+        )
+        self.assertEqual(
+            parse_datetime("2021-10-05T10:21:33-0600").utcoffset(),
+            datetime.timedelta(hours=-6),
+        )
+        with self.assertRaises(ValueError):
+            parse_datetime("05-10-2021")
+
+
+class TestLazyInvoice(unittest.TestCase):
+    def setUp(self):
+        self.content = read_fixture("valid_dte.xml")
+
+    def test_same_values_as_invoice(self):
+        lazy = LazyInvoice(self.content)
+        self.assertEqual(lazy.to_invoice(), parse_invoice_xml(self.content))
+        self.assertEqual(lazy, parse_invoice_xml(self.content))
+        self.assertIsNone(lazy._sections)
+
+    def test_builds_only_what_is_read(self):
+        lazy = LazyInvoice(self.content)
+        self.assertIsNone(lazy._sections)
+        self.assertEqual(lazy.headers.issuer.nit, "12345678")
+        self.assertEqual(lazy.totals.grand_total, 140.0)
+        self.assertIsNone(lazy._lines)
+        self.assertIs(lazy.headers, lazy.headers)
+        self.assertEqual(len(lazy.lines), 2)
+
+    def test_releases_the_tree(self):
+        lazy = LazyInvoice(self.content)
+        self.assertEqual(lazy.headers.issuer.nit, "12345678")
+        self.assertEqual(lazy.totals.grand_total, 140.0)
+        self.assertEqual(
+            lazy.fel_signature, parse_invoice_xml(self.content).fel_signature
+        )
+        self.assertIsNone(lazy._sections)
+        self.assertIsNone(lazy._lines)
+        self.assertEqual(len(lazy.lines), 2)
+        self.assertIsNone(lazy._sections)
+
+    def test_invalid_xml_fails_on_access(self):
+        lazy = LazyInvoice(b"<not-a-dte/>")
+        with self.assertRaises(Exception):
+            lazy.fel_signature
+
+
+class TestInvoiceHeaderSummary(unittest.TestCase):
+    def test_from_listing(self):
+        header = {
+            "numeroUuid": "0A1B2C3D-A9DA-4C15-8E7A-6B4D3F2E1C0B",
+            "serie": "0A1B2C3D",
+            "numeroDte": "2849581397",
+            "fechaEmision": "2021-10-05T10:21:33-06:00",
+            "nitEmisor": "12345678",
+            "nitReceptor": "87654321",
+            "establecimiento": 1,
+            "granTotal": "140.00",
+            "estado": "I",
+        }
+        summary = parse_invoice_header(header)
+        self.assertEqual(summary.issuer_nit, "12345678")
+        self.assertEqual(summary.establishment, "1")
+        self.assertEqual(summary.grand_total, 140.0)
+        self.assertEqual(summary.status, EstadoDTE.ANULADAS)
+        self.assertEqual(summary.issue_date.date(), datetime.date(2021, 10, 5))
+        self.assertIsNone(summary.currency)
+        self.assertIs(summary.header, header)
+        self.assertFalse(hasattr(summary, "__dict__"))
+
+    def test_day_month_year_dates(self):
+        summary = parse_invoice_header(
+            {"numeroUuid": "A", "fechaEmision": "05/10/2021"}
+        )
+        self.assertEqual(summary.issue_date, datetime.datetime(2021, 10, 5))
+        self.assertIsNone(summary.grand_total)
+        self.assertIsNone(summary.status)
+
+
+class TestModels(unittest.TestCase):
+    def test_models_are_slotted(self):
+        address = Address("STREET", "01001", "GUATEMALA", "GUATEMALA")
+        self.assertFalse(hasattr(address, "__dict__"))
+        self.assertEqual(address.country, "GT")
+        with self.assertRaises(AttributeError):
+            address.unknown = 1
+
+    def test_builder_still_works(self):
+        issuer = (
+            IssuingModel.builder()
+            .set_nit("12345678")
+            .set_commercial_name("COMERCIAL")
+            .set_issuing_name("EMISOR")
+            .set_address(None)
+            .set_vat_affiliation("GEN")
+            .set_establishment("1")
+            .set_email(None)
+            .build()
+        )
+        self.assertEqual(issuer.nit, "12345678")
+        self.assertFalse(hasattr(issuer, "__dict__"))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+import os
+import datetime
+import tempfile
+import threading
+import unittest
+from sat_gt_fel_invoices_downloader.jobs import (
+    DONE,
+    FAILED,
+    PENDING,
+    RUNNING,
+    DownloadJob,
+)
+from sat_gt_fel_invoices_downloader.models import EstadoDTE, SATFELFilters, TypeFEL
+
+FILTERS = SATFELFilters(
+    0,
+    EstadoDTE.TODOS,
+    datetime.date(2021, 1, 1),
+    datetime.date(2021, 1, 31),
+    TypeFEL.RECIBIDA,
+)
+
+
+class FakeFelDownloader:
+    def __init__(self, failing):
+        self.failing = failing
+        self.downloaded = []
+        self.lock = threading.Lock()
+
+    def _stream_document(self, invoice, filetype, save_in_dir, received):
+        uuid = invoice["numeroUuid"]
+        with self.lock:
+            self.downloaded.append((uuid, filetype))
+        if uuid in self.failing:
+            raise ValueError("SAT is down")
+        filename = os.path.join(save_in_dir, uuid + "." + filetype)
+        with open(filename, "wb") as f:
+            f.write(b"content")
+        return filename
+
+
+class FakeDownloader:
+    def __init__(self, count, failing=()):
+        self.invoices = [{"numeroUuid": "UUID-{}".format(i)} for i in range(count)]
+        self.queries = 0
+        self.fel = FakeFelDownloader(failing)
+
+    def get_invoices_with_filters(self, filters):
+        self.queries += 1
+        return self.invoices
+
+    def _get_downloader(self):
+        return self.fel
+
+    def _call(self, function):
+        return function(self.fel)
+
+
+class TestDownloadJob(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_runs_every_task(self):
+        downloader = FakeDownloader(10, failing={"UUID-3"})
+        job = DownloadJob(self.path, max_attempts=2)
+        self.assertEqual(job.plan(downloader, FILTERS, formats=("xml", "pdf")), 20)
+        progress = job.run(downloader, workers=3)
+        self.assertEqual(progress[DONE], 18)
+        self.assertEqual(progress[FAILED], 2)
+        self.assertTrue(os.path.exists(os.path.join(self.path, "UUID-0.pdf")))
+        # Both formats of UUID-3 were tried twice
+        self.assertEqual(downloader.fel.downloaded.count(("UUID-3", "xml")), 2)
+
+    def test_resumes_where_it_stopped(self):
+        downloader = FakeDownloader(5)
+        job = DownloadJob(self.path, lease_seconds=0)
+        job.plan(downloader, FILTERS, formats=("xml",))
+        for _ in range(2):
+            uuid, filetype, invoice = job.claim()
+            job.complete(uuid, filetype, "done")
+        # A worker that died holding a task, its lease expired already
+        job.claim()
+
+        resumed = DownloadJob(self.path)
+        resumed.plan(downloader, FILTERS, formats=("xml",))
+        self.assertEqual(downloader.queries, 1)
+        self.assertEqual(resumed.progress()[PENDING], 2)
+        progress = resumed.run(downloader, workers=2)
+        self.assertEqual(progress[DONE], 5)
+        self.assertEqual(len(downloader.fel.downloaded), 3)
+
+    def test_unknown_formats(self):
+        downloader = FakeDownloader(1)
+        job = DownloadJob(self.path)
+        for formats in (("document",), ("xml", "csv")):
+            with self.assertRaises(ValueError):
+                job.plan(downloader, FILTERS, formats=formats)
+        self.assertEqual(downloader.queries, 0)
+
+    def test_resumes_right_after_a_crash(self):
+        downloader = FakeDownloader(3)
+        job = DownloadJob(self.path, lease_seconds=0.3)
+        job.plan(downloader, FILTERS, formats=("xml",))
+        # The worker crashed holding a task whose lease didn't expire yet
+        job.claim()
+
+        resumed = DownloadJob(self.path, lease_seconds=0.3)
+        progress = resumed.run(downloader, workers=2)
+        self.assertEqual(progress[DONE], 3)
+        self.assertEqual(progress[RUNNING], 0)
+        self.assertEqual(len(downloader.fel.downloaded), 3)
+
+    def test_add_and_remove_workers(self):
+        downloader = FakeDownloader(20)
+        job = DownloadJob(self.path)
+        job.plan(downloader, FILTERS, formats=("xml",))
+        runner = job.start(downloader, workers=1)
+        runner.add_workers(2)
+        runner.remove_workers(1)
+        runner.join()
+        self.assertEqual(job.progress()[DONE], 20)
+        self.assertEqual(runner.workers, 0)
@@ -0,0 +1,77 @@
+import socket
+import datetime
+import unittest
+from sat_gt_fel_invoices_downloader import metrics
+from sat_gt_fel_invoices_downloader.main import SATDownloader
+from sat_gt_fel_invoices_downloader.models import (
+    EstadoDTE,
+    SatCredentials,
+    SATFELFilters,
+    TypeFEL,
+)
+from .mock_sat import MockSAT
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.sink = metrics.InMemorySink()
+        metrics.set_sink(self.sink)
+
+    def tearDown(self):
+        metrics.set_sink(None)
+
+    def test_span_and_counters(self):
+        with metrics.span("query", format="xml"):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.span("query", format="pdf"):
+                raise ValueError()
+        metrics.increment("bytes", 10, format="xml")
+        metrics.increment("bytes", 5, format="pdf")
+        self.assertEqual(self.sink.summary()["query"]["count"], 2)
+        self.assertEqual(self.sink.counter("query_errors"), 1)
+        self.assertEqual(self.sink.counter("bytes"), 15)
+        self.assertEqual(self.sink.counter("bytes", format="xml"), 10)
+
+    def test_disabled(self):
+        metrics.set_sink(None)
+
+        @metrics.timed("work")
+        def work():
+            return 1
+
+        self.assertEqual(work(), 1)
+        with metrics.span("query"):
+            metrics.increment("bytes")
+        self.assertEqual(self.sink.counters, {})
+        self.assertEqual(self.sink.timings, {})
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+        metrics.set_sink(metrics.StatsDSink(*server.getsockname()))
+        metrics.increment("retries", host="sat")
+        self.assertEqual(server.recv(1024), b"sat_fel.retries:1|c|#host:sat")
+
+    def test_downloader_stages(self):
+        filters = SATFELFilters(
+            0,
+            EstadoDTE.TODOS,
+            datetime.date(2021, 1, 1),
+            datetime.date(2021, 1, 3),
+            TypeFEL.RECIBIDA,
+        )
+        with MockSAT(invoices_per_day=2, contingency_rate=1) as mock:
+            downloader = SATDownloader(request_session=mock.session())
+            downloader.setCredentials(SatCredentials(mock.username, mock.password))
+            invoices = downloader.get_invoices_with_filters(filters)
+            results = list(downloader.download_many(invoices, formats=("pdf",)))
+        self.assertTrue(all(result.ok for result in results))
+        summary = self.sink.summary()
+        for stage in ("login", "menu", "fel_page", "headers_query", "document"):
+            self.assertIn(stage, summary)
+        self.assertEqual(self.sink.counter("invoices_listed"), 6)
+        self.assertEqual(self.sink.counter("contingency_hits"), 6)
+        self.assertGreater(self.sink.counter("bytes_downloaded", format="pdf"), 0)
@@ -0,0 +1,93 @@
+import os
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+from sat_gt_fel_invoices_downloader.models import (
+    EstadoDTE,
+    SatCredentials,
+    SATFELFilters,
+    TypeFEL,
+)
+from sat_gt_fel_invoices_downloader.multi_account import MultiAccountDownloader
+from sat_gt_fel_invoices_downloader.session_pool import SessionPool
+from .mock_sat import MockSAT
+
+
+def filters(days):
+    start = datetime.date(2021, 1, 1)
+    return SATFELFilters(
+        0,
+        EstadoDTE.TODOS,
+        start,
+        start + datetime.timedelta(days=days - 1),
+        TypeFEL.RECIBIDA,
+    )
+
+
+class TestMultiAccountDownloader(unittest.TestCase):
+    def setUp(self):
+        self.sat = MockSAT(
+            invoices_per_day=2, accounts={"22222222": "other", "33333333": "third"}
+        )
+        self.sat.start_server()
+        self.addCleanup(self.sat.stop_server)
+        new_session = SessionPool._new_session
+        patcher = mock.patch.object(
+            SessionPool,
+            "_new_session",
+            lambda pool: self.sat.session(new_session(pool)),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_tags_results_by_account(self):
+        accounts = [
+            (SatCredentials(self.sat.username, self.sat.password), filters(3)),
+            (SatCredentials("22222222", "other"), filters(2)),
+        ]
+        with tempfile.TemporaryDirectory() as d:
+            downloader = MultiAccountDownloader(
+                accounts, formats=("xml",), workers=4, save_in_dir=d
+            )
+            results = list(downloader)
+            self.assertEqual(len(os.listdir(os.path.join(d, "22222222"))), 4)
+        self.assertTrue(all(result.ok for result in results))
+        by_account = {}
+        for result in results:
+            by_account[result.account] = by_account.get(result.account, 0) + 1
+        self.assertEqual(by_account, {self.sat.username: 6, "22222222": 4})
+        self.assertEqual(len(downloader.pool), 0)
+
+    def test_big_account_does_not_starve_the_rest(self):
+        accounts = [
+            (SatCredentials(self.sat.username, self.sat.password), filters(20)),
+            (SatCredentials("22222222", "other"), filters(1)),
+        ]
+        downloader = MultiAccountDownloader(
+            accounts, formats=("xml",), workers=2, workers_per_account=1
+        )
+        order = [result.account for result in downloader]
+        self.assertEqual(len(order), 42)
+        last_small = max(i for i, name in enumerate(order) if name == "22222222")
+        self.assertLess(last_small, 10)
+
+    def test_failed_login_only_affects_its_account(self):
+        accounts = [
+            (SatCredentials("22222222", "wrong"), filters(1)),
+            (SatCredentials("33333333", "third"), filters(1)),
+        ]
+        downloader = MultiAccountDownloader(
+            accounts, formats=("xml", "pdf"), max_active_accounts=1
+        )
+        results = list(downloader)
+        failed = [result for result in results if not result.ok]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0].account, "22222222")
+        self.assertEqual(failed[0].format, "list")
+        self.assertEqual(len(results), 5)
+
+    def test_rejects_repeated_accounts(self):
+        credentials = SatCredentials("22222222", "other")
+        with self.assertRaises(ValueError):
+            MultiAccountDownloader([(credentials, filters(1))] * 2)
@@ -0,0 +1,60 @@
+import io
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+from sat_gt_fel_invoices_downloader.offline import main, parse_directory
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "valid_dte.xml")
+
+
+class TestOffline(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+        os.makedirs(os.path.join(self.path, "2021", "01"))
+        for index in range(5):
+            folder = self.path if index % 2 else os.path.join(self.path, "2021", "01")
+            shutil.copy(FIXTURE, os.path.join(folder, "{}.xml".format(index)))
+        with open(os.path.join(self.path, "broken.xml"), "wb") as f:
+            f.write(b"<dte:GTDocumento")
+        with open(os.path.join(self.path, "notes.txt"), "wb") as f:
+            f.write(b"not an invoice")
+
+    def check_results(self, results):
+        self.assertEqual(len(results), 6)
+        errors = [result for result in results if not result.ok]
+        self.assertEqual([os.path.basename(r.path) for r in errors], ["broken.xml"])
+        self.assertIsInstance(errors[0].error, ValueError)
+        for result in results:
+            if result.ok:
+                self.assertTrue(result.invoice.fel_signature)
+
+    def test_parse_in_process(self):
+        self.check_results(list(parse_directory(self.path, workers=1, chunk_size=2)))
+
+    def test_parse_with_workers(self):
+        self.check_results(list(parse_directory(self.path, workers=2, chunk_size=2)))
+
+    def test_cli_writes_jsonl(self):
+        output = os.path.join(self.path, "output")
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            code = main([self.path, "-o", output, "-w", "1", "--chunk-size", "2"])
+        self.assertEqual(code, 1)
+        self.assertEqual(stdout.getvalue().strip(), "Parsed 5 invoices, 1 errors")
+        self.assertEqual(
+            sorted(os.listdir(output)),
+            ["invoices-000000.jsonl", "invoices-000001.jsonl", "invoices-000002.jsonl"],
+        )
+        rows = []
+        for filename in sorted(os.listdir(output)):
+            with open(os.path.join(output, filename)) as f:
+                rows += [json.loads(line) for line in f]
+        self.assertEqual(len(rows), 5)
+        for row in rows:
+            self.assertTrue(row["path"].endswith(".xml"))
+            self.assertTrue(row["fel_signature"])
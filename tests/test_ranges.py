@@ -0,0 +1,47 @@
+import datetime
+import unittest
+from sat_gt_fel_invoices_downloader.models import EstadoDTE, SATFELFilters, TypeFEL
+from sat_gt_fel_invoices_downloader.ranges import (
+    halve_filters,
+    merge_invoices,
+    split_filters,
+)
+
+
+def make_filters(start, end):
+    return SATFELFilters(0, EstadoDTE.TODOS, start, end, TypeFEL.RECIBIDA)
+
+
+class TestRanges(unittest.TestCase):
+    def test_split_filters_covers_range(self):
+        filters = make_filters(datetime.date(2021, 1, 1), datetime.date(2021, 1, 17))
+        windows = list(split_filters(filters, days=7))
+        self.assertEqual(
+            [(w.fechaInicio.day, w.fechaFin.day) for w in windows],
+            [(1, 7), (8, 14), (15, 17)],
+        )
+        self.assertEqual(windows[0].tipo, TypeFEL.RECIBIDA)
+
+    def test_split_filters_needs_a_day(self):
+        filters = make_filters(datetime.date(2021, 1, 1), datetime.date(2021, 1, 17))
+        for days in (0, -1):
+            with self.assertRaises(ValueError):
+                split_filters(filters, days=days)
+
+    def test_halve_filters(self):
+        filters = make_filters(datetime.date(2021, 1, 1), datetime.date(2021, 1, 4))
+        first, second = halve_filters(filters)
+        self.assertEqual((first.fechaInicio.day, first.fechaFin.day), (1, 2))
+        self.assertEqual((second.fechaInicio.day, second.fechaFin.day), (3, 4))
+        single_day = make_filters(datetime.date(2021, 1, 1), datetime.date(2021, 1, 1))
+        self.assertIsNone(halve_filters(single_day))
+
+    def test_merge_invoices(self):
+        merged = merge_invoices(
+            [[{"numeroUuid": "A"}, {"numeroUuid": "B"}], [{"numeroUuid": "A"}]]
+        )
+        self.assertEqual([i["numeroUuid"] for i in merged], ["A", "B"])
+
+
+if __name__ == "__main__":
+    unittest.main()
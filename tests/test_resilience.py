@@ -0,0 +1,157 @@
+import unittest
+import requests
+from requests.adapters import BaseAdapter
+from sat_gt_fel_invoices_downloader.resilience import (
+    CircuitBreaker,
+    RateLimiter,
+    ResilientSession,
+    RetryPolicy,
+    default_session,
+    parse_retry_after,
+)
+from sat_gt_fel_invoices_downloader.main import SATDownloader
+
+
+class ScriptedAdapter(BaseAdapter):
+    """
+    Answers with the given status codes in order, exceptions are raised.
+    """
+
+    def __init__(self, answers):
+        super().__init__()
+        self.answers = list(answers)
+        self.calls = 0
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        status, headers = answer if isinstance(answer, tuple) else (answer, {})
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response.url = request.url
+        response.request = request
+        response._content = b""
+        return response
+
+    def close(self):
+        pass
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def make_session(answers, **kwargs):
+    sleeps = []
+    session = ResilientSession(sleep=sleeps.append, **kwargs)
+    adapter = ScriptedAdapter(answers)
+    session.mount("https://", adapter)
+    return session, adapter, sleeps
+
+
+class TestResilientSession(unittest.TestCase):
+    def test_retries_transient_errors(self):
+        session, adapter, sleeps = make_session(
+            [503, requests.ConnectionError("reset"), 200]
+        )
+        response = session.get("https://felcons.c.sat.gob.gt/x")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(adapter.calls, 3)
+        self.assertEqual(len(sleeps), 2)
+
+    def test_gives_up_after_max_retries(self):
+        session, adapter, _ = make_session(
+            [503, 503, 503], default_policy=RetryPolicy(max_retries=2)
+        )
+        self.assertEqual(session.get("https://sat.gob.gt/x").status_code, 503)
+        session, adapter, _ = make_session(
+            [requests.Timeout(), requests.Timeout()],
+            default_policy=RetryPolicy(max_retries=1),
+        )
+        with self.assertRaises(requests.Timeout):
+            session.get("https://sat.gob.gt/x")
+
+    def test_does_not_retry_other_statuses(self):
+        session, adapter, _ = make_session([500])
+        self.assertEqual(session.get("https://sat.gob.gt/x").status_code, 500)
+        self.assertEqual(adapter.calls, 1)
+
+    def test_retry_after(self):
+        session, adapter, sleeps = make_session([(429, {"Retry-After": "7"}), 200])
+        session.get("https://sat.gob.gt/x")
+        self.assertEqual(sleeps, [7])
+
+    def test_policy_per_endpoint(self):
+        session, adapter, _ = make_session(
+            [503, 200], policies=[("init\\.do", RetryPolicy(max_retries=0))]
+        )
+        self.assertEqual(session.post("https://sat.gob.gt/init.do").status_code, 503)
+        self.assertEqual(session.get("https://sat.gob.gt/x").status_code, 200)
+
+    def test_circuit_pauses_the_host(self):
+        session, adapter, sleeps = make_session(
+            [503, 503, 200],
+            default_policy=RetryPolicy(max_retries=0),
+            failure_threshold=2,
+            reset_timeout=30,
+        )
+        session.get("https://sat.gob.gt/x")
+        session.get("https://sat.gob.gt/x")
+        self.assertTrue(session.breaker_for("https://sat.gob.gt/y").is_open)
+        session.get("https://sat.gob.gt/x")
+        self.assertGreater(sleeps[0], 29)
+        self.assertFalse(session.breaker_for("https://sat.gob.gt/y").is_open)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_and_recovers(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        self.assertEqual(breaker.remaining(), 0)
+        breaker.record_failure()
+        self.assertEqual(breaker.remaining(), 10)
+        clock.now = 10
+        self.assertEqual(breaker.remaining(), 0)
+        breaker.record_failure()
+        self.assertEqual(breaker.remaining(), 10)
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_limits_rate(self):
+        clock = FakeClock()
+        limiter = RateLimiter(2, burst=2, clock=clock, sleep=clock.sleep)
+        for _ in range(6):
+            limiter.acquire()
+        self.assertAlmostEqual(clock.now, 2)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("12"), 12)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        self.assertIsNone(parse_retry_after("soon"))
+        self.assertIsNone(parse_retry_after(None))
+
+
+class TestDefaultSession(unittest.TestCase):
+    def test_pool_size(self):
+        for session, size in (
+            (default_session(), 20),
+            (default_session(pool_size=4), 4),
+            (SATDownloader(pool_size=32).session, 32),
+        ):
+            adapter = session.get_adapter("https://felcons.c.sat.gob.gt")
+            self.assertEqual(adapter._pool_maxsize, size)
+            self.assertFalse(adapter._pool_block)
+            self.assertIs(session.get_adapter("http://example.com"), adapter)
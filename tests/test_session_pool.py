@@ -0,0 +1,71 @@
+import unittest
+from unittest import mock
+from sat_gt_fel_invoices_downloader.actions import SessionExpiredError
+from sat_gt_fel_invoices_downloader.main import SATDownloader
+from sat_gt_fel_invoices_downloader.models import SatCredentials
+from sat_gt_fel_invoices_downloader.session_pool import SessionPool
+
+
+def fake_initialize(downloader):
+    downloader.its_initialized = True
+    downloader._downloader = object()
+
+
+def fake_logout(downloader):
+    downloader.its_initialized = False
+    downloader._downloader = None
+
+
+@mock.patch.object(SATDownloader, "logout", fake_logout)
+@mock.patch.object(SATDownloader, "initialize", fake_initialize)
+class TestSessionPool(unittest.TestCase):
+    def test_reuses_sessions(self):
+        credentials = SatCredentials("1234", "secret")
+        with SessionPool() as pool:
+            downloader = pool.get(credentials)
+            self.assertTrue(downloader.its_initialized)
+            self.assertIs(pool.get(credentials), downloader)
+            self.assertEqual(len(pool), 1)
+
+    def test_evicts_least_recently_used(self):
+        pool = SessionPool(max_connections=8, connections_per_session=4)
+        first = pool.get(SatCredentials("1", "a"))
+        second = pool.get(SatCredentials("2", "b"))
+        pool.get(SatCredentials("1", "a"))
+        pool.get(SatCredentials("3", "c"))
+        self.assertEqual(len(pool), 2)
+        self.assertTrue(first.its_initialized)
+        self.assertFalse(second.its_initialized)
+        pool.close()
+        self.assertEqual(len(pool), 0)
+        self.assertFalse(first.its_initialized)
+
+    def test_sessions_pool_is_bounded(self):
+        pool = SessionPool(connections_per_session=2)
+        downloader = pool.get(SatCredentials("1", "a"))
+        adapter = downloader.session.get_adapter("https://felcons.c.sat.gob.gt")
+        self.assertEqual(adapter._pool_maxsize, 2)
+        self.assertTrue(adapter._pool_block)
+
+
+@mock.patch.object(SATDownloader, "initialize", fake_initialize)
+class TestRelogin(unittest.TestCase):
+    def test_retries_once_after_expired_session(self):
+        downloader = SATDownloader().setCredentials(SatCredentials("1", "a"))
+        seen = []
+
+        def function(fel_downloader):
+            seen.append(fel_downloader)
+            if len(seen) == 1:
+                raise SessionExpiredError()
+            return "ok"
+
+        self.assertEqual(downloader._call(function), "ok")
+        self.assertEqual(len(seen), 2)
+        self.assertIsNot(seen[0], seen[1])
+
+    def test_token_ttl(self):
+        downloader = SATDownloader(token_ttl=0).setCredentials(SatCredentials("1", "a"))
+        first = downloader._get_downloader()
+        downloader.authenticated_at = -1
+        self.assertIsNot(downloader._get_downloader(), first)
@@ -0,0 +1,69 @@
+import os
+import datetime
+import unittest
+from sat_gt_fel_invoices_downloader import parse_invoice_xml
+from sat_gt_fel_invoices_downloader.models import EstadoDTE
+from sat_gt_fel_invoices_downloader.store import InvoiceStore
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "valid_dte.xml")
+
+
+class TestInvoiceStore(unittest.TestCase):
+    def setUp(self):
+        with open(FIXTURE, "rb") as f:
+            self.content = f.read()
+        self.invoice = parse_invoice_xml(self.content)
+        self.store = InvoiceStore(":memory:")
+
+    def tearDown(self):
+        self.store.close()
+
+    def header(self, **values):
+        header = {
+            "numeroUuid": self.invoice.fel_signature,
+            "nitEmisor": self.invoice.headers.issuer.nit,
+            "nitReceptor": self.invoice.headers.receiver.nit,
+            "fechaEmision": self.invoice.headers.issue_date.isoformat(),
+            "granTotal": self.invoice.totals.grand_total,
+            "estado": "V",
+        }
+        header.update(values)
+        return header
+
+    def test_round_trip(self):
+        self.store.upsert_invoices([self.invoice])
+        self.assertEqual(
+            self.store.get_invoice(self.invoice.fel_signature), self.invoice
+        )
+
+    def test_upsert_xml_matches_models(self):
+        self.store.upsert_xml([self.content])
+        self.store.upsert_xml([self.content])
+        self.assertEqual(self.store.count(), 1)
+        self.assertEqual(list(self.store.find_invoices()), [self.invoice])
+
+    def test_find_invoices(self):
+        self.store.upsert_invoices([self.invoice])
+        day = self.invoice.headers.issue_date.date()
+        nit = self.invoice.headers.issuer.nit
+        total = self.invoice.totals.grand_total
+        self.assertEqual(self.store.count(issuer_nit=nit, since=day, until=day), 1)
+        self.assertEqual(self.store.count(issuer_nit=nit, min_total=total + 1), 0)
+        self.assertEqual(self.store.count(since=day + datetime.timedelta(days=1)), 0)
+        self.assertEqual(self.store.count(receiver_nit="nobody"), 0)
+
+    def test_headers_and_status(self):
+        self.store.upsert_headers([self.header(estado="I")])
+        self.assertEqual(self.store.missing_invoices(), [self.invoice.fel_signature])
+        self.store.upsert_invoices([self.invoice])
+        self.assertEqual(self.store.missing_invoices(), [])
+        self.assertEqual(self.store.count(status=EstadoDTE.ANULADAS), 1)
+        self.assertEqual(self.store.count(status=EstadoDTE.VIGENTES), 0)
+        headers = list(
+            self.store.find_headers(issuer_nit=self.invoice.headers.issuer.nit)
+        )
+        self.assertEqual(headers, [self.header(estado="I")])
+
+
+if __name__ == "__main__":
+    unittest.main()
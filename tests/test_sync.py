@@ -0,0 +1,137 @@
+import os
+import json
+import datetime
+import tempfile
+import unittest
+from sat_gt_fel_invoices_downloader.main import SATDownloader
+from sat_gt_fel_invoices_downloader.models import DownloadResult, SatCredentials
+from sat_gt_fel_invoices_downloader.sync import InvoiceSync, is_valid_document
+from .mock_sat import MockSAT
+
+SINCE = datetime.date(2021, 1, 1)
+XML_PATH = "/dte-agencia-virtual/api/consulta-dte/xml"
+PDF_PATH = "/dte-agencia-virtual/api/consulta-dte/pdf"
+LIST_PATH = "/dte-agencia-virtual/api/consulta-dte"
+
+
+class FailingDownloader(SATDownloader):
+    """
+    Fails the pdf of the invoices in fail, and answers an empty xml for the
+    ones in empty.
+    """
+
+    def __init__(self, fail=(), empty=(), **kwargs):
+        super().__init__(**kwargs)
+        self.fail = set(fail)
+        self.empty = set(empty)
+
+    def download_one(self, invoice, filetype, *args, **kwargs):
+        uuid = invoice["numeroUuid"]
+        if uuid in self.fail and filetype == "pdf":
+            return DownloadResult(invoice, filetype, error=ValueError())
+        if uuid in self.empty and filetype == "xml":
+            return DownloadResult(invoice, filetype, b"")
+        return super().download_one(invoice, filetype, *args, **kwargs)
+
+
+class TestInvoiceSync(unittest.TestCase):
+    def setUp(self):
+        self.sat = MockSAT(invoices_per_day=2)
+        self.sat.start_server()
+        self.addCleanup(self.sat.stop_server)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def make_downloader(self, cls=SATDownloader, **kwargs):
+        downloader = cls(request_session=self.sat.session(), **kwargs)
+        credentials = SatCredentials(self.sat.username, self.sat.password)
+        return downloader.setCredentials(credentials)
+
+    def manifest(self):
+        with open(os.path.join(self.directory, "manifest.json")) as f:
+            return json.load(f)
+
+    def test_first_run(self):
+        until = datetime.date(2021, 1, 5)
+        report = self.make_downloader().sync(self.directory, SINCE, until)
+        self.assertEqual(len(report.new), 10)
+        self.assertEqual(
+            (report.changed, report.unchanged, report.failed), ([], [], [])
+        )
+        manifest = self.manifest()
+        self.assertEqual(manifest["watermark"], "2021-01-05")
+        self.assertEqual(sorted(manifest["invoices"]), sorted(report.new))
+        for uuid, entry in manifest["invoices"].items():
+            self.assertEqual(entry["status"], "V")
+            for filetype in ("xml", "pdf"):
+                with open(
+                    os.path.join(self.directory, entry["files"][filetype]), "rb"
+                ) as f:
+                    self.assertTrue(is_valid_document(filetype, f.read()))
+
+    def test_delta_run(self):
+        first = self.make_downloader().sync(
+            self.directory, SINCE, datetime.date(2021, 1, 5)
+        )
+        downloads = self.sat.requests[XML_PATH] + self.sat.requests[PDF_PATH]
+        report = self.make_downloader().sync(
+            self.directory, until=datetime.date(2021, 1, 8)
+        )
+        self.assertEqual(sorted(report.unchanged), sorted(first.new))
+        self.assertEqual(len(report.new), 6)
+        self.assertEqual(report.changed, [])
+        self.assertEqual(self.manifest()["watermark"], "2021-01-08")
+        # Only the new invoices are downloaded again
+        downloads = (
+            self.sat.requests[XML_PATH] + self.sat.requests[PDF_PATH] - downloads
+        )
+        self.assertEqual(downloads, 6 * 2)
+
+    def test_status_change(self):
+        until = datetime.date(2021, 1, 3)
+        first = self.make_downloader().sync(self.directory, SINCE, until)
+        self.sat.void_rate = 1
+        report = self.make_downloader().sync(self.directory, until=until)
+        self.assertEqual(sorted(report.changed), sorted(first.new))
+        self.assertEqual((report.new, report.unchanged), ([], []))
+        statuses = {e["status"] for e in self.manifest()["invoices"].values()}
+        self.assertEqual(statuses, {"I"})
+
+    def test_failures_are_retried_by_day(self):
+        until = datetime.date(2021, 1, 3)
+        self.make_downloader().sync(self.directory, SINCE, until)
+        new = [
+            header["numeroUuid"]
+            for day in range(4, 7)
+            for header in self.sat.headers_for_day(datetime.date(2021, 1, day))
+        ]
+        downloader = self.make_downloader(
+            FailingDownloader, fail=new[:1], empty=new[1:2]
+        )
+        invoice_sync = InvoiceSync(downloader, self.directory, lookback_days=0)
+        report = invoice_sync.run(until=datetime.date(2021, 1, 6))
+        self.assertEqual(report.failed, sorted(new[:2]))
+        self.assertEqual(len(report.new), 4)
+        manifest = self.manifest()
+        # The watermark moves on, the failed invoices are kept apart
+        self.assertEqual(manifest["watermark"], "2021-01-06")
+        self.assertEqual(manifest["failed"], {uuid: "2021-01-04" for uuid in new[:2]})
+        for uuid in new[:2]:
+            self.assertNotIn(uuid, manifest["invoices"])
+
+        # The next run only queries again the day of the failed invoices
+        queries = self.sat.requests[LIST_PATH]
+        invoice_sync = InvoiceSync(
+            self.make_downloader(), self.directory, lookback_days=0
+        )
+        report = invoice_sync.run(until=datetime.date(2021, 1, 8))
+        self.assertEqual(self.sat.requests[LIST_PATH] - queries, 2)
+        self.assertEqual(len(report.new), 2 + 4)
+        self.assertTrue(set(new[:2]) <= set(report.new))
+        self.assertEqual(report.failed, [])
+        manifest = self.manifest()
+        self.assertEqual(manifest["watermark"], "2021-01-08")
+        self.assertEqual(manifest["failed"], {})
+        for uuid in new[:2]:
+            self.assertEqual(manifest["invoices"][uuid]["status"], "V")